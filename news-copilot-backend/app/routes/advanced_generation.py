@@ -5,6 +5,7 @@ Provides comprehensive news completion and generation endpoints
 
 from flask import Blueprint, request, jsonify
 from http import HTTPStatus
+from app.utils.response_helper import APIResponse
 import logging
 from datetime import datetime
 
@@ -31,8 +32,11 @@ def complete_article():
         "context": "news|sports|technology|politics|business|health",
         "maxTokens": 100,
         "temperature": 0.7,
-        "style": "formal|casual|breaking|analysis"
+        "style": "formal|casual|breaking|analysis",
+        "stream": false
     }
+    
+    With "stream": true the continuation is sent as server-sent events while it is generated.
     """
     try:
         if not request.is_json:
@@ -60,6 +64,22 @@ def complete_article():
         if not SERVICE_AVAILABLE:
             return _fallback_article_completion(content, context, max_tokens)
         
+        if data.get("stream", False):
+            return APIResponse.event_stream(
+                news_completion_service.stream_completion(
+                    content=content,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    context=context
+                ),
+                done_data={
+                    "context": context,
+                    "temperature": temperature,
+                    "maxTokens": max_tokens,
+                    "timestamp": datetime.now().isoformat()
+                }
+            )
+        
         # Use the completion service
         result = news_completion_service.complete_article(
             content=content,
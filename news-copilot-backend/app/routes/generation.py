@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify
 from app.extensions import cache
+from app.utils.response_helper import APIResponse
 from http import HTTPStatus
 import logging
 
@@ -46,8 +47,11 @@ def generate_text():
         "maxLength": 100,
         "temperature": 0.7,
         "topK": 20,
-        "topP": 0.9
+        "topP": 0.9,
+        "stream": false
     }
+    
+    With "stream": true the completion is sent as server-sent events while it is generated.
     """
     try:
         # Validate request
@@ -84,6 +88,28 @@ def generate_text():
         
         logger.info(f"Generating text for prompt length: {len(prompt)}, max_length: {max_length}")
         
+        if data.get("stream", False):
+            from app.services.generation.text_generation import text_generation_stream
+            
+            return APIResponse.event_stream(
+                text_generation_stream(
+                    prompt=prompt,
+                    max_length=max_length,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p
+                ),
+                done_data={
+                    "prompt": prompt,
+                    "parameters": {
+                        "maxLength": max_length,
+                        "temperature": temperature,
+                        "topK": top_k,
+                        "topP": top_p
+                    }
+                }
+            )
+        
         # Generate text
         generated_text = generate_text_cached(
             prompt=prompt,
@@ -212,7 +238,7 @@ def health_check():
     try:
         from app.services.generation.text_generation import news_generator
         
-        model_status = "available" if hasattr(news_generator, 'generator') and news_generator.generator else "fallback"
+        model_status = "available" if hasattr(news_generator, 'is_available') and news_generator.is_available() else "fallback"
         
         return jsonify({
             "statusCode": HTTPStatus.OK,
@@ -6,7 +6,7 @@ Integrates the custom transformer model for intelligent news article completion
 import os
 import sys
 import logging
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
 
 # Configure logging
@@ -18,36 +18,38 @@ class NewsCompletionService:
     
     def __init__(self):
         self.model_loaded = False
-        self.generator = None
+        self.client = None
         self.fallback_mode = True
         self._initialize_model()
     
     def _initialize_model(self):
-        """Initialize the transformer model"""
+        """Connect to the local model server (see news-copilot-models/inference/model_server.py)"""
         try:
             # Add models path
             models_path = os.path.join(os.path.dirname(__file__), '../../../../news-copilot-models')
             if os.path.exists(models_path):
                 sys.path.insert(0, models_path)
                 
-                from inference.model_inference import ModelGenerator
+                from inference.model_client import ModelClient
                 
-                # Try to load the model
-                model_path = os.path.join(models_path, 'checkpoints', 'final_model')
-                if os.path.exists(model_path):
-                    self.generator = ModelGenerator(model_path)
-                    self.model_loaded = True
-                    self.fallback_mode = False
-                    logger.info("Successfully loaded transformer model")
-                else:
-                    logger.warning(f"Model path {model_path} not found, using fallback")
+                # The model lives in one server process shared by every worker; this is only a client
+                self.client = ModelClient(timeout=float(os.environ.get('GENERATION_TIMEOUT', 30)))
+                self._check_model_server()
             else:
                 logger.warning("Models directory not found, using fallback")
                 
         except Exception as e:
-            logger.error(f"Failed to initialize transformer model: {e}")
+            logger.error(f"Failed to initialize transformer model client: {e}")
             self.fallback_mode = True
     
+    def _check_model_server(self) -> bool:
+        """Refresh model availability from the model server"""
+        self.model_loaded = self.client is not None and self.client.ping()
+        self.fallback_mode = not self.model_loaded
+        if self.model_loaded:
+            logger.info(f"Connected to model server at {self.client.address}")
+        return self.model_loaded
+    
     def complete_article(self, 
                         content: str,
                         max_tokens: int = 100,
@@ -66,7 +68,7 @@ class NewsCompletionService:
             Dict with completion results
         """
         try:
-            if self.model_loaded and self.generator:
+            if self.model_loaded or self._check_model_server():
                 return self._transformer_completion(content, max_tokens, temperature, context)
             else:
                 return self._fallback_completion(content, max_tokens, context)
@@ -81,7 +83,7 @@ class NewsCompletionService:
             # Optimize parameters based on context
             context_params = self._get_context_parameters(context)
             
-            result = self.generator.generate(
+            result = self.client.generate(
                 prompt=content,
                 max_new_tokens=max_tokens,
                 temperature=temperature,
@@ -100,10 +102,48 @@ class NewsCompletionService:
                 "timestamp": datetime.now().isoformat()
             }
             
+        except (ConnectionError, TimeoutError) as e:
+            logger.error(f"Model server unavailable: {e}")
+            self.model_loaded = False
+            self.fallback_mode = True
+            return self._fallback_completion(content, max_tokens, context)
         except Exception as e:
             logger.error(f"Transformer completion failed: {e}")
             return self._fallback_completion(content, max_tokens, context)
     
+    def stream_completion(self,
+                          content: str,
+                          max_tokens: int = 100,
+                          temperature: float = 0.7,
+                          context: str = "news") -> Iterator[str]:
+        """Yield the continuation of `content` incrementally as the model server decodes it"""
+        started = False
+        try:
+            if self.model_loaded or self._check_model_server():
+                context_params = self._get_context_parameters(context)
+                for chunk in self.client.stream(
+                    prompt=content,
+                    max_new_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=context_params['top_p'],
+                    top_k=context_params['top_k'],
+                    do_sample=True
+                ):
+                    started = True
+                    yield chunk
+                return
+        except Exception as e:
+            logger.error(f"Streaming completion failed: {e}")
+            # Text already sent cannot be taken back, so only fall back before the first chunk
+            if started:
+                raise
+            if isinstance(e, (ConnectionError, TimeoutError)):
+                self.model_loaded = False
+                self.fallback_mode = True
+        
+        completed_text = self._fallback_completion(content, max_tokens, context)["completed_text"]
+        yield completed_text[len(content):] if completed_text.startswith(content) else completed_text
+    
     def _fallback_completion(self, content: str, max_tokens: int, context: str) -> Dict:
         """Fallback completion using rule-based generation"""
         
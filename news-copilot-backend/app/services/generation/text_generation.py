@@ -1,34 +1,29 @@
 import sys
 import os
-import torch
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterator, Optional
 
 # Add the models directory to the path
 sys.path.append(os.path.join(os.path.dirname(__file__), '../../../../news-copilot-models'))
 
 try:
-    from models.transformer_model import TransformerForCausalLM, TransformerConfig
-    from models.custom_tokenizer import CustomTokenizer
-    from inference.model_inference import ModelGenerator
+    from inference.model_client import ModelClient
     
     class NewsTransformerGenerator:
-        """News completion generator using the custom transformer model"""
+        """News completion generator backed by the shared local model server"""
         
-        def __init__(self, model_path: str = None):
-            self.model_path = model_path or "./news-copilot-models/checkpoints/final_model"
-            self.generator = None
-            self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-            self._load_model()
-        
-        def _load_model(self):
-            """Load the transformer model and tokenizer"""
-            try:
-                self.generator = ModelGenerator(self.model_path)
-                print(f"Successfully loaded transformer model from {self.model_path}")
-            except Exception as e:
-                print(f"Failed to load transformer model: {e}")
+        def __init__(self, timeout: Optional[float] = None):
+            if timeout is None:
+                timeout = float(os.environ.get('GENERATION_TIMEOUT', 30))
+            self.client = ModelClient(timeout=timeout)
+            if self.is_available():
+                print(f"Connected to model server at {self.client.address}")
+            else:
+                print(f"Model server at {self.client.address} is not running")
                 print("Using fallback text completion...")
-                self.generator = None
+        
+        def is_available(self) -> bool:
+            """Whether the model server is reachable"""
+            return self.client.ping()
         
         def generate_text(self, 
                          prompt: str,
@@ -39,20 +34,15 @@ try:
                          do_sample: bool = True) -> str:
             """Generate text completion for news articles"""
             
-            if self.generator is None:
-                # Fallback for when model is not available
-                return self._fallback_generation(prompt, max_new_tokens)
-            
             try:
                 # Use the custom transformer for generation
-                result = self.generator.generate(
+                result = self.client.generate(
                     prompt=prompt,
                     max_new_tokens=max_new_tokens,
                     temperature=temperature,
                     top_p=top_p,
                     top_k=top_k,
-                    do_sample=do_sample,
-                    pad_token_id=self.generator.tokenizer.pad_token_id
+                    do_sample=do_sample
                 )
                 
                 return result
@@ -61,6 +51,35 @@ try:
                 print(f"Generation error: {e}")
                 return self._fallback_generation(prompt, max_new_tokens)
         
+        def stream_text(self,
+                        prompt: str,
+                        max_new_tokens: int = 50,
+                        temperature: float = 0.7,
+                        top_p: float = 0.9,
+                        top_k: int = 20,
+                        do_sample: bool = True) -> Iterator[str]:
+            """Yield the completion incrementally as the model server decodes it"""
+            
+            started = False
+            try:
+                for chunk in self.client.stream(
+                    prompt=prompt,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    top_k=top_k,
+                    do_sample=do_sample
+                ):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                print(f"Streaming generation error: {e}")
+                # Text already sent cannot be taken back, so only fall back before the first chunk
+                if started:
+                    raise
+                # Like the model stream, yield only the continuation (the fallback includes the prompt)
+                yield self._fallback_generation(prompt, max_new_tokens)[len(prompt):]
+        
         def _fallback_generation(self, prompt: str, max_length: int) -> str:
             """Fallback generation when model is not available"""
             fallback_completions = {
@@ -103,6 +122,20 @@ try:
         )
         
         return [{"generated_text": generated_text}]
+    
+    def text_generation_stream(prompt: str,
+                               max_length: int = 100,
+                               temperature: float = 0.7,
+                               top_k: int = 20,
+                               top_p: float = 0.9) -> Iterator[str]:
+        """Streaming counterpart of text_generation_pipeline"""
+        return news_generator.stream_text(
+            prompt=prompt,
+            max_new_tokens=max_length,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p
+        )
 
 except ImportError as e:
     print(f"Failed to import transformer components: {e}")
@@ -137,3 +170,12 @@ except ImportError as e:
         # Default completion
         default_completion = f"{prompt} story continues to develop as journalists gather more information and officials prepare statements for the public..."
         return [{"generated_text": default_completion[:len(prompt) + max_length]}]
+    
+    def text_generation_stream(prompt: str,
+                               max_length: int = 100,
+                               temperature: float = 0.7,
+                               top_k: int = 20,
+                               top_p: float = 0.9) -> Iterator[str]:
+        """Fallback streaming: the rule-based continuation (without the prompt) as a single chunk"""
+        result = text_generation_pipeline(prompt, max_length, temperature, top_k, top_p)
+        yield result[0]["generated_text"][len(prompt):]
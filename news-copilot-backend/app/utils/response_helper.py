@@ -1,6 +1,7 @@
-from typing import Any, Dict, List, Optional, Union
+import json
+from typing import Any, Dict, Iterable, List, Optional, Union
 from http import HTTPStatus
-from flask import jsonify, Response
+from flask import jsonify, Response, stream_with_context
 
 
 class APIResponse:
@@ -154,6 +155,26 @@ class APIResponse:
             data={"items": items},
             metadata=metadata
         )
+    
+    @staticmethod
+    def event_stream(chunks: Iterable[str], done_data: Dict[str, Any] = None) -> Response:
+        """
+        Stream text chunks as server-sent events: one `data: {"text": ...}` event per chunk, then
+        an `event: done` with `done_data`, or an `event: error` if the producer fails
+        """
+        def events():
+            try:
+                for chunk in chunks:
+                    yield f"data: {json.dumps({'text': chunk})}\n\n"
+                yield f"event: done\ndata: {json.dumps(done_data or {})}\n\n"
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+        
+        return Response(
+            stream_with_context(events()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
 
 
 class ResponseFormatter:
@@ -34,7 +34,11 @@ try:
         TransformerConfig,
         TransformerForCausalLM,
         TransformerModel,
-        TransformerPreTrainedModel
+        TransformerPreTrainedModel,
+        KVCache,
+        StaticKVCache,
+        SlidingWindowKVCache,
+        no_init_weights
     )
     from .models.custom_tokenizer import (
         CustomTokenizer,
@@ -62,6 +66,10 @@ try:
         "TransformerForCausalLM", 
         "TransformerModel",
         "TransformerPreTrainedModel",
+        "KVCache",
+        "StaticKVCache",
+        "SlidingWindowKVCache",
+        "no_init_weights",
         
         # Tokenizer classes
         "CustomTokenizer",
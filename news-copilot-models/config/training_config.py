@@ -54,7 +54,9 @@ class TrainingConfig:
     use_mixed_precision: bool = True
     precision_type: str = "bf16"  # "fp16", "bf16"
     use_gradient_checkpointing: bool = True
+    gradient_checkpointing_every_n_layers: int = 1  # 1 = every layer; larger is faster but keeps more activations
     use_flash_attention: bool = True
+    attn_implementation: str = "eager"  # "eager", "sdpa" (opt-in: SDPA kernels differ numerically from eager)
     
     # Evaluation and logging
     eval_interval: int = 1000
@@ -14,7 +14,7 @@ project_root = Path(__file__).parent.parent
 sys.path.append(str(project_root))
 
 from models.transformer_model import TransformerConfig, TransformerForCausalLM
-from models.custom_tokenizer import CustomTokenizer, create_custom_tokenizer_from_texts
+from models.custom_tokenizer import CustomTokenizer, TOKENIZER_MODEL_NAME, create_custom_tokenizer_from_texts
 from config.training_config import get_config
 from training.train_model import TransformerTrainer, TrainingArguments, TextDataset, load_training_data
 
@@ -173,7 +173,7 @@ def main():
     
     # Step 2: Create or load tokenizer
     logger.info("Step 2: Setting up tokenizer...")
-    if not os.path.exists(tokenizer_dir):
+    if not os.path.exists(os.path.join(tokenizer_dir, TOKENIZER_MODEL_NAME)):
         logger.info("Creating new tokenizer...")
         training_texts = load_training_data(data_file)[:200]  # Use subset for tokenizer
         tokenizer = create_custom_tokenizer_from_texts(
@@ -270,6 +270,10 @@ def main():
         fp16=False,  # Disable for CPU training
         bf16=False,
         
+        # Memory
+        gradient_checkpointing=training_config.use_gradient_checkpointing,
+        gradient_checkpointing_every_n_layers=training_config.gradient_checkpointing_every_n_layers,
+        
         # Experiment tracking
         run_name=f"{model_name}-example",
         wandb_project="transformer-news-demo",
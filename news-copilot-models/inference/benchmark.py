@@ -0,0 +1,435 @@
+"""
+Generation Benchmark Suite
+Prefill/decode timing over a matrix of prompt lengths, new-token counts, batch sizes and dtypes,
+plus an optional per-layer forward profiler
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import resource
+import itertools
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from inference.model_inference import TransformerGenerator
+
+logger = logging.getLogger(__name__)
+
+BENCHMARK_TEXT = (
+    "The city council approved the new transit budget on Tuesday after a lengthy debate over "
+    "fares, service cuts and the timeline for the long-delayed light rail extension. Officials "
+    "said the plan would add late-night buses on the busiest routes while the state reviews "
+    "its share of the construction costs. "
+)
+
+
+def _percentile(values: Sequence[float], q: float) -> float:
+    """Linearly interpolated percentile, q in [0, 100]"""
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = (len(ordered) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def _summarize(values: Sequence[float]) -> Dict[str, float]:
+    return {
+        "mean": sum(values) / len(values),
+        "p50": _percentile(values, 50),
+        "p95": _percentile(values, 95),
+        "min": min(values),
+        "max": max(values),
+    }
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB (ru_maxrss is KiB on Linux, bytes on macOS)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class LayerProfiler:
+    """
+    Attribute forward time to attention, MLP, norms and lm_head per decoder layer.
+
+    Forward pre/post hooks time every call of the hooked modules; on CUDA each hook synchronizes
+    first, so the numbers are wall time of the module itself (at the cost of extra syncs). Use as
+    a context manager; hooks are removed on exit.
+    """
+
+    def __init__(self, model: torch.nn.Module):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        self._starts: Dict[str, List[float]] = defaultdict(list)
+        self._handles = []
+
+    def _modules(self) -> Dict[str, torch.nn.Module]:
+        modules = {}
+        for layer_idx, layer in enumerate(self.model.model.layers):
+            modules[f"layers.{layer_idx}.attention"] = layer.self_attn
+            modules[f"layers.{layer_idx}.mlp"] = layer.mlp
+            modules[f"layers.{layer_idx}.input_norm"] = layer.input_layernorm
+            modules[f"layers.{layer_idx}.post_attention_norm"] = layer.post_attention_layernorm
+        modules["final_norm"] = self.model.model.norm
+        modules["lm_head"] = self.model.lm_head
+        return modules
+
+    def __enter__(self) -> "LayerProfiler":
+        for name, module in self._modules().items():
+            self._handles.append(module.register_forward_pre_hook(self._pre_hook(name)))
+            self._handles.append(module.register_forward_hook(self._post_hook(name)))
+        return self
+
+    def __exit__(self, *exc_info):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _pre_hook(self, name: str):
+        def hook(module, inputs):
+            _synchronize(self.device)
+            self._starts[name].append(time.perf_counter())
+        return hook
+
+    def _post_hook(self, name: str):
+        def hook(module, inputs, outputs):
+            _synchronize(self.device)
+            self.timings[name] += time.perf_counter() - self._starts[name].pop()
+            self.calls[name] += 1
+        return hook
+
+    def reset(self):
+        self.timings.clear()
+        self.calls.clear()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Per-layer and per-component totals in milliseconds"""
+        layers = []
+        for layer_idx in range(len(self.model.model.layers)):
+            prefix = f"layers.{layer_idx}"
+            norms = self.timings[f"{prefix}.input_norm"] + self.timings[f"{prefix}.post_attention_norm"]
+            layers.append({
+                "attention_ms": self.timings[f"{prefix}.attention"] * 1000,
+                "mlp_ms": self.timings[f"{prefix}.mlp"] * 1000,
+                "norms_ms": norms * 1000,
+            })
+
+        totals = {
+            "attention_ms": sum(layer["attention_ms"] for layer in layers),
+            "mlp_ms": sum(layer["mlp_ms"] for layer in layers),
+            "norms_ms": sum(layer["norms_ms"] for layer in layers) + self.timings["final_norm"] * 1000,
+            "lm_head_ms": self.timings["lm_head"] * 1000,
+        }
+        return {
+            "layers": layers,
+            "final_norm_ms": self.timings["final_norm"] * 1000,
+            "lm_head_ms": self.timings["lm_head"] * 1000,
+            "lm_head_calls": self.calls["lm_head"],
+            "totals": totals,
+        }
+
+    def save_json(self, path: str, **metadata):
+        with open(path, "w") as f:
+            json.dump({**metadata, **self.to_dict()}, f, indent=2)
+
+
+def make_prompt_ids(generator: TransformerGenerator, prompt_length: int, batch_size: int) -> torch.Tensor:
+    """[batch_size, prompt_length] prompt of BOS + repeated news text (no padding needed)"""
+    text_ids = generator.tokenizer.encode(BENCHMARK_TEXT, add_special_tokens=False)
+    repeats = prompt_length // max(1, len(text_ids)) + 1
+    prompt = [generator.tokenizer.bos_token_id] + (text_ids * repeats)[:prompt_length - 1]
+    return torch.tensor([prompt] * batch_size, dtype=torch.long, device=generator.device)
+
+
+def count_generated_tokens(generated: torch.Tensor, input_length: int, eos_token_id: int) -> int:
+    """Tokens actually produced, up to and including each row's first EOS (padding after it excluded)"""
+    total = 0
+    for row in generated[:, input_length:].tolist():
+        total += row.index(eos_token_id) + 1 if eos_token_id in row else len(row)
+    return total
+
+
+@torch.no_grad()
+def benchmark_config(
+    generator: TransformerGenerator,
+    prompt_length: int,
+    max_new_tokens: int,
+    batch_size: int,
+    num_runs: int = 5,
+    num_warmup: int = 1,
+    ignore_eos: bool = True,
+    profiler: Optional[LayerProfiler] = None,
+) -> Dict[str, Any]:
+    """
+    Time greedy generation for one configuration. Prefill is the time to the first generated
+    token; decode covers every following step.
+    """
+    input_ids = make_prompt_ids(generator, prompt_length, batch_size)
+    eos_token_id = generator.tokenizer.eos_token_id
+    # An out-of-vocabulary EOS keeps every run at max_new_tokens
+    stop_token_id = -1 if ignore_eos else eos_token_id
+    prefill_times, decode_times, total_times, decode_token_times = [], [], [], []
+    generated_tokens = []
+
+    for run in range(num_warmup + num_runs):
+        if profiler is not None and run == num_warmup:
+            profiler.reset()
+
+        steps = generator._iter_generate_tokens(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            temperature=1.0,
+            top_k=0,
+            top_p=1.0,
+            do_sample=False,
+            repetition_penalty=1.0,
+            no_repeat_ngram_size=0,
+            pad_token_id=eos_token_id,
+            eos_token_id=stop_token_id,
+        )
+
+        _synchronize(generator.device)
+        start_time = time.perf_counter()
+        generated = next(steps)
+        _synchronize(generator.device)
+        prefill_end = time.perf_counter()
+        num_steps = 1
+        for generated in steps:
+            num_steps += 1
+        _synchronize(generator.device)
+        end_time = time.perf_counter()
+
+        if run < num_warmup:
+            continue
+        prefill_times.append(prefill_end - start_time)
+        decode_times.append(end_time - prefill_end)
+        total_times.append(end_time - start_time)
+        if num_steps > 1:
+            decode_token_times.append((end_time - prefill_end) / (num_steps - 1))
+        generated_tokens.append(count_generated_tokens(generated, prompt_length, stop_token_id))
+
+    total_tokens = sum(generated_tokens)
+    results = {
+        "prompt_length": prompt_length,
+        "max_new_tokens": max_new_tokens,
+        "batch_size": batch_size,
+        "dtype": str(next(generator.model.parameters()).dtype),
+        "num_runs": num_runs,
+        "generated_tokens_per_run": total_tokens / num_runs,
+        "prefill_ms": {k: v * 1000 for k, v in _summarize(prefill_times).items()},
+        "decode_ms": {k: v * 1000 for k, v in _summarize(decode_times).items()},
+        "latency_ms": {k: v * 1000 for k, v in _summarize(total_times).items()},
+        "prefill_tokens_per_second": batch_size * prompt_length * num_runs / sum(prefill_times),
+        "decode_tokens_per_second": (
+            max(0, total_tokens - batch_size * num_runs) / sum(decode_times) if sum(decode_times) > 0 else 0.0
+        ),
+        "tokens_per_second": total_tokens / sum(total_times),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if decode_token_times:
+        results["decode_step_ms"] = {k: v * 1000 for k, v in _summarize(decode_token_times).items()}
+    if generator.device.type == "cuda":
+        results["peak_cuda_memory_mb"] = torch.cuda.max_memory_allocated(generator.device) / 2**20
+    return results
+
+
+def run_benchmark_suite(
+    generator: TransformerGenerator,
+    prompt_lengths: Sequence[int] = (32, 128, 512),
+    new_token_counts: Sequence[int] = (32, 128),
+    batch_sizes: Sequence[int] = (1, 4),
+    dtypes: Sequence[str] = ("float32",),
+    num_runs: int = 5,
+    num_warmup: int = 1,
+    ignore_eos: bool = True,
+    profile_dir: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Benchmark every combination of prompt length, new-token count, batch size and dtype.
+
+    The prefix cache is disabled while benchmarking so every run pays for its full prefill.
+    `peak_rss_mb` is the process-lifetime peak, so it only grows across configurations; on CUDA
+    `peak_cuda_memory_mb` is reset per configuration. With `profile_dir` each configuration also
+    writes a LayerProfiler JSON report there.
+    """
+    saved_cache, saved_dtype = generator.prefix_cache, generator.torch_dtype
+    generator.prefix_cache = None
+    results = []
+
+    try:
+        for dtype_name in dtypes:
+            dtype = getattr(torch, dtype_name)
+            generator.model.to(dtype)
+            generator.torch_dtype = dtype
+
+            for prompt_length, max_new_tokens, batch_size in itertools.product(
+                prompt_lengths, new_token_counts, batch_sizes
+            ):
+                if prompt_length + max_new_tokens > generator.model.config.max_position_embeddings:
+                    logger.info(f"Skipping prompt_length={prompt_length} max_new_tokens={max_new_tokens}: too long")
+                    continue
+                if generator.device.type == "cuda":
+                    torch.cuda.reset_peak_memory_stats(generator.device)
+
+                profiler = LayerProfiler(generator.model) if profile_dir is not None else None
+                kwargs = dict(
+                    prompt_length=prompt_length,
+                    max_new_tokens=max_new_tokens,
+                    batch_size=batch_size,
+                    num_runs=num_runs,
+                    num_warmup=num_warmup,
+                    ignore_eos=ignore_eos,
+                )
+                if profiler is not None:
+                    with profiler:
+                        result = benchmark_config(generator, profiler=profiler, **kwargs)
+                    os.makedirs(profile_dir, exist_ok=True)
+                    profile_path = os.path.join(
+                        profile_dir, f"profile_{dtype_name}_p{prompt_length}_n{max_new_tokens}_b{batch_size}.json"
+                    )
+                    profiler.save_json(
+                        profile_path,
+                        dtype=dtype_name,
+                        prompt_length=prompt_length,
+                        max_new_tokens=max_new_tokens,
+                        batch_size=batch_size,
+                        num_runs=num_runs,
+                    )
+                    result["profile_path"] = profile_path
+                else:
+                    result = benchmark_config(generator, **kwargs)
+
+                logger.info(
+                    f"{dtype_name} prompt={prompt_length} new={max_new_tokens} batch={batch_size}: "
+                    f"prefill p50 {result['prefill_ms']['p50']:.1f}ms, "
+                    f"decode {result['decode_tokens_per_second']:.1f} tok/s, "
+                    f"latency p95 {result['latency_ms']['p95']:.1f}ms"
+                )
+                results.append(result)
+    finally:
+        generator.prefix_cache = saved_cache
+        generator.model.to(saved_dtype)
+        generator.torch_dtype = saved_dtype
+
+    return results
+
+
+def _top_k_filtering(logits: torch.Tensor, top_k: int) -> torch.Tensor:
+    """Reference top-k filtering (the sampler before fusion), kept as the benchmark baseline"""
+    if top_k <= 0:
+        return logits
+    
+    top_k = min(top_k, logits.size(-1))
+    values, _ = torch.topk(logits, top_k, dim=-1)
+    min_values = values[:, -1:].expand_as(logits)
+    return torch.where(logits < min_values, torch.full_like(logits, float('-inf')), logits)
+
+
+def _top_p_filtering(logits: torch.Tensor, top_p: float) -> torch.Tensor:
+    """Reference full-vocab top-p filtering, kept as the benchmark baseline"""
+    if top_p >= 1.0:
+        return logits
+    
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+    cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+    
+    # Keep at least one token
+    sorted_indices_to_remove = cumulative_probs > top_p
+    sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
+    sorted_indices_to_remove[:, 0] = False
+    
+    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+    return logits.masked_fill(indices_to_remove, float('-inf'))
+
+
+@torch.no_grad()
+def benchmark_sampling(
+    generator: TransformerGenerator,
+    batch_size: int = 8,
+    temperature: float = 0.7,
+    top_k: int = 50,
+    top_p: float = 0.9,
+    num_iters: int = 200,
+) -> Dict[str, Any]:
+    """Micro-benchmark the fused sampler against separate top-k and full-vocab top-p filtering"""
+    vocab_size = generator.model.config.vocab_size
+    logits = torch.randn(batch_size, vocab_size, device=generator.device)
+    
+    def unfused():
+        filtered = _top_k_filtering(logits / temperature, top_k)
+        filtered = _top_p_filtering(filtered, top_p)
+        return torch.multinomial(F.softmax(filtered, dim=-1), num_samples=1)
+    
+    def fused():
+        return generator._fused_sample(logits, temperature, top_k, top_p)
+    
+    results: Dict[str, Any] = {}
+    for name, sample in (("unfused", unfused), ("fused", fused)):
+        sample()  # warm-up
+        _synchronize(generator.device)
+        start_time = time.perf_counter()
+        for _ in range(num_iters):
+            sample()
+        _synchronize(generator.device)
+        elapsed = time.perf_counter() - start_time
+        results[name] = {"ms_per_step": elapsed / num_iters * 1000}
+    
+    results["speedup"] = results["unfused"]["ms_per_step"] / results["fused"]["ms_per_step"]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Transformer generation")
+    parser.add_argument('model_path', help='Path to trained model')
+    parser.add_argument('--device', default='auto')
+    parser.add_argument('--prompt-lengths', type=int, nargs='+', default=[32, 128, 512])
+    parser.add_argument('--new-tokens', type=int, nargs='+', default=[32, 128])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--dtypes', nargs='+', default=['float32'], choices=['float32', 'bfloat16', 'float16'])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--respect-eos', action='store_true', help='Stop runs at EOS instead of max_new_tokens')
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON file for the results')
+    parser.add_argument('--profile-dir', default=None, help='Write per-layer profiles here')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    generator = TransformerGenerator(args.model_path, device=args.device, torch_dtype=torch.float32)
+    results = run_benchmark_suite(
+        generator,
+        prompt_lengths=args.prompt_lengths,
+        new_token_counts=args.new_tokens,
+        batch_sizes=args.batch_sizes,
+        dtypes=args.dtypes,
+        num_runs=args.runs,
+        num_warmup=args.warmup,
+        ignore_eos=not args.respect_eos,
+        profile_dir=args.profile_dir,
+    )
+
+    with open(args.output, "w") as f:
+        json.dump({"model_path": args.model_path, "device": str(generator.device), "results": results}, f, indent=2)
+    logger.info(f"Benchmark results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
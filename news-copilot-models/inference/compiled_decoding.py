@@ -0,0 +1,238 @@
+"""
+Compiled Decoding
+torch.compile'd prefill and decode steps with fixed shapes over a preallocated per-slot KV cache
+"""
+
+import time
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+
+from models.transformer_model import TransformerForCausalLM, apply_rotary_pos_emb, repeat_kv, _SDPA_SUPPORTS_GQA
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFILL_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048)
+DEFAULT_MAX_PROMPT_LEN = 512
+DEFAULT_MAX_NEW_TOKENS = 256
+
+
+class CompiledDecoder:
+    """
+    Fixed-shape inference path for torch.compile.
+
+    torch.compile specializes graphs on tensor shapes, while the eager cache paths change shape
+    every step as the KV length grows. Here keys and values live in preallocated
+    [batch_size, num_key_value_heads, max_cache_len, head_dim] buffers with one row ("slot") per
+    sequence:
+
+    - prefill right-pads a prompt up to the next length bucket, so there is one graph per bucket;
+    - decode always steps every slot by one token and attends over the whole buffer under a
+      position mask, so a single graph serves every step.
+
+    Padding positions written by prefill sit after the prompt and are overwritten by the
+    decode steps before any query can see them. Inactive slots are computed and ignored.
+    `lock` is held by whoever is using the slots (a GenerationEngine, or one generate call).
+
+    Each decode step attends over the whole buffer, so its length is what every step costs:
+    max_cache_len is the longest prefill bucket (the one covering `max_prompt_len`) plus
+    `max_new_tokens`, not the model's max_position_embeddings. Only buckets up to that one are
+    compiled and warmed up.
+    """
+
+    def __init__(
+        self,
+        model: TransformerForCausalLM,
+        batch_size: int = 1,
+        max_prompt_len: int = DEFAULT_MAX_PROMPT_LEN,
+        max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS,
+        prefill_buckets: Sequence[int] = DEFAULT_PREFILL_BUCKETS,
+        mode: Optional[str] = None,
+    ):
+        if max_prompt_len < 1 or max_new_tokens < 1:
+            raise ValueError(
+                f"max_prompt_len and max_new_tokens must be positive, got {max_prompt_len} and {max_new_tokens}"
+            )
+        config = model.config
+        parameter = next(model.parameters())
+        self.model = model
+        self.config = config
+        self.batch_size = batch_size
+
+        longest_bucket = min((b for b in prefill_buckets if b >= max_prompt_len), default=max_prompt_len)
+        self.prefill_buckets = sorted({b for b in prefill_buckets if b < longest_bucket} | {longest_bucket})
+        self.max_new_tokens = max_new_tokens
+        self.max_cache_len = longest_bucket + max_new_tokens
+        if self.max_cache_len > config.max_position_embeddings:
+            raise ValueError(
+                f"Compiled cache of {self.max_cache_len} positions (prompt bucket {longest_bucket} + "
+                f"max_new_tokens {max_new_tokens}) exceeds max_position_embeddings {config.max_position_embeddings}"
+            )
+        self.device = parameter.device
+        self.dtype = parameter.dtype
+        self.lock = threading.Lock()
+
+        cache_shape = (batch_size, config.num_key_value_heads, self.max_cache_len, config.head_dim)
+        self.key_cache = [
+            torch.zeros(cache_shape, dtype=self.dtype, device=self.device) for _ in range(config.num_hidden_layers)
+        ]
+        self.value_cache = [
+            torch.zeros(cache_shape, dtype=self.dtype, device=self.device) for _ in range(config.num_hidden_layers)
+        ]
+        self._positions = torch.arange(self.max_cache_len, device=self.device)
+        self._slots = torch.arange(batch_size, device=self.device)
+
+        # Grow the shared rotary table to max_cache_len up front, so the graphs only index into it
+        model.model.rotary_emb(self.key_cache[0], self._positions[None], seq_len=self.max_cache_len)
+
+        self._prefill_fn = torch.compile(self._prefill_forward, mode=mode, dynamic=False)
+        self._decode_fn = torch.compile(self._decode_forward, mode=mode, dynamic=False)
+
+    def _project_qkv(self, attn, hidden_states, cos, sin):
+        bsz, q_len, _ = hidden_states.shape
+        query_states = attn.q_proj(hidden_states).view(bsz, q_len, attn.num_heads, attn.head_dim).transpose(1, 2)
+        key_states = attn.k_proj(hidden_states).view(bsz, q_len, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+        value_states = attn.v_proj(hidden_states).view(bsz, q_len, attn.num_key_value_heads, attn.head_dim).transpose(1, 2)
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+        return query_states, key_states, value_states
+
+    def _attend(self, attn, query_states, key_states, value_states, attn_mask):
+        bsz, _, q_len, _ = query_states.shape
+        kwargs = {}
+        if _SDPA_SUPPORTS_GQA:
+            kwargs["enable_gqa"] = attn.num_key_value_groups > 1
+        else:
+            key_states = repeat_kv(key_states, attn.num_key_value_groups)
+            value_states = repeat_kv(value_states, attn.num_key_value_groups)
+
+        attn_output = F.scaled_dot_product_attention(
+            query_states, key_states, value_states, attn_mask=attn_mask, is_causal=attn_mask is None, **kwargs
+        )
+        return attn.o_proj(attn_output.transpose(1, 2).reshape(bsz, q_len, attn.hidden_size))
+
+    def _position_mask(self, query_positions, key_positions):
+        """Additive mask [len(query_positions), len(key_positions)], banded with config.sliding_window"""
+        distance = query_positions[:, None] - key_positions[None, :]
+        masked = distance < 0
+        if self.config.sliding_window is not None:
+            masked = masked | (distance >= self.config.sliding_window)
+        return torch.zeros(distance.shape, dtype=self.dtype, device=self.device).masked_fill(
+            masked, torch.finfo(self.dtype).min
+        )
+
+    def _prefill_forward(self, input_ids, slot, last_index):
+        """input_ids [1, bucket]; writes the slot's cache and returns logits [1, vocab] at last_index"""
+        decoder = self.model.model
+        positions = self._positions[:input_ids.shape[1]]
+        cos = decoder.rotary_emb.cos_cached[positions][None]
+        sin = decoder.rotary_emb.sin_cached[positions][None]
+        # The prompt starts at position 0, so it only attends to itself
+        attn_mask = None
+        if self.config.sliding_window is not None:
+            attn_mask = self._position_mask(positions, positions)[None, None]
+
+        hidden_states = decoder.embed_tokens(input_ids)
+        # As in TransformerModel, the residual is carried un-added into the next norm
+        residual = None
+        for layer_idx, layer in enumerate(decoder.layers):
+            if residual is None:
+                residual = hidden_states
+                normed = layer.input_layernorm(hidden_states)
+            else:
+                normed, residual = layer.input_layernorm(hidden_states, residual)
+            query_states, key_states, value_states = self._project_qkv(layer.self_attn, normed, cos, sin)
+            # [slot, :, positions] puts the broadcast index dims first: [seq_len, heads, head_dim]
+            self.key_cache[layer_idx][slot, :, positions] = key_states[0].transpose(0, 1)
+            self.value_cache[layer_idx][slot, :, positions] = value_states[0].transpose(0, 1)
+            attn_output = self._attend(layer.self_attn, query_states, key_states, value_states, attn_mask)
+            hidden_states, residual = layer.post_attention_layernorm(attn_output, residual)
+            hidden_states = layer.mlp(hidden_states)
+
+        hidden_states, _ = decoder.norm(
+            hidden_states.index_select(1, last_index), residual.index_select(1, last_index)
+        )
+        return self.model.lm_head(hidden_states)[:, -1].float()
+
+    def _decode_forward(self, input_ids, positions):
+        """input_ids [batch_size, 1], positions [batch_size]; returns logits [batch_size, vocab]"""
+        decoder = self.model.model
+        cos = decoder.rotary_emb.cos_cached[positions][:, None]
+        sin = decoder.rotary_emb.sin_cached[positions][:, None]
+        attn_mask = self._position_mask(positions, self._positions)[:, None, None, :]
+
+        hidden_states = decoder.embed_tokens(input_ids)
+        # As in TransformerModel, the residual is carried un-added into the next norm
+        residual = None
+        for layer_idx, layer in enumerate(decoder.layers):
+            if residual is None:
+                residual = hidden_states
+                normed = layer.input_layernorm(hidden_states)
+            else:
+                normed, residual = layer.input_layernorm(hidden_states, residual)
+            query_states, key_states, value_states = self._project_qkv(layer.self_attn, normed, cos, sin)
+            self.key_cache[layer_idx][self._slots, :, positions] = key_states[:, :, 0]
+            self.value_cache[layer_idx][self._slots, :, positions] = value_states[:, :, 0]
+            attn_output = self._attend(
+                layer.self_attn, query_states, self.key_cache[layer_idx], self.value_cache[layer_idx], attn_mask
+            )
+            hidden_states, residual = layer.post_attention_layernorm(attn_output, residual)
+            hidden_states = layer.mlp(hidden_states)
+
+        hidden_states, _ = decoder.norm(hidden_states, residual)
+        return self.model.lm_head(hidden_states)[:, -1].float()
+
+    def fits(self, prompt_length: int, max_new_tokens: int) -> bool:
+        return prompt_length <= self.prefill_buckets[-1] and prompt_length + max_new_tokens <= self.max_cache_len
+
+    def bucket_for(self, length: int) -> int:
+        for bucket in self.prefill_buckets:
+            if length <= bucket:
+                return bucket
+        raise ValueError(f"Prompt of {length} tokens exceeds the longest compiled bucket {self.prefill_buckets[-1]}")
+
+    @torch.no_grad()
+    def prefill(self, slot: int, token_ids: Sequence[int]) -> torch.Tensor:
+        """Run a prompt into `slot` and return its last-position logits [1, vocab]"""
+        length = len(token_ids)
+        input_ids = torch.zeros((1, self.bucket_for(length)), dtype=torch.long, device=self.device)
+        input_ids[0, :length] = torch.tensor(token_ids, dtype=torch.long, device=self.device)
+        return self._prefill_fn(
+            input_ids,
+            torch.tensor([slot], device=self.device),
+            torch.tensor([length - 1], device=self.device),
+        )
+
+    @torch.no_grad()
+    def decode(self, slots: List[int], input_ids: torch.Tensor, positions: List[int]) -> torch.Tensor:
+        """
+        Feed one token ([len(slots), 1]) at `positions` into each of `slots`; returns their
+        logits [len(slots), vocab]
+        """
+        index = torch.tensor(slots, dtype=torch.long, device=self.device)
+        all_input_ids = torch.zeros((self.batch_size, 1), dtype=torch.long, device=self.device)
+        all_positions = torch.zeros(self.batch_size, dtype=torch.long, device=self.device)
+        all_input_ids[index] = input_ids
+        all_positions[index] = torch.tensor(positions, dtype=torch.long, device=self.device)
+        return self._decode_fn(all_input_ids, all_positions).index_select(0, index)
+
+    def warmup(self):
+        """Compile every prefill bucket and the decode step now instead of on the first requests"""
+        start_time = time.time()
+        for bucket in self.prefill_buckets:
+            self.prefill(0, [0] * bucket)
+        self.decode([0], torch.zeros((1, 1), dtype=torch.long, device=self.device), [0])
+        logger.info(
+            f"Compiled {len(self.prefill_buckets)} prefill buckets and the decode step "
+            f"in {time.time() - start_time:.1f}s"
+        )
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "batch_size": self.batch_size,
+            "max_cache_len": self.max_cache_len,
+            "max_new_tokens": self.max_new_tokens,
+            "prefill_buckets": self.prefill_buckets,
+        }
@@ -0,0 +1,444 @@
+"""
+Continuous Batching Generation Engine
+Serves concurrent completion requests from a single background decode loop
+"""
+
+import time
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+
+from inference.model_inference import NoRepeatNGramIndex, TransformerGenerator
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class GenerationRequest:
+    """A queued completion request and the future its result is delivered on"""
+    prompt: str
+    max_new_tokens: int = 100
+    temperature: float = 0.7
+    top_k: int = 50
+    top_p: float = 0.9
+    do_sample: bool = True
+    repetition_penalty: float = 1.1
+    no_repeat_ngram_size: int = 3
+    stop_strings: Optional[List[str]] = None
+    return_full_text: bool = False
+    future: Future = field(default_factory=Future)
+    # Streaming: every sampled token ID is put here, then None once the request is done
+    token_queue: Optional["queue.Queue[Optional[int]]"] = None
+    cancelled: bool = False
+    # time.monotonic() after which the request is retired with a TimeoutError
+    deadline: Optional[float] = None
+
+    @property
+    def expired(self) -> bool:
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+
+@dataclass
+class _ActiveSequence:
+    """Decoding state of one request inside the running batch"""
+    request: GenerationRequest
+    token_ids: torch.Tensor  # [1, seq_len]; the last token is not in the KV cache yet
+    input_length: int
+    ngram_index: Optional[NoRepeatNGramIndex] = None
+    slot: Optional[int] = None  # row of the CompiledDecoder cache, when the engine runs compiled
+
+    @property
+    def num_generated(self) -> int:
+        return self.token_ids.shape[1] - self.input_length
+
+
+def _left_pad_cache(
+    past_key_values: Tuple[Tuple[torch.Tensor, torch.Tensor], ...],
+    attention_mask: torch.Tensor,
+    pad_length: int,
+) -> Tuple[Tuple[Tuple[torch.Tensor, torch.Tensor], ...], torch.Tensor]:
+    """Left-pad every layer's K/V along the sequence axis and mask the new positions out"""
+    past_key_values = tuple(
+        (F.pad(key, (0, 0, pad_length, 0)), F.pad(value, (0, 0, pad_length, 0)))
+        for key, value in past_key_values
+    )
+    return past_key_values, F.pad(attention_mask, (pad_length, 0))
+
+
+class GenerationEngine:
+    """
+    Continuous-batching front end for a TransformerGenerator.
+
+    `submit` queues a request and returns a Future; one background thread owns the model. Each
+    admitted prompt is prefilled on its own and merged into the running batch, whose KV cache is
+    left-padded to a common length with a per-row padding mask and per-row position ids. All
+    active rows then take one decode step together, finished rows are retired and their futures
+    resolved, and waiting requests are admitted between steps.
+
+    If the generator was loaded with `compile_model`, the engine takes over its CompiledDecoder:
+    each request gets a slot of the preallocated cache and every decode step is the same
+    fixed-shape graph, so the batch size is capped at the decoder's slot count.
+    """
+
+    def __init__(self, generator: TransformerGenerator, max_batch_size: int = 8, max_queue_size: int = 0):
+        self.generator = generator
+        self.model = generator.model
+        self.device = generator.device
+        self.max_batch_size = max_batch_size
+        self.eos_token_id = generator.tokenizer.eos_token_id
+
+        self._queue: "queue.Queue[Optional[GenerationRequest]]" = queue.Queue(maxsize=max_queue_size)
+        self._active: List[_ActiveSequence] = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self._running = False
+        # Held while checking _running and queueing, so stop() cannot slip in between
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._compiled = None
+        self._free_slots: List[int] = []
+
+    def start(self) -> "GenerationEngine":
+        """Start the background decode loop"""
+        if not self._running:
+            compiled = self.generator.compiled_decoder
+            if compiled is not None and compiled.lock.acquire(blocking=False):
+                self._compiled = compiled
+                self._free_slots = list(range(compiled.batch_size))
+                self.max_batch_size = min(self.max_batch_size, compiled.batch_size)
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name="generation-engine", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the decode loop; pending and active requests fail with RuntimeError"""
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._queue.put(None)  # wake the loop if it is waiting for work
+        self._thread.join(timeout)
+        if self._compiled is not None:
+            self._compiled.lock.release()
+            self._compiled = None
+
+    def enqueue(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> GenerationRequest:
+        """
+        Queue a completion request. After `timeout` seconds it is retired and its future fails
+        with TimeoutError; setting `cancelled` on the returned request retires it early.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        request = GenerationRequest(prompt=prompt, deadline=deadline, **kwargs)
+        self._put(request)
+        return request
+
+    def _put(self, request: GenerationRequest):
+        with self._lock:
+            if not self._running:
+                raise RuntimeError("GenerationEngine is not running. Call start() first.")
+            self._queue.put(request)
+
+    def submit(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> Future:
+        """Queue a completion request; the returned Future resolves to the generated text"""
+        return self.enqueue(prompt, timeout=timeout, **kwargs).future
+
+    def generate(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> str:
+        """Submit a request and block until its text is ready (at most `timeout` seconds)"""
+        request = self.enqueue(prompt, timeout=timeout, **kwargs)
+        try:
+            return request.future.result(timeout=timeout)
+        finally:
+            # Nobody is waiting any more; stop decoding it if it is still running
+            request.cancelled = True
+
+    def stream(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> Iterator[str]:
+        """
+        Submit a request and yield its text as tokens are decoded. `timeout` bounds the wait for
+        each token. Closing the iterator early retires the request at the next step.
+        """
+        token_queue: "queue.Queue[Optional[int]]" = queue.Queue()
+        request = GenerationRequest(prompt=prompt, token_queue=token_queue, **kwargs)
+        self._put(request)
+
+        def token_ids() -> Iterator[int]:
+            while True:
+                try:
+                    token_id = token_queue.get(timeout=timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No token generated within {timeout}s")
+                if token_id is None:
+                    request.future.result()  # re-raise a failure of the request
+                    return
+                yield token_id
+
+        try:
+            yield from self.generator._stream_text(token_ids(), request.stop_strings)
+        finally:
+            request.cancelled = True
+
+    @property
+    def num_active(self) -> int:
+        """Number of sequences in the running batch"""
+        return len(self._active)
+
+    def _run(self):
+        while self._running:
+            try:
+                self._admit_requests()
+                if self._active:
+                    self._decode_step()
+            except Exception as e:
+                logger.error(f"Generation engine step failed: {e}")
+                self._fail_active(e)
+
+        # Shutting down: fail whatever is left
+        error = RuntimeError("GenerationEngine stopped")
+        self._fail_active(error)
+        while True:
+            try:
+                request = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is not None and request.future.set_running_or_notify_cancel():
+                self._fail_request(request, error)
+
+    def _admit_requests(self):
+        """Move queued requests into the batch while there are free slots"""
+        while self._running and len(self._active) < self.max_batch_size:
+            try:
+                # Only block when idle so a running batch never waits on an empty queue
+                request = self._queue.get(block=not self._active)
+            except queue.Empty:
+                return
+
+            if request is None:
+                return
+            if not request.future.set_running_or_notify_cancel():
+                continue
+            if request.cancelled or request.expired:
+                # Abandoned while queued; do not spend a prefill on it
+                self._fail_request(request, TimeoutError("Request expired before it was scheduled"))
+                continue
+
+            try:
+                self._prefill(request)
+            except Exception as e:
+                logger.error(f"Prefill failed: {e}")
+                self._fail_request(request, e)
+
+        self._retire_finished()
+
+    @torch.no_grad()
+    def _prefill(self, request: GenerationRequest):
+        """Run a new prompt, sample its first token and merge it into the batch"""
+        prompt_ids = torch.tensor([self.generator._encode_prompt(request.prompt)], device=self.device)
+        slot = None
+        if self._compiled is not None:
+            if not self._compiled.fits(prompt_ids.shape[1], request.max_new_tokens):
+                raise ValueError(
+                    f"Prompt of {prompt_ids.shape[1]} tokens plus max_new_tokens={request.max_new_tokens} does not "
+                    f"fit the compiled cache (longest prompt bucket {self._compiled.prefill_buckets[-1]}, "
+                    f"max_cache_len {self._compiled.max_cache_len})"
+                )
+            slot = self._free_slots.pop()
+            try:
+                logits = self._compiled.prefill(slot, prompt_ids[0].tolist())
+                self._start_sequence(request, prompt_ids, logits, slot=slot)
+            except Exception:
+                # The slot only belongs to the request once it is in the batch
+                self._free_slots.append(slot)
+                raise
+        else:
+            logits, past_key_values = self.generator._prefill(prompt_ids)
+            self._start_sequence(request, prompt_ids, logits, past_key_values=past_key_values)
+
+    def _start_sequence(self, request: GenerationRequest, prompt_ids, logits, slot=None, past_key_values=None):
+        """Sample the first token of a prefilled prompt and add it to the batch"""
+        ngram_index = (
+            NoRepeatNGramIndex(request.no_repeat_ngram_size, 1) if request.no_repeat_ngram_size > 0 else None
+        )
+        sequence = _ActiveSequence(
+            request=request,
+            token_ids=prompt_ids,
+            input_length=prompt_ids.shape[1],
+            ngram_index=ngram_index,
+            slot=slot,
+        )
+        next_token = self._sample([sequence], logits)
+        sequence.token_ids = torch.cat([prompt_ids, next_token], dim=1)
+        self._emit(sequence)
+        if slot is not None:
+            self._active.append(sequence)
+        else:
+            self._merge(sequence, past_key_values, prompt_ids.shape[1])
+
+    def _merge(self, sequence: _ActiveSequence, past_key_values, cache_length: int):
+        """Append a prefilled row, left-padding whichever side has the shorter cache"""
+        attention_mask = torch.ones((1, cache_length), dtype=torch.long, device=self.device)
+
+        if not self._active:
+            self._past_key_values = past_key_values
+            self._attention_mask = attention_mask
+        else:
+            batch_length = self._attention_mask.shape[1]
+            if cache_length < batch_length:
+                past_key_values, attention_mask = _left_pad_cache(
+                    past_key_values, attention_mask, batch_length - cache_length
+                )
+            elif cache_length > batch_length:
+                self._past_key_values, self._attention_mask = _left_pad_cache(
+                    self._past_key_values, self._attention_mask, cache_length - batch_length
+                )
+
+            self._past_key_values = tuple(
+                (torch.cat([key, new_key], dim=0), torch.cat([value, new_value], dim=0))
+                for (key, value), (new_key, new_value) in zip(self._past_key_values, past_key_values)
+            )
+            self._attention_mask = torch.cat([self._attention_mask, attention_mask], dim=0)
+
+        self._active.append(sequence)
+
+    @torch.no_grad()
+    def _decode_step(self):
+        """Feed every row's pending token through the model in one batched forward pass"""
+        batch_size = len(self._active)
+        input_ids = torch.cat([seq.token_ids[:, -1:] for seq in self._active], dim=0)
+
+        if self._compiled is not None:
+            logits = self._compiled.decode(
+                [seq.slot for seq in self._active],
+                input_ids,
+                [seq.token_ids.shape[1] - 1 for seq in self._active],
+            )
+        else:
+            position_ids = torch.tensor(
+                [[seq.token_ids.shape[1] - 1] for seq in self._active], dtype=torch.long, device=self.device
+            )
+            attention_mask = torch.cat(
+                [self._attention_mask, self._attention_mask.new_ones((batch_size, 1))], dim=1
+            )
+
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._past_key_values,
+                use_cache=True,
+            )
+            self._past_key_values = outputs["past_key_values"]
+            self._attention_mask = attention_mask
+            logits = outputs["logits"][:, -1, :]
+
+        next_tokens = self._sample(self._active, logits)
+        for row, seq in enumerate(self._active):
+            seq.token_ids = torch.cat([seq.token_ids, next_tokens[row:row + 1]], dim=1)
+            self._emit(seq)
+
+        self._retire_finished()
+
+    def _sample(self, sequences: List[_ActiveSequence], logits: torch.Tensor) -> torch.Tensor:
+        """Apply each row's penalties, then sample all rows at once with per-row parameters"""
+        logits = torch.cat([
+            self.generator._process_logits(
+                logits[row:row + 1],
+                seq.token_ids,
+                seq.request.repetition_penalty,
+                seq.request.no_repeat_ngram_size,
+                seq.ngram_index,
+            )
+            for row, seq in enumerate(sequences)
+        ], dim=0)
+
+        # Greedy rows are top-1 sampling
+        requests = [seq.request for seq in sequences]
+        temperature = torch.tensor([r.temperature if r.do_sample else 1.0 for r in requests], device=self.device)
+        top_k = torch.tensor([r.top_k if r.do_sample else 1 for r in requests], device=self.device)
+        top_p = torch.tensor([r.top_p if r.do_sample else 1.0 for r in requests], device=self.device)
+        return self.generator._fused_sample(logits, temperature, top_k, top_p)
+
+    def _retire_finished(self):
+        """Resolve finished rows and compact the batch to the remaining ones"""
+        keep = []
+        for row, seq in enumerate(self._active):
+            if seq.request.expired:
+                self._fail_request(
+                    seq.request, TimeoutError(f"Request exceeded its deadline after {seq.num_generated} tokens")
+                )
+            elif (
+                seq.request.cancelled
+                or seq.token_ids[0, -1].item() == self.eos_token_id
+                or seq.num_generated >= seq.request.max_new_tokens
+            ):
+                self._resolve(seq)
+            else:
+                keep.append(row)
+                continue
+            if seq.slot is not None:
+                self._free_slots.append(seq.slot)
+
+        if len(keep) == len(self._active):
+            return
+        if not keep:
+            self._reset()
+            return
+
+        index = torch.tensor(keep, dtype=torch.long, device=self.device)
+        self._active = [self._active[row] for row in keep]
+        if self._compiled is not None:
+            # Slots are addressed by index, so nothing needs compacting
+            return
+        self._past_key_values = tuple(
+            (key.index_select(0, index), value.index_select(0, index)) for key, value in self._past_key_values
+        )
+        self._attention_mask = self._attention_mask.index_select(0, index)
+
+        # Drop leading columns that are padding for every remaining row
+        first_valid = int(self._attention_mask.bool().any(dim=0).nonzero()[0])
+        if first_valid > 0:
+            self._past_key_values = tuple(
+                (key[:, :, first_valid:], value[:, :, first_valid:]) for key, value in self._past_key_values
+            )
+            self._attention_mask = self._attention_mask[:, first_valid:]
+
+    def _emit(self, seq: _ActiveSequence):
+        """Hand the newest token to a streaming consumer"""
+        if seq.request.token_queue is not None:
+            seq.request.token_queue.put(seq.token_ids[0, -1].item())
+
+    def _resolve(self, seq: _ActiveSequence):
+        request = seq.request
+        try:
+            text = self.generator._decode_output(
+                seq.token_ids[0], seq.input_length, request.return_full_text, request.stop_strings
+            )
+            request.future.set_result(text)
+        except Exception as e:
+            request.future.set_exception(e)
+        finally:
+            if request.token_queue is not None:
+                request.token_queue.put(None)
+
+    def _fail_request(self, request: GenerationRequest, error: Exception):
+        if not request.future.done():
+            request.future.set_exception(error)
+        if request.token_queue is not None:
+            request.token_queue.put(None)
+
+    def _fail_active(self, error: Exception):
+        for seq in self._active:
+            self._fail_request(seq.request, error)
+        self._reset()
+
+    def _reset(self):
+        self._active = []
+        self._past_key_values = None
+        self._attention_mask = None
+        if self._compiled is not None:
+            self._free_slots = list(range(self._compiled.batch_size))
@@ -0,0 +1,200 @@
+"""
+Thin client for the local model server
+
+Only depends on the standard library, so web workers can talk to the model process without
+importing torch or loading any weights themselves.
+"""
+
+import os
+import stat
+import secrets
+import tempfile
+import threading
+import logging
+from multiprocessing.connection import Client
+from typing import Any, Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+SOCKET_NAME = "model.sock"
+AUTHKEY_NAME = "authkey"
+
+
+def _check_private(path: str, st: os.stat_result):
+    """Refuse paths other local users could have planted or can read"""
+    if st.st_uid != os.getuid():
+        raise PermissionError(f"{path} is owned by uid {st.st_uid}, not by this user")
+    if st.st_mode & 0o077:
+        raise PermissionError(f"{path} is accessible to other users (mode {stat.S_IMODE(st.st_mode):o})")
+
+
+def get_runtime_dir() -> str:
+    """
+    Private (0700) directory holding the server socket and authkey. Defaults to
+    $XDG_RUNTIME_DIR/news-copilot, or a per-user directory under the system temp dir.
+    """
+    runtime_dir = os.environ.get("GENERATION_SERVER_DIR")
+    if not runtime_dir:
+        base = os.environ.get("XDG_RUNTIME_DIR")
+        runtime_dir = (
+            os.path.join(base, "news-copilot") if base
+            else os.path.join(tempfile.gettempdir(), f"news-copilot-{os.getuid()}")
+        )
+
+    try:
+        os.mkdir(runtime_dir, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(runtime_dir)
+    if not stat.S_ISDIR(st.st_mode):
+        raise PermissionError(f"{runtime_dir} is not a directory")
+    _check_private(runtime_dir, st)
+    return runtime_dir
+
+
+def get_server_address() -> str:
+    return os.environ.get("GENERATION_SERVER_SOCKET") or os.path.join(get_runtime_dir(), SOCKET_NAME)
+
+
+def get_authkey_path() -> str:
+    return os.environ.get("GENERATION_SERVER_AUTHKEY_FILE") or os.path.join(get_runtime_dir(), AUTHKEY_NAME)
+
+
+def get_server_authkey(create: bool = False) -> bytes:
+    """
+    The shared secret from $GENERATION_SERVER_AUTHKEY, else from the 0600 authkey file. With
+    `create` (the server), a random key is written to that file when neither exists.
+    """
+    authkey = os.environ.get("GENERATION_SERVER_AUTHKEY")
+    if authkey:
+        return authkey.encode()
+
+    path = get_authkey_path()
+    if create:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600)
+        except FileExistsError:
+            pass
+        else:
+            with os.fdopen(fd, "wb") as f:
+                f.write(secrets.token_hex(32).encode())
+
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NOFOLLOW)
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            f"No model server authkey: set GENERATION_SERVER_AUTHKEY or start the server to create {path}"
+        ) from None
+    with os.fdopen(fd, "rb") as f:
+        _check_private(path, os.fstat(f.fileno()))
+        authkey = f.read().strip()
+    if not authkey:
+        raise PermissionError(f"Model server authkey file {path} is empty")
+    return authkey
+
+
+class ModelClient:
+    """
+    RPC client for `ModelServer`.
+
+    Messages are pickled, so the connection is only as trustworthy as the authkey: it is read
+    from $GENERATION_SERVER_AUTHKEY or the server's private authkey file on first connect.
+
+    Each thread keeps one connection open and reuses it across calls. A call that hits a dropped
+    pooled connection reconnects once. A call that times out closes its connection, because the
+    late reply would otherwise be read as the answer to the next call.
+    """
+
+    def __init__(self, address: Optional[str] = None, authkey: Optional[bytes] = None, timeout: float = 30.0):
+        self.address = address or get_server_address()
+        self.authkey = authkey
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.authkey is None:
+                self.authkey = get_server_authkey()
+            conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Close this thread's connection"""
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _request(self, method: str, kwargs: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        """Send a request and return the first reply message"""
+        for attempt in range(2):
+            reused = getattr(self._local, "conn", None) is not None
+            try:
+                conn = self._connection()
+                # The server retires the request once `timeout` has passed, since nobody will read it
+                conn.send({"method": method, "kwargs": kwargs, "timeout": timeout})
+                return self._receive(conn, method, timeout)
+            except (EOFError, ConnectionError, BrokenPipeError) as e:
+                self.close()
+                # A pooled connection may have been dropped by a server restart; retry on a fresh one
+                if reused and attempt == 0:
+                    continue
+                raise ConnectionError(f"Model server at {self.address} is unavailable: {e}") from e
+            except (FileNotFoundError, PermissionError) as e:
+                self.close()
+                raise ConnectionError(f"Model server at {self.address} is unavailable: {e}") from e
+
+    def _receive(self, conn, method: str, timeout: float) -> Dict[str, Any]:
+        if not conn.poll(timeout):
+            self.close()
+            raise TimeoutError(f"Model server did not answer '{method}' within {timeout}s")
+        response = conn.recv()
+        if not response["ok"]:
+            raise RuntimeError(f"Model server error: {response['error']}")
+        return response
+
+    def call(self, method: str, timeout: Optional[float] = None, **kwargs) -> Any:
+        """Invoke `method` on the server and return its result"""
+        timeout = self.timeout if timeout is None else timeout
+        return self._request(method, kwargs, timeout)["result"]
+
+    def stream(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> Iterator[str]:
+        """
+        Generate a completion and yield its text chunks as the server decodes them. `timeout`
+        bounds the wait for each chunk. Closing the iterator early drops the connection, which
+        makes the server retire the request.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        response = self._request("generate_stream", dict(kwargs, prompt=prompt), timeout)
+        done = False
+        try:
+            while not response.get("done"):
+                yield response["chunk"]
+                try:
+                    response = self._receive(self._local.conn, "generate_stream", timeout)
+                except (EOFError, OSError) as e:
+                    raise ConnectionError(f"Model server at {self.address} closed the stream: {e}") from e
+            done = True
+        finally:
+            if not done:
+                # Unread chunks would be taken as replies to the next call on this connection
+                self.close()
+
+    def generate(self, prompt: str, timeout: Optional[float] = None, **kwargs) -> str:
+        """Generate a completion; kwargs are forwarded to `GenerationEngine.submit`"""
+        return self.call("generate", timeout=timeout, prompt=prompt, **kwargs)
+
+    def get_model_info(self) -> Dict[str, Any]:
+        return self.call("info")
+
+    def ping(self, timeout: float = 1.0) -> bool:
+        """Whether the server is reachable"""
+        try:
+            return self.call("ping", timeout=timeout)
+        except (ConnectionError, TimeoutError, OSError):
+            return False
@@ -4,18 +4,77 @@ Transformer Model Inference and Generation Utilities
 
 import os
 import json
+import functools
 import torch
 import torch.nn.functional as F
-from typing import List, Optional, Dict, Any, Union, Tuple
+from typing import List, Optional, Dict, Any, Union, Tuple, Iterable, Iterator
 import time
 import logging
+import threading
+from collections import defaultdict
 
-from models.transformer_model import TransformerConfig, TransformerForCausalLM
+from models.transformer_model import TransformerConfig, TransformerForCausalLM, StaticKVCache, SlidingWindowKVCache
 from models.custom_tokenizer import CustomTokenizer
+from models.quantization import quantize_dynamic_int8, load_quantized_model, is_quantized_checkpoint
+from inference.prefix_cache import PrefixCache
+from inference.compiled_decoding import CompiledDecoder, DEFAULT_MAX_NEW_TOKENS, DEFAULT_MAX_PROMPT_LEN
 
 logger = logging.getLogger(__name__)
 
 
+class NoRepeatNGramIndex:
+    """
+    Per-sequence map from each (n-1)-token prefix to the tokens that followed it.
+
+    `update` only indexes the n-grams ending at tokens added since the previous call, so a decode
+    step costs O(1) amortized instead of rescanning the whole history.
+    """
+    
+    def __init__(self, ngram_size: int, batch_size: int):
+        self.ngram_size = ngram_size
+        self.index: List[Dict[Tuple[int, ...], set]] = [defaultdict(set) for _ in range(batch_size)]
+        self.num_indexed = 0
+        # Per row: (end position, prefix, token) of every entry `update` added, for `truncate`
+        self.journal: List[List[Tuple[int, Tuple[int, ...], int]]] = [[] for _ in range(batch_size)]
+    
+    def update(self, input_ids: torch.Tensor):
+        """Index n-grams ending at positions not seen by a previous call"""
+        seq_len = input_ids.shape[1]
+        n = self.ngram_size
+        if seq_len <= self.num_indexed:
+            return
+        
+        start = max(0, self.num_indexed - n + 1)
+        for row, tokens in enumerate(input_ids[:, start:].tolist()):
+            row_index = self.index[row]
+            row_journal = self.journal[row]
+            for i in range(len(tokens) - n + 1):
+                prefix = tuple(tokens[i:i + n - 1])
+                token = tokens[i + n - 1]
+                if token not in row_index[prefix]:
+                    row_index[prefix].add(token)
+                    row_journal.append((start + i + n - 1, prefix, token))
+        
+        self.num_indexed = seq_len
+    
+    def truncate(self, seq_len: int):
+        """Forget n-grams ending at or after `seq_len`, e.g. after rejected speculative tokens"""
+        for row_index, row_journal in zip(self.index, self.journal):
+            while row_journal and row_journal[-1][0] >= seq_len:
+                _, prefix, token = row_journal.pop()
+                row_index[prefix].discard(token)
+        self.num_indexed = min(self.num_indexed, seq_len)
+    
+    def banned_tokens(self, input_ids: torch.Tensor) -> List[List[int]]:
+        """Tokens that would repeat an n-gram, given each row's last n-1 tokens"""
+        n = self.ngram_size
+        if input_ids.shape[1] < n - 1:
+            return [[] for _ in self.index]
+        
+        prefixes = input_ids[:, input_ids.shape[1] - (n - 1):].tolist()
+        return [list(self.index[row].get(tuple(prefix), ())) for row, prefix in enumerate(prefixes)]
+
+
 class TransformerGenerator:
     """High-level interface for text generation with Transformer model"""
     
@@ -24,12 +83,35 @@ class TransformerGenerator:
         model_path: str,
         tokenizer_path: Optional[str] = None,
         device: str = "auto",
-        torch_dtype: torch.dtype = torch.bfloat16,
+        torch_dtype: Optional[Union[torch.dtype, str]] = "auto",
         load_in_8bit: bool = False,
         load_in_4bit: bool = False,
+        attn_implementation: Optional[str] = None,
+        prefix_cache_max_bytes: int = 0,
+        draft_model_path: Optional[str] = None,
+        num_speculative_tokens: int = 4,
+        compile_model: bool = False,
+        compile_batch_size: int = 1,
+        compile_max_prompt_len: int = DEFAULT_MAX_PROMPT_LEN,
+        compile_max_new_tokens: int = DEFAULT_MAX_NEW_TOKENS,
+        compile_warmup: bool = True,
     ):
+        if load_in_8bit and device == "auto":
+            device = "cpu"
         self.device = self._get_device(device)
+        if torch_dtype == "auto":
+            # On CPU serve in the checkpoint's stored dtype, so the mmap'd weights are shared by every
+            # process instead of being cast into private copies; save bf16 checkpoints to serve bf16
+            torch_dtype = None if self.device.type == "cpu" else torch.bfloat16
         self.torch_dtype = torch_dtype
+        self.attn_implementation = attn_implementation
+        self.load_in_8bit = load_in_8bit
+        
+        if load_in_8bit:
+            # int8 dynamic quantization runs on CPU with fp32 activations
+            if self.device.type != "cpu":
+                raise ValueError(f"load_in_8bit requires device='cpu', got {self.device}")
+            self.torch_dtype = torch.float32
         
         # Load tokenizer
         if tokenizer_path is None:
@@ -40,9 +122,46 @@ class TransformerGenerator:
         
         # Load model
         logger.info(f"Loading model from {model_path}")
+        load_start = time.time()
         self.model = self._load_model(model_path)
+        if self.torch_dtype is None:
+            self.torch_dtype = next(self.model.parameters()).dtype
+        
+        logger.info(f"Model loaded successfully on {self.device} in {time.time() - load_start:.2f}s")
+        
+        # K/V of recent prompts, so a prompt that extends an earlier one only prefills the new suffix
+        self.prefix_cache = PrefixCache(prefix_cache_max_bytes) if prefix_cache_max_bytes > 0 else None
         
-        logger.info(f"Model loaded successfully on {self.device}")
+        # Optional small model (e.g. the "tiny" config trained with the same tokenizer) for speculative decoding
+        self.draft_model = None
+        self.num_speculative_tokens = num_speculative_tokens
+        # Totals over every speculative call; generate() may run on several threads at once
+        self.speculative_stats = {"target_forwards": 0, "proposed_tokens": 0, "accepted_tokens": 0}
+        self._speculative_stats_lock = threading.Lock()
+        if draft_model_path is not None:
+            if num_speculative_tokens < 1:
+                raise ValueError(f"num_speculative_tokens must be positive, got {num_speculative_tokens}")
+            logger.info(f"Loading draft model from {draft_model_path}")
+            self.draft_model = self._load_model(draft_model_path)
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(
+                    f"Draft model vocab_size {self.draft_model.config.vocab_size} does not match "
+                    f"target vocab_size {self.model.config.vocab_size}"
+                )
+        
+        # Fixed-shape torch.compile'd prefill/decode; warming up here keeps compile time off the first request
+        self.compiled_decoder = None
+        if compile_model:
+            if load_in_8bit:
+                raise ValueError("compile_model is not supported together with load_in_8bit")
+            self.compiled_decoder = CompiledDecoder(
+                self.model,
+                batch_size=compile_batch_size,
+                max_prompt_len=compile_max_prompt_len,
+                max_new_tokens=compile_max_new_tokens,
+            )
+            if compile_warmup:
+                self.compiled_decoder.warmup()
     
     def _get_device(self, device: str) -> torch.device:
         """Determine the appropriate device"""
@@ -60,17 +179,24 @@ class TransformerGenerator:
         with open(config_path, 'r') as f:
             config_dict = json.load(f)
         
+        if self.attn_implementation is not None:
+            config_dict["attn_implementation"] = self.attn_implementation
         config = TransformerConfig(**config_dict)
-        model = TransformerForCausalLM(config)
         
-        # Load weights
-        weights_path = os.path.join(model_path, "pytorch_model.bin")
-        state_dict = torch.load(weights_path, map_location=self.device)
-        model.load_state_dict(state_dict)
+        if self.load_in_8bit and is_quantized_checkpoint(model_path):
+            logger.info("Loading int8 quantized weights")
+            return load_quantized_model(model_path, config)
         
-        model = model.to(self.device, dtype=self.torch_dtype)
+        # Weights are bound to a meta-initialized model; safetensors checkpoints are mmap'd, not copied
+        model = TransformerForCausalLM.from_pretrained(
+            model_path, config=config, device=self.device, torch_dtype=self.torch_dtype
+        )
         model.eval()
         
+        if self.load_in_8bit:
+            logger.info("No int8 artifact found, quantizing linear projections on load")
+            model = quantize_dynamic_int8(model, inplace=True)
+        
         return model
     
     @torch.no_grad()
@@ -88,12 +214,17 @@ class TransformerGenerator:
         eos_token_id: Optional[int] = None,
         stop_strings: Optional[List[str]] = None,
         return_full_text: bool = False,
+        use_cache: bool = True,
+        cache_implementation: str = "dynamic",
+        speculative: Optional[bool] = None,
     ) -> str:
-        """Generate text from a prompt"""
+        """
+        Generate text from a prompt. With a draft model loaded, decoding is speculative unless
+        `speculative=False` (it requires the dynamic KV cache).
+        """
         
         # Tokenize input
-        input_ids = self.tokenizer.encode(prompt, add_special_tokens=True)
-        input_ids = torch.tensor([input_ids], device=self.device)
+        input_ids = torch.tensor([self._encode_prompt(prompt)], device=self.device)
         input_length = input_ids.shape[1]
         
         # Set default values
@@ -102,8 +233,65 @@ class TransformerGenerator:
         if eos_token_id is None:
             eos_token_id = self.tokenizer.eos_token_id
         
+        if speculative is None:
+            speculative = self.draft_model is not None and use_cache and cache_implementation == "dynamic"
+        if speculative and self.draft_model is None:
+            raise ValueError("speculative=True requires a draft model (pass draft_model_path)")
+        sampling_kwargs = dict(
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            do_sample=do_sample,
+            repetition_penalty=repetition_penalty,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+            pad_token_id=pad_token_id,
+            eos_token_id=eos_token_id,
+        )
+        
         # Generate
-        generated_ids = self._generate_tokens(
+        if speculative:
+            generated_ids = self._speculative_generate_tokens(input_ids=input_ids, **sampling_kwargs)
+        else:
+            generated_ids = self._generate_tokens(
+                input_ids=input_ids,
+                use_cache=use_cache,
+                cache_implementation=cache_implementation,
+                **sampling_kwargs,
+            )
+        
+        return self._decode_output(generated_ids[0], input_length, return_full_text, stop_strings)
+    
+    @torch.no_grad()
+    def generate_stream(
+        self,
+        prompt: str,
+        max_new_tokens: int = 100,
+        temperature: float = 0.7,
+        top_k: int = 50,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        repetition_penalty: float = 1.1,
+        no_repeat_ngram_size: int = 3,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+        stop_strings: Optional[List[str]] = None,
+        use_cache: bool = True,
+        cache_implementation: str = "dynamic",
+    ) -> Iterator[str]:
+        """
+        Generate text from a prompt, yielding it as it is decoded.
+
+        The concatenated chunks equal `generate(...)` with `return_full_text=False`.
+        """
+        input_ids = torch.tensor([self._encode_prompt(prompt)], device=self.device)
+        
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        
+        steps = self._iter_generate_tokens(
             input_ids=input_ids,
             max_new_tokens=max_new_tokens,
             temperature=temperature,
@@ -114,14 +302,93 @@ class TransformerGenerator:
             no_repeat_ngram_size=no_repeat_ngram_size,
             pad_token_id=pad_token_id,
             eos_token_id=eos_token_id,
+            use_cache=use_cache,
+            cache_implementation=cache_implementation,
+        )
+        yield from self._stream_text((generated[0, -1].item() for generated in steps), stop_strings)
+    
+    def _stream_text(self, token_ids: Iterable[int], stop_strings: Optional[List[str]] = None) -> Iterator[str]:
+        """
+        Detokenize generated token IDs incrementally, with the same stop-string and whitespace
+        handling as `_decode_output`.
+
+        Text is emitted as soon as it is final. The last `len(stop_string) - 1` characters are held
+        back because they could still begin a stop string, and so is trailing whitespace, because
+        it could turn out to be the end of the output.
+        """
+        decoder = self.tokenizer.decode_stream(skip_special_tokens=True)
+        holdback = max(len(stop) for stop in stop_strings) - 1 if stop_strings else 0
+        pending = ""
+        started = False
+        
+        def cut_at_stop(text: str) -> int:
+            positions = [text.find(stop) for stop in stop_strings or [] if stop in text]
+            return min(positions) if positions else -1
+        
+        for token_id in token_ids:
+            pending += decoder.push(token_id)
+            
+            cut = cut_at_stop(pending)
+            if cut >= 0:
+                pending = pending[:cut]
+                break
+            
+            ready = pending[:len(pending) - holdback].rstrip()
+            chunk = ready if started else ready.lstrip()
+            if chunk:
+                yield chunk
+                started = True
+                pending = pending[len(ready):]
+        else:
+            pending += decoder.flush()
+            cut = cut_at_stop(pending)
+            if cut >= 0:
+                pending = pending[:cut]
+        
+        final = pending.rstrip() if started else pending.strip()
+        if final:
+            yield final
+    
+    def _encode_prompt(self, prompt: str) -> List[int]:
+        """Tokenize a prompt for continuation: BOS but no trailing EOS"""
+        return [self.tokenizer.bos_token_id] + self.tokenizer.encode(prompt, add_special_tokens=False)
+    
+    def _encode_prompts(self, prompts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Left-pad a batch of prompts (BOS + text each); returns input_ids and attention_mask"""
+        encoded = self.tokenizer.batch_encode(
+            prompts,
+            add_special_tokens=False,
+            padding=True,
+            truncation=False,
+            padding_side="left",
+            return_tensors="pt",
         )
+        input_ids = encoded["input_ids"].to(self.device)
+        attention_mask = encoded["attention_mask"].to(self.device)
+        
+        # Put BOS right before each row's first real token, inside one extra left padding column
+        pad_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.unk_token_id
+        input_ids = F.pad(input_ids, (1, 0), value=pad_id)
+        attention_mask = F.pad(attention_mask, (1, 0), value=0)
+        bos_index = (attention_mask == 0).sum(dim=1, keepdim=True) - 1
+        input_ids.scatter_(1, bos_index, self.tokenizer.bos_token_id)
+        attention_mask.scatter_(1, bos_index, 1)
         
-        # Decode generated text
+        return input_ids, attention_mask
+    
+    def _decode_output(
+        self,
+        token_ids: torch.Tensor,
+        input_length: int,
+        return_full_text: bool = False,
+        stop_strings: Optional[List[str]] = None,
+    ) -> str:
+        """Decode one generated sequence and apply stop strings"""
         if return_full_text:
-            generated_text = self.tokenizer.decode(generated_ids[0], skip_special_tokens=True)
+            generated_text = self.tokenizer.decode(token_ids.tolist(), skip_special_tokens=True)
         else:
-            new_tokens = generated_ids[0][input_length:]
-            generated_text = self.tokenizer.decode(new_tokens, skip_special_tokens=True)
+            new_tokens = token_ids[input_length:]
+            generated_text = self.tokenizer.decode(new_tokens.tolist(), skip_special_tokens=True)
         
         # Apply stop strings
         if stop_strings:
@@ -131,6 +398,25 @@ class TransformerGenerator:
         
         return generated_text.strip()
     
+    def _prefill(self, input_ids: torch.Tensor) -> Tuple[torch.Tensor, Tuple[Tuple[torch.Tensor, torch.Tensor], ...]]:
+        """
+        Run a single prompt ([1, seq_len]) and return its last-position logits and dynamic cache.
+        With the prefix cache enabled, only the part after the longest cached prefix is run.
+        """
+        if self.prefix_cache is None:
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+            return outputs["logits"][:, -1, :], outputs["past_key_values"]
+        
+        token_ids = input_ids[0].tolist()
+        cached_length, past_key_values = self.prefix_cache.lookup(token_ids)
+        outputs = self.model(
+            input_ids=input_ids[:, cached_length:],
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        self.prefix_cache.insert(token_ids, outputs["past_key_values"])
+        return outputs["logits"][:, -1, :], outputs["past_key_values"]
+    
     def _generate_tokens(
         self,
         input_ids: torch.Tensor,
@@ -143,129 +429,444 @@ class TransformerGenerator:
         no_repeat_ngram_size: int,
         pad_token_id: int,
         eos_token_id: int,
+        use_cache: bool = True,
+        attention_mask: Optional[torch.Tensor] = None,
+        cache_implementation: str = "dynamic",
     ) -> torch.Tensor:
-        """Generate tokens using the model"""
+        """Generate tokens using the model; returns prompt + generated IDs (see `_iter_generate_tokens`)"""
+        generated = input_ids
+        for generated in self._iter_generate_tokens(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            do_sample=do_sample,
+            repetition_penalty=repetition_penalty,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+            pad_token_id=pad_token_id,
+            eos_token_id=eos_token_id,
+            use_cache=use_cache,
+            attention_mask=attention_mask,
+            cache_implementation=cache_implementation,
+        ):
+            pass
+        return generated
+    
+    def _iter_generate_tokens(
+        self,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        temperature: float,
+        top_k: int,
+        top_p: float,
+        do_sample: bool,
+        repetition_penalty: float,
+        no_repeat_ngram_size: int,
+        pad_token_id: int,
+        eos_token_id: int,
+        use_cache: bool = True,
+        attention_mask: Optional[torch.Tensor] = None,
+        cache_implementation: str = "dynamic",
+    ) -> Iterator[torch.Tensor]:
+        """
+        Generate tokens using the model, yielding the sequences after every step.
+
+        With `use_cache` the prompt is run once and every following step feeds only the newest
+        token together with the `past_key_values` returned by the previous step. Without it the
+        whole sequence is re-encoded each step; both paths produce the same greedy output.
+        `cache_implementation="static"` preallocates the cache for prompt + max_new_tokens
+        instead of growing it with torch.cat; `"sliding_window"` keeps only the entries inside
+        `config.sliding_window`. With `compile_model`, single dynamic-cache prompts go through
+        the fixed-shape CompiledDecoder instead.
+        """
         
         batch_size = input_ids.shape[0]
         generated = input_ids
+        past_key_values = None
+        if use_cache and cache_implementation == "static":
+            past_key_values = StaticKVCache(
+                self.model.config,
+                batch_size=batch_size,
+                max_cache_len=input_ids.shape[1] + max_new_tokens,
+                device=self.device,
+                dtype=next(self.model.parameters()).dtype,
+            )
+        elif use_cache and cache_implementation == "sliding_window":
+            past_key_values = SlidingWindowKVCache(self.model.config)
+        elif cache_implementation not in ("dynamic", "static", "sliding_window"):
+            raise ValueError(
+                f"Unknown cache_implementation: {cache_implementation}. "
+                f"Available: ['dynamic', 'static', 'sliding_window']"
+            )
+        
+        # Single unpadded prompts can run through the compiled graphs when they fit and the slots are free
+        compiled = self.compiled_decoder
+        use_compiled = (
+            compiled is not None
+            and use_cache
+            and cache_implementation == "dynamic"
+            and batch_size == 1
+            and attention_mask is None
+            and compiled.fits(input_ids.shape[1], max_new_tokens)
+            and compiled.lock.acquire(blocking=False)
+        )
+        
+        # ...or reuse cached K/V of an earlier prompt's prefix
+        use_prefix_cache = (
+            self.prefix_cache is not None
+            and use_cache
+            and cache_implementation == "dynamic"
+            and batch_size == 1
+            and attention_mask is None
+        )
         
         # Keep track of finished sequences
         finished = torch.zeros(batch_size, dtype=torch.bool, device=self.device)
+        ngram_index = NoRepeatNGramIndex(no_repeat_ngram_size, batch_size) if no_repeat_ngram_size > 0 else None
         
-        for _ in range(max_new_tokens):
-            # Forward pass
-            outputs = self.model(input_ids=generated, use_cache=False)
-            logits = outputs["logits"][:, -1, :]  # Get logits for last token
-            
-            # Apply repetition penalty
-            if repetition_penalty != 1.0:
-                logits = self._apply_repetition_penalty(
-                    logits, generated, repetition_penalty, no_repeat_ngram_size
+        try:
+            for step in range(max_new_tokens):
+                if use_compiled:
+                    if step == 0:
+                        logits = self.compiled_decoder.prefill(0, generated[0].tolist())
+                    else:
+                        logits = self.compiled_decoder.decode([0], generated[:, -1:], [generated.shape[1] - 1])
+                elif use_prefix_cache and past_key_values is None:
+                    logits, past_key_values = self._prefill(generated)
+                else:
+                    # Forward pass (only the newest token once the cache holds the prefix)
+                    model_inputs = self.model.prepare_inputs_for_generation(
+                        generated,
+                        past_key_values=past_key_values,
+                        attention_mask=attention_mask,
+                        use_cache=use_cache,
+                    )
+                    outputs = self.model(**model_inputs)
+                    logits = outputs["logits"][:, -1, :]  # Get logits for last token
+                    if use_cache:
+                        past_key_values = outputs["past_key_values"]
+                
+                next_token = self._sample_next_token(
+                    logits,
+                    generated,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    do_sample=do_sample,
+                    repetition_penalty=repetition_penalty,
+                    no_repeat_ngram_size=no_repeat_ngram_size,
+                    ngram_index=ngram_index,
                 )
-            
-            # Apply temperature
-            if temperature != 1.0:
-                logits = logits / temperature
-            
-            # Sample next token
-            if do_sample:
-                # Apply top-k filtering
-                if top_k > 0:
-                    logits = self._top_k_filtering(logits, top_k)
                 
-                # Apply top-p (nucleus) filtering
-                if top_p < 1.0:
-                    logits = self._top_p_filtering(logits, top_p)
+                # Sequences that already finished keep emitting padding
+                next_token = next_token.masked_fill(finished.unsqueeze(-1), pad_token_id)
+                
+                # Add generated token
+                generated = torch.cat([generated, next_token], dim=1)
+                if attention_mask is not None:
+                    attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch_size, 1))], dim=1)
+                
+                yield generated
                 
-                # Sample from the filtered distribution
-                probs = F.softmax(logits, dim=-1)
-                next_token = torch.multinomial(probs, num_samples=1)
+                # Check for end of sequence
+                finished = finished | (next_token.squeeze(-1) == eos_token_id)
+                if finished.all():
+                    break
+        finally:
+            if use_compiled:
+                compiled.lock.release()
+    
+    def _speculative_generate_tokens(
+        self,
+        input_ids: torch.Tensor,
+        max_new_tokens: int,
+        temperature: float,
+        top_k: int,
+        top_p: float,
+        do_sample: bool,
+        repetition_penalty: float,
+        no_repeat_ngram_size: int,
+        pad_token_id: int,
+        eos_token_id: int,
+        stats: Optional[Dict[str, int]] = None,
+    ) -> torch.Tensor:
+        """
+        Speculative decoding of a single prompt ([1, seq_len]); returns prompt + generated IDs.
+        This call's counters are added to `stats` when given, and to `speculative_stats`.
+
+        Each round the draft model proposes up to `num_speculative_tokens` tokens autoregressively
+        and the target scores all of them in one forward pass. Proposal x_i, drawn from the draft's
+        distribution q_i, is accepted with probability min(1, p_i(x_i) / q_i(x_i)) under the target's
+        distribution p_i. The first rejected position is resampled from max(0, p_i - q_i)
+        (normalized); if every proposal is accepted, one extra token is sampled from the target's
+        last position. The output follows the target's distribution exactly, including repetition
+        penalty, n-gram blocking and the top-k/top-p warping, and greedy output is identical to
+        `_generate_tokens`.
+
+        Both models keep a dynamic cache of everything but the last accepted token. After a round
+        their caches are cut back to the accepted prefix.
+        """
+        if input_ids.shape[0] != 1:
+            raise ValueError(f"Speculative decoding supports a single sequence, got batch size {input_ids.shape[0]}")
+        
+        ngram_indexes = {
+            name: NoRepeatNGramIndex(no_repeat_ngram_size, 1) if no_repeat_ngram_size > 0 else None
+            for name in ("target", "draft")
+        }
+        
+        def crop(past_key_values, length):
+            if past_key_values is None:
+                return None
+            return tuple((k[:, :, :length], v[:, :, :length]) for k, v in past_key_values)
+        
+        def probs_at(logits, context, ngram_index):
+            # fp32 so the p/q acceptance ratio is not quantized by a half-precision model
+            logits = self._process_logits(logits.float(), context, repetition_penalty, no_repeat_ngram_size, ngram_index)
+            return self._sampling_probs(logits, temperature, top_k, top_p, do_sample)
+        
+        def pick(probs):
+            return torch.multinomial(probs, 1) if do_sample else torch.argmax(probs, dim=-1, keepdim=True)
+        
+        # Caches cover generated[:, :-1]; the last token is fed with the next round's inputs
+        target_past = draft_past = None
+        if input_ids.shape[1] > 1:
+            if self.prefix_cache is not None:
+                _, target_past = self._prefill(input_ids[:, :-1])
             else:
-                # Greedy sampling
-                next_token = torch.argmax(logits, dim=-1, keepdim=True)
+                target_past = self.model(input_ids=input_ids[:, :-1], use_cache=True)["past_key_values"]
+            draft_past = self.draft_model(input_ids=input_ids[:, :-1], use_cache=True)["past_key_values"]
+        target_length = draft_length = input_ids.shape[1] - 1
+        
+        generated = input_ids
+        num_generated = 0
+        call_stats = {"target_forwards": 0, "proposed_tokens": 0, "accepted_tokens": 0}
+        while num_generated < max_new_tokens:
+            seq_len = generated.shape[1]
+            # A round emits the accepted proposals plus one target token, so never overshoot
+            num_draft = min(self.num_speculative_tokens, max_new_tokens - num_generated - 1)
+            
+            # Draft: propose num_draft tokens, keeping the distribution each was drawn from
+            context = generated
+            draft_probs = []
+            for _ in range(num_draft):
+                outputs = self.draft_model(
+                    input_ids=context[:, draft_length:], past_key_values=draft_past, use_cache=True
+                )
+                draft_past = outputs["past_key_values"]
+                draft_length = context.shape[1]
+                probs = probs_at(outputs["logits"][:, -1, :], context, ngram_indexes["draft"])
+                draft_probs.append(probs)
+                context = torch.cat([context, pick(probs)], dim=1)
+            
+            # Target: score the last accepted token and every proposal in one pass
+            outputs = self.model(input_ids=context[:, target_length:], past_key_values=target_past, use_cache=True)
+            target_past = outputs["past_key_values"]
+            target_logits = outputs["logits"][:, -(num_draft + 1):, :]
+            
+            num_accepted = 0
+            next_token = None
+            for i in range(num_draft):
+                probs = probs_at(target_logits[:, i, :], context[:, :seq_len + i], ngram_indexes["target"])
+                token = context[:, seq_len + i]
+                p, q = probs[0, token], draft_probs[i][0, token]
+                if do_sample:
+                    accepted = bool(torch.rand((), device=p.device) * q < p)
+                else:
+                    accepted = bool(p > 0)
+                if not accepted:
+                    residual = (probs - draft_probs[i]).clamp(min=0) if do_sample else probs
+                    if residual.sum() <= 0:
+                        residual = probs
+                    next_token = pick(residual / residual.sum())
+                    break
+                num_accepted += 1
+            if next_token is None:
+                probs = probs_at(target_logits[:, num_draft, :], context, ngram_indexes["target"])
+                next_token = pick(probs)
+            
+            new_tokens = torch.cat([context[:, seq_len:seq_len + num_accepted], next_token], dim=1)
+            eos_positions = (new_tokens[0] == eos_token_id).nonzero()
+            if len(eos_positions) > 0:
+                new_tokens = new_tokens[:, :eos_positions[0].item() + 1]
+            generated = torch.cat([generated, new_tokens], dim=1)
+            num_generated += new_tokens.shape[1]
             
-            # Add generated token
-            generated = torch.cat([generated, next_token], dim=1)
+            call_stats["target_forwards"] += 1
+            call_stats["proposed_tokens"] += num_draft
+            call_stats["accepted_tokens"] += num_accepted
             
-            # Check for end of sequence
-            finished = finished | (next_token.squeeze() == eos_token_id)
-            if finished.all():
+            if len(eos_positions) > 0:
                 break
+            
+            # Drop K/V and n-grams of rejected proposals
+            committed = generated.shape[1] - 1
+            target_length = min(target_length + num_draft + 1, committed)
+            draft_length = min(draft_length, committed)
+            target_past = crop(target_past, target_length)
+            draft_past = crop(draft_past, draft_length)
+            for ngram_index in ngram_indexes.values():
+                if ngram_index is not None:
+                    ngram_index.truncate(committed)
         
+        with self._speculative_stats_lock:
+            for key, value in call_stats.items():
+                self.speculative_stats[key] += value
+        if stats is not None:
+            for key, value in call_stats.items():
+                stats[key] = stats.get(key, 0) + value
         return generated
     
-    def _apply_repetition_penalty(
+    def get_speculative_stats(self) -> Dict[str, float]:
+        """Acceptance rate of draft proposals and tokens emitted per target forward pass"""
+        with self._speculative_stats_lock:
+            stats = dict(self.speculative_stats)
+        return _summarize_speculative_stats(stats)
+    
+    def _sample_next_token(
         self,
         logits: torch.Tensor,
         input_ids: torch.Tensor,
-        penalty: float,
+        temperature: Union[float, torch.Tensor],
+        top_k: Union[int, torch.Tensor],
+        top_p: Union[float, torch.Tensor],
+        do_sample: bool,
+        repetition_penalty: float,
         no_repeat_ngram_size: int,
+        ngram_index: Optional["NoRepeatNGramIndex"] = None,
     ) -> torch.Tensor:
-        """Apply repetition penalty to logits"""
-        if penalty == 1.0:
-            return logits
+        """
+        Pick the next token [batch_size, 1] from last-position logits. Pass the same
+        `ngram_index` on every step of a generation so n-gram blocking stays incremental.
+        """
+        logits = self._process_logits(logits, input_ids, repetition_penalty, no_repeat_ngram_size, ngram_index)
         
-        batch_size, vocab_size = logits.shape
+        # Sample next token
+        if do_sample:
+            return self._fused_sample(logits, temperature, top_k, top_p)
         
-        for batch_idx in range(batch_size):
-            for token_id in set(input_ids[batch_idx].tolist()):
-                # Apply penalty to repeated tokens
-                if logits[batch_idx, token_id] < 0:
-                    logits[batch_idx, token_id] *= penalty
-                else:
-                    logits[batch_idx, token_id] /= penalty
+        # Greedy sampling
+        return torch.argmax(logits, dim=-1, keepdim=True)
+    
+    def _process_logits(
+        self,
+        logits: torch.Tensor,
+        input_ids: torch.Tensor,
+        repetition_penalty: float,
+        no_repeat_ngram_size: int,
+        ngram_index: Optional["NoRepeatNGramIndex"] = None,
+    ) -> torch.Tensor:
+        """Apply repetition penalty and n-gram blocking"""
+        # Apply repetition penalty
+        if repetition_penalty != 1.0:
+            logits = self._apply_repetition_penalty(logits, input_ids, repetition_penalty)
         
         # Prevent n-gram repetition
         if no_repeat_ngram_size > 0:
-            for batch_idx in range(batch_size):
-                # Get the last (no_repeat_ngram_size - 1) tokens
-                if input_ids.shape[1] >= no_repeat_ngram_size:
-                    ngram = input_ids[batch_idx, -(no_repeat_ngram_size-1):].tolist()
-                    
-                    # Find all n-grams in the input that start with this prefix
-                    for i in range(input_ids.shape[1] - no_repeat_ngram_size + 1):
-                        if input_ids[batch_idx, i:i+no_repeat_ngram_size-1].tolist() == ngram:
-                            banned_token = input_ids[batch_idx, i+no_repeat_ngram_size-1].item()
-                            logits[batch_idx, banned_token] = float('-inf')
+            if ngram_index is None:
+                ngram_index = NoRepeatNGramIndex(no_repeat_ngram_size, input_ids.shape[0])
+            logits = self._apply_no_repeat_ngram(logits, input_ids, ngram_index)
         
         return logits
     
-    def _top_k_filtering(self, logits: torch.Tensor, top_k: int) -> torch.Tensor:
-        """Apply top-k filtering to logits"""
-        if top_k <= 0:
-            return logits
+    @staticmethod
+    def _fused_candidates(
+        logits: torch.Tensor,
+        temperature: Union[float, torch.Tensor],
+        top_k: Union[int, torch.Tensor],
+        top_p: Union[float, torch.Tensor],
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Temperature, top-k and top-p filtering with a single sort; returns the candidates'
+        probabilities and token IDs, both [batch_size, max_k].
+
+        `torch.topk` already returns the candidates in descending order, so nucleus filtering
+        runs over those k candidates instead of sorting the whole vocabulary again. Every
+        parameter may be a scalar or a per-row tensor of shape [batch_size]; top_k <= 0
+        disables top-k for that row.
+        """
+        batch_size, vocab_size = logits.shape
+        device = logits.device
         
-        top_k = min(top_k, logits.size(-1))
-        # Get top-k values and indices
-        values, indices = torch.topk(logits, top_k, dim=-1)
+        def per_row(value, dtype):
+            if isinstance(value, torch.Tensor):
+                return value.to(device=device, dtype=dtype).reshape(-1).expand(batch_size)
+            return torch.full((batch_size,), value, dtype=dtype, device=device)
         
-        # Create a mask for top-k tokens
-        min_values = values[:, -1:].expand_as(logits)
-        logits = torch.where(logits < min_values, torch.full_like(logits, float('-inf')), logits)
+        temperature = per_row(temperature, logits.dtype)
+        top_p = per_row(top_p, logits.dtype)
+        top_k = per_row(top_k, torch.long)
+        top_k = torch.where(top_k > 0, top_k, torch.full_like(top_k, vocab_size)).clamp(max=vocab_size)
         
-        return logits
-    
-    def _top_p_filtering(self, logits: torch.Tensor, top_p: float) -> torch.Tensor:
-        """Apply top-p (nucleus) filtering to logits"""
-        if top_p >= 1.0:
-            return logits
+        # Candidates in descending order; rows with a smaller k mask out the tail
+        values, indices = torch.topk(logits, int(top_k.max()), dim=-1)
+        values = values / temperature.unsqueeze(-1)
+        ranks = torch.arange(values.shape[-1], device=device)
+        values = values.masked_fill(ranks.unsqueeze(0) >= top_k.unsqueeze(-1), float('-inf'))
         
-        # Sort logits in descending order
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        # Nucleus: drop a candidate once the mass before it already exceeds top_p (keeps the first)
+        probs = F.softmax(values, dim=-1)
+        mass_before = torch.cumsum(probs, dim=-1) - probs
+        values = values.masked_fill(mass_before > top_p.unsqueeze(-1), float('-inf'))
         
-        # Calculate cumulative probabilities
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-        
-        # Create mask for tokens to keep
-        sorted_indices_to_remove = cumulative_probs > top_p
-        # Keep at least one token
-        sorted_indices_to_remove[:, 1:] = sorted_indices_to_remove[:, :-1].clone()
-        sorted_indices_to_remove[:, 0] = False
+        return F.softmax(values, dim=-1), indices
+    
+    @staticmethod
+    def _fused_sample(
+        logits: torch.Tensor,
+        temperature: Union[float, torch.Tensor],
+        top_k: Union[int, torch.Tensor],
+        top_p: Union[float, torch.Tensor],
+    ) -> torch.Tensor:
+        """Sample one token per row [batch_size, 1] (see `_fused_candidates`)"""
+        probs, indices = TransformerGenerator._fused_candidates(logits, temperature, top_k, top_p)
+        choice = torch.multinomial(probs, num_samples=1)
+        return indices.gather(-1, choice)
+    
+    @staticmethod
+    def _sampling_probs(
+        logits: torch.Tensor,
+        temperature: Union[float, torch.Tensor],
+        top_k: Union[int, torch.Tensor],
+        top_p: Union[float, torch.Tensor],
+        do_sample: bool,
+    ) -> torch.Tensor:
+        """Full-vocabulary distribution [batch_size, vocab_size] that sampling draws from"""
+        if not do_sample:
+            return F.one_hot(torch.argmax(logits, dim=-1), logits.shape[-1]).to(logits.dtype)
+        probs, indices = TransformerGenerator._fused_candidates(logits, temperature, top_k, top_p)
+        return torch.zeros_like(logits).scatter_(-1, indices, probs)
+    
+    def _apply_repetition_penalty(
+        self,
+        logits: torch.Tensor,
+        input_ids: torch.Tensor,
+        penalty: float,
+    ) -> torch.Tensor:
+        """Apply repetition penalty to logits of every token already in `input_ids`"""
+        if penalty == 1.0:
+            return logits
         
-        # Apply mask to original logits
-        indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-        logits = logits.masked_fill(indices_to_remove, float('-inf'))
+        # Gather the scores of seen tokens, penalize them and scatter them back in one pass
+        score = torch.gather(logits, 1, input_ids)
+        score = torch.where(score < 0, score * penalty, score / penalty)
+        return logits.scatter(1, input_ids, score)
+    
+    def _apply_no_repeat_ngram(
+        self,
+        logits: torch.Tensor,
+        input_ids: torch.Tensor,
+        ngram_index: "NoRepeatNGramIndex",
+    ) -> torch.Tensor:
+        """Ban tokens that would complete an n-gram already present in `input_ids`"""
+        ngram_index.update(input_ids)
+        banned = ngram_index.banned_tokens(input_ids)
         
+        rows = [row for row, tokens in enumerate(banned) for _ in tokens]
+        if not rows:
+            return logits
+        cols = [token for tokens in banned for token in tokens]
+        logits[rows, cols] = float('-inf')
         return logits
     
     def chat(
@@ -316,25 +917,65 @@ class TransformerGenerator:
         batch_size: int = 4,
         **kwargs
     ) -> List[str]:
-        """Generate text for multiple prompts"""
+        """Generate text for multiple prompts, running `batch_size` prompts per forward pass"""
         results = []
         
         for i in range(0, len(prompts), batch_size):
             batch_prompts = prompts[i:i+batch_size]
-            batch_results = []
-            
-            for prompt in batch_prompts:
-                result = self.generate(
-                    prompt=prompt,
-                    max_new_tokens=max_new_tokens,
-                    **kwargs
-                )
-                batch_results.append(result)
-            
-            results.extend(batch_results)
+            results.extend(self._generate_batch(batch_prompts, max_new_tokens=max_new_tokens, **kwargs))
         
         return results
     
+    @torch.no_grad()
+    def _generate_batch(
+        self,
+        prompts: List[str],
+        max_new_tokens: int = 100,
+        temperature: float = 0.7,
+        top_k: int = 50,
+        top_p: float = 0.9,
+        do_sample: bool = True,
+        repetition_penalty: float = 1.1,
+        no_repeat_ngram_size: int = 3,
+        pad_token_id: Optional[int] = None,
+        eos_token_id: Optional[int] = None,
+        stop_strings: Optional[List[str]] = None,
+        return_full_text: bool = False,
+        use_cache: bool = True,
+        cache_implementation: str = "dynamic",
+    ) -> List[str]:
+        """Generate for one left-padded batch; rows stop independently at EOS"""
+        input_ids, attention_mask = self._encode_prompts(prompts)
+        input_length = input_ids.shape[1]
+        
+        # Set default values
+        if pad_token_id is None:
+            pad_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        
+        generated_ids = self._generate_tokens(
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            temperature=temperature,
+            top_k=top_k,
+            top_p=top_p,
+            do_sample=do_sample,
+            repetition_penalty=repetition_penalty,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+            pad_token_id=pad_token_id,
+            eos_token_id=eos_token_id,
+            use_cache=use_cache,
+            attention_mask=attention_mask,
+            cache_implementation=cache_implementation,
+        )
+        
+        # Left padding and post-EOS padding are special tokens and are skipped when decoding
+        return [
+            self._decode_output(row_ids, input_length, return_full_text, stop_strings)
+            for row_ids in generated_ids
+        ]
+    
     def get_model_info(self) -> Dict[str, Any]:
         """Get information about the loaded model"""
         config = self.model.config
@@ -354,6 +995,10 @@ class TransformerGenerator:
             "trainable_parameters": trainable_params,
             "device": str(self.device),
             "dtype": str(self.torch_dtype),
+            "quantization": "int8_dynamic" if self.load_in_8bit else None,
+            "prefix_cache": self.prefix_cache.stats() if self.prefix_cache is not None else None,
+            "speculative_decoding": self.get_speculative_stats() if self.draft_model is not None else None,
+            "compiled": self.compiled_decoder.info() if self.compiled_decoder is not None else None,
         }
 
 
@@ -430,24 +1075,257 @@ def create_model_chatbot(
 # Example usage and testing functions
 
 def benchmark_generation(generator: TransformerGenerator, num_tests: int = 5) -> Dict[str, float]:
-    """Benchmark generation speed"""
+    """Benchmark generation speed (see inference/benchmark.py for the full prefill/decode matrix)"""
     test_prompt = "The future of artificial intelligence is"
+    input_length = len(generator._encode_prompt(test_prompt))
+    eos_token_id = generator.tokenizer.eos_token_id
     times = []
+    generated_tokens = 0
     
     for _ in range(num_tests):
-        start_time = time.time()
-        _ = generator.generate(test_prompt, max_new_tokens=100)
-        end_time = time.time()
-        times.append(end_time - start_time)
+        start_time = time.perf_counter()
+        input_ids = torch.tensor([generator._encode_prompt(test_prompt)], device=generator.device)
+        with torch.no_grad():
+            generated = generator._generate_tokens(
+                input_ids=input_ids,
+                max_new_tokens=100,
+                temperature=0.7,
+                top_k=50,
+                top_p=0.9,
+                do_sample=True,
+                repetition_penalty=1.1,
+                no_repeat_ngram_size=3,
+                pad_token_id=eos_token_id,
+                eos_token_id=eos_token_id,
+            )
+        times.append(time.perf_counter() - start_time)
+        # Count the tokens actually produced; EOS may stop generation early
+        generated_tokens += generated.shape[1] - input_length
     
     return {
         "average_time": sum(times) / len(times),
         "min_time": min(times),
         "max_time": max(times),
-        "tokens_per_second": 100 / (sum(times) / len(times))
+        "average_generated_tokens": generated_tokens / num_tests,
+        "tokens_per_second": generated_tokens / sum(times),
     }
 
 
+def benchmark_kv_cache(
+    generator: TransformerGenerator,
+    prompt: str = "The future of artificial intelligence is",
+    max_new_tokens: int = 100,
+    num_tests: int = 3,
+) -> Dict[str, Any]:
+    """Compare greedy decoding throughput with and without the KV cache"""
+    input_ids = torch.tensor([generator._encode_prompt(prompt)], device=generator.device)
+    eos_token_id = generator.tokenizer.eos_token_id
+    results: Dict[str, Any] = {}
+    outputs = {}
+    
+    for use_cache in (False, True):
+        times = []
+        generated_tokens = 0
+        
+        for _ in range(num_tests):
+            start_time = time.perf_counter()
+            generated = generator._generate_tokens(
+                input_ids=input_ids,
+                max_new_tokens=max_new_tokens,
+                temperature=1.0,
+                top_k=0,
+                top_p=1.0,
+                do_sample=False,
+                repetition_penalty=1.0,
+                no_repeat_ngram_size=0,
+                pad_token_id=eos_token_id,
+                eos_token_id=eos_token_id,
+                use_cache=use_cache,
+            )
+            times.append(time.perf_counter() - start_time)
+            # Count the tokens actually produced; EOS may stop generation early
+            generated_tokens += generated.shape[1] - input_ids.shape[1]
+        
+        outputs[use_cache] = generated
+        results["cached" if use_cache else "uncached"] = {
+            "average_time": sum(times) / len(times),
+            "min_time": min(times),
+            "max_time": max(times),
+            "tokens_per_second": generated_tokens / sum(times),
+        }
+    
+    results["speedup"] = results["cached"]["tokens_per_second"] / results["uncached"]["tokens_per_second"]
+    results["outputs_match"] = torch.equal(outputs[True], outputs[False])
+    return results
+
+
+def benchmark_compiled_decoding(
+    generator: TransformerGenerator,
+    prompt: str = "The future of artificial intelligence is",
+    max_new_tokens: int = 100,
+    num_tests: int = 3,
+) -> Dict[str, Any]:
+    """Compare greedy decoding throughput of the eager model and the compiled fixed-shape path"""
+    if generator.compiled_decoder is None:
+        raise ValueError("benchmark_compiled_decoding requires a generator loaded with compile_model=True")
+    
+    input_ids = torch.tensor([generator._encode_prompt(prompt)], device=generator.device)
+    eos_token_id = generator.tokenizer.eos_token_id
+    compiled_decoder = generator.compiled_decoder
+    results: Dict[str, Any] = {}
+    outputs = {}
+    
+    try:
+        for compiled in (False, True):
+            generator.compiled_decoder = compiled_decoder if compiled else None
+            times = []
+            generated_tokens = 0
+            
+            with torch.no_grad():
+                for _ in range(num_tests):
+                    start_time = time.perf_counter()
+                    generated = generator._generate_tokens(
+                        input_ids=input_ids,
+                        max_new_tokens=max_new_tokens,
+                        temperature=1.0,
+                        top_k=0,
+                        top_p=1.0,
+                        do_sample=False,
+                        repetition_penalty=1.0,
+                        no_repeat_ngram_size=0,
+                        pad_token_id=eos_token_id,
+                        eos_token_id=eos_token_id,
+                    )
+                    times.append(time.perf_counter() - start_time)
+                    generated_tokens += generated.shape[1] - input_ids.shape[1]
+            
+            outputs[compiled] = generated
+            results["compiled" if compiled else "eager"] = {
+                "average_time": sum(times) / len(times),
+                "min_time": min(times),
+                "tokens_per_second": generated_tokens / sum(times),
+            }
+    finally:
+        generator.compiled_decoder = compiled_decoder
+    
+    results["speedup"] = results["compiled"]["tokens_per_second"] / results["eager"]["tokens_per_second"]
+    results["outputs_match"] = torch.equal(outputs[True], outputs[False])
+    return results
+
+
+def _summarize_speculative_stats(stats: Dict[str, int]) -> Dict[str, float]:
+    forwards = stats.get("target_forwards", 0)
+    proposed = stats.get("proposed_tokens", 0)
+    accepted = stats.get("accepted_tokens", 0)
+    return {
+        **stats,
+        "acceptance_rate": accepted / proposed if proposed else 0.0,
+        "tokens_per_target_forward": (accepted + forwards) / forwards if forwards else 0.0,
+    }
+
+
+def benchmark_speculative_decoding(
+    generator: TransformerGenerator,
+    prompt: str = "The future of artificial intelligence is",
+    max_new_tokens: int = 100,
+    num_tests: int = 3,
+    do_sample: bool = False,
+) -> Dict[str, Any]:
+    """Compare decoding throughput of the target model alone and with draft-model speculation"""
+    if generator.draft_model is None:
+        raise ValueError("benchmark_speculative_decoding requires a generator with a draft model")
+    
+    input_ids = torch.tensor([generator._encode_prompt(prompt)], device=generator.device)
+    eos_token_id = generator.tokenizer.eos_token_id
+    sampling = dict(
+        max_new_tokens=max_new_tokens,
+        temperature=0.7 if do_sample else 1.0,
+        top_k=50 if do_sample else 0,
+        top_p=0.9 if do_sample else 1.0,
+        do_sample=do_sample,
+        repetition_penalty=1.0,
+        no_repeat_ngram_size=0,
+        pad_token_id=eos_token_id,
+        eos_token_id=eos_token_id,
+    )
+    results: Dict[str, Any] = {}
+    outputs = {}
+    
+    # Counted per call, so concurrent generate() calls do not leak into the result
+    stats: Dict[str, int] = {}
+    for speculative in (False, True):
+        if speculative:
+            generate_tokens = functools.partial(generator._speculative_generate_tokens, stats=stats)
+        else:
+            generate_tokens = generator._generate_tokens
+        times = []
+        generated_tokens = 0
+        
+        with torch.no_grad():
+            for _ in range(num_tests):
+                start_time = time.perf_counter()
+                generated = generate_tokens(input_ids=input_ids, **sampling)
+                times.append(time.perf_counter() - start_time)
+                generated_tokens += generated.shape[1] - input_ids.shape[1]
+        
+        outputs[speculative] = generated
+        results["speculative" if speculative else "baseline"] = {
+            "average_time": sum(times) / len(times),
+            "tokens_per_second": generated_tokens / sum(times),
+        }
+    
+    summary = _summarize_speculative_stats(stats)
+    results["acceptance_rate"] = summary["acceptance_rate"]
+    results["tokens_per_target_forward"] = summary["tokens_per_target_forward"]
+    results["speedup"] = results["speculative"]["tokens_per_second"] / results["baseline"]["tokens_per_second"]
+    if not do_sample:
+        results["outputs_match"] = torch.equal(outputs[True], outputs[False])
+    return results
+
+
+@torch.no_grad()
+def benchmark_prefix_cache(
+    generator: TransformerGenerator,
+    document: str,
+    num_steps: int = 10,
+    max_bytes: int = 256 * 2**20,
+) -> Dict[str, Any]:
+    """
+    Time the prefill of an editor-style document that grows a little on every call, with and
+    without the prompt prefix cache
+    """
+    words = document.split()
+    step = max(1, len(words) // (2 * num_steps))
+    prompts = [" ".join(words[:len(words) // 2 + i * step]) for i in range(num_steps)]
+    saved_cache = generator.prefix_cache
+    results: Dict[str, Any] = {}
+    
+    try:
+        for enabled in (False, True):
+            generator.prefix_cache = PrefixCache(max_bytes) if enabled else None
+            times = []
+            for prompt in prompts:
+                input_ids = torch.tensor([generator._encode_prompt(prompt)], device=generator.device)
+                start_time = time.perf_counter()
+                generator._prefill(input_ids)
+                times.append(time.perf_counter() - start_time)
+            
+            # The first call is always a cold prefill
+            results["cached" if enabled else "uncached"] = {
+                "average_prefill_time": sum(times[1:]) / max(1, len(times) - 1),
+                "first_prefill_time": times[0],
+            }
+            if enabled:
+                results["cache_stats"] = generator.prefix_cache.stats()
+    finally:
+        generator.prefix_cache = saved_cache
+    
+    results["speedup"] = (
+        results["uncached"]["average_prefill_time"] / results["cached"]["average_prefill_time"]
+    )
+    return results
+
+
 def interactive_chat(model_path: str, system_prompt: Optional[str] = None):
     """Start an interactive chat session"""
     print("Loading Transformer model...")
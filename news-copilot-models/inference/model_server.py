@@ -0,0 +1,265 @@
+"""
+Local Model Server
+One process owns the TransformerGenerator and serves completions to web workers over a Unix socket
+"""
+
+import os
+import sys
+import stat
+import socket
+import argparse
+import logging
+import threading
+from concurrent.futures import wait
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener
+from typing import Any, Dict, Optional
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from inference.model_inference import TransformerGenerator
+from inference.generation_engine import GenerationEngine
+from inference.compiled_decoding import DEFAULT_MAX_NEW_TOKENS, DEFAULT_MAX_PROMPT_LEN
+from inference.model_client import get_server_address, get_server_authkey
+
+logger = logging.getLogger(__name__)
+
+
+class ModelServer:
+    """
+    Serve a TransformerGenerator to local clients (see `ModelClient`).
+
+    Every client connection gets its own thread, and all of them submit to one GenerationEngine.
+    Requests from different web workers are therefore batched in the same decode loop, and the
+    weights are held once no matter how many workers there are.
+
+    Connections carry pickles, so they must be authenticated: the socket lives in a private
+    runtime directory, and the authkey is $GENERATION_SERVER_AUTHKEY or a random key the server
+    writes to a 0600 file there (see `get_server_authkey`).
+    """
+
+    # How often a thread waiting on a request checks whether its client hung up
+    POLL_INTERVAL = 0.5
+    # Client-settable GenerationRequest fields; the rest is the engine's own bookkeeping
+    REQUEST_FIELDS = (
+        "prompt", "max_new_tokens", "temperature", "top_k", "top_p", "do_sample",
+        "repetition_penalty", "no_repeat_ngram_size", "stop_strings", "return_full_text",
+    )
+
+    def __init__(
+        self,
+        generator: TransformerGenerator,
+        address: Optional[str] = None,
+        authkey: Optional[bytes] = None,
+        max_batch_size: int = 8,
+    ):
+        self.generator = generator
+        self.address = address or get_server_address()
+        self.authkey = authkey or get_server_authkey(create=True)
+        self.engine = GenerationEngine(generator, max_batch_size=max_batch_size)
+        self._listener: Optional[Listener] = None
+        self._running = False
+
+    def serve_forever(self):
+        """Accept connections until `shutdown` is called"""
+        self._remove_stale_socket()
+
+        self.engine.start()
+        self._listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        self._running = True
+        logger.info(f"Model server listening on {self.address}")
+
+        try:
+            while self._running:
+                try:
+                    conn = self._listener.accept()
+                except AuthenticationError:
+                    logger.warning("Rejected model server connection with a bad authkey")
+                    continue
+                except OSError:
+                    if not self._running:
+                        break
+                    raise
+                threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+        finally:
+            self.shutdown()
+
+    def _remove_stale_socket(self):
+        """
+        Unlink a socket left behind by a crashed server, which would make bind() fail. Anything
+        else at the address, or a socket somebody is still listening on, is left alone.
+        """
+        try:
+            st = os.lstat(self.address)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(st.st_mode):
+            raise RuntimeError(f"{self.address} exists and is not a socket; refusing to replace it")
+
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.address)
+        except ConnectionRefusedError:
+            logger.info(f"Removing stale model server socket {self.address}")
+            os.unlink(self.address)
+            return
+        finally:
+            probe.close()
+        raise RuntimeError(f"Another model server is already listening on {self.address}")
+
+    def shutdown(self):
+        self._running = False
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        self.engine.stop()
+
+    def _handle_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    if request.get("method") == "generate_stream":
+                        self._stream(conn, request.get("kwargs", {}), request.get("timeout"))
+                    elif request.get("method") == "generate":
+                        conn.send(self._generate(conn, request.get("kwargs", {}), request.get("timeout")))
+                    else:
+                        conn.send(self._dispatch(request))
+                except (BrokenPipeError, OSError):
+                    return
+
+    def _client_gone(self, conn) -> bool:
+        """
+        Clients wait for the reply before sending anything else, so a readable connection
+        means the client closed it (e.g. after timing out)
+        """
+        try:
+            return conn.poll()
+        except (EOFError, OSError):
+            return True
+
+    def _check_request_kwargs(self, kwargs: Dict[str, Any]):
+        if not isinstance(kwargs, dict):
+            raise TypeError(f"kwargs must be a dict, got {type(kwargs).__name__}")
+        unknown = sorted(set(kwargs) - set(self.REQUEST_FIELDS))
+        if unknown:
+            raise ValueError(f"Unknown generation arguments: {unknown}. Available: {list(self.REQUEST_FIELDS)}")
+
+    def _generate(self, conn, kwargs: Dict[str, Any], timeout: Optional[float]) -> Dict[str, Any]:
+        """
+        Run a generate request under the client's timeout. The request is cancelled as soon as
+        the client hangs up, so an abandoned request does not hold a batch slot.
+        """
+        try:
+            self._check_request_kwargs(kwargs)
+            request = self.engine.enqueue(timeout=timeout, **kwargs)
+        except Exception as e:
+            logger.error(f"Model server request 'generate' failed: {e}")
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        try:
+            while not wait([request.future], timeout=self.POLL_INTERVAL).done:
+                if self._client_gone(conn):
+                    raise ConnectionAbortedError("Client closed the connection")
+            return {"ok": True, "result": request.future.result()}
+        except ConnectionAbortedError:
+            raise
+        except Exception as e:
+            logger.error(f"Model server request 'generate' failed: {e}")
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+        finally:
+            request.cancelled = True
+
+    def _stream(self, conn, kwargs: Dict[str, Any], timeout: Optional[float] = None):
+        """Send one message per text chunk, then a final `done` message"""
+        try:
+            self._check_request_kwargs(kwargs)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Model server stream failed: {e}")
+            conn.send({"ok": False, "error": f"{type(e).__name__}: {e}"})
+            return
+        # `timeout` bounds the wait for each chunk, as it does on the client
+        chunks = self.engine.stream(timeout=timeout, **kwargs)
+        try:
+            for chunk in chunks:
+                if self._client_gone(conn):
+                    raise ConnectionAbortedError("Client closed the stream")
+                conn.send({"ok": True, "chunk": chunk})
+        except TimeoutError as e:
+            logger.error(f"Model server stream failed: {e}")
+            conn.send({"ok": False, "error": f"{type(e).__name__}: {e}"})
+            return
+        except (BrokenPipeError, OSError):
+            raise
+        except Exception as e:
+            logger.error(f"Model server stream failed: {e}")
+            conn.send({"ok": False, "error": f"{type(e).__name__}: {e}"})
+            return
+        finally:
+            # If the stream did not run to completion (failed send, client gone, timeout), closing it
+            # cancels the request in the engine
+            chunks.close()
+        conn.send({"ok": True, "done": True})
+
+    def _dispatch(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        method = request.get("method")
+        kwargs = request.get("kwargs", {})
+        try:
+            if method == "info":
+                result = self.generator.get_model_info()
+            elif method == "ping":
+                result = True
+            else:
+                raise ValueError(
+                    f"Unknown method: {method}. Available: ['generate', 'generate_stream', 'info', 'ping']"
+                )
+            return {"ok": True, "result": result}
+        except Exception as e:
+            logger.error(f"Model server request '{method}' failed: {e}")
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a Transformer model over a local Unix socket")
+    parser.add_argument('model_path', help='Path to trained model')
+    parser.add_argument('--socket', default=None,
+                        help='Socket path (defaults to $GENERATION_SERVER_SOCKET, else model.sock in the private runtime dir)')
+    parser.add_argument('--device', default='auto')
+    parser.add_argument('--max-batch-size', type=int, default=int(os.environ.get('GENERATION_MAX_BATCH_SIZE', 8)))
+    parser.add_argument('--load-in-8bit', action='store_true',
+                        default=os.environ.get('GENERATION_LOAD_IN_8BIT', '0') == '1')
+    parser.add_argument('--prefix-cache-mb', type=int, default=int(os.environ.get('GENERATION_PREFIX_CACHE_MB', 256)),
+                        help='Byte budget of the prompt prefix KV cache in MiB (0 disables it)')
+    parser.add_argument('--compile', action='store_true',
+                        default=os.environ.get('GENERATION_COMPILE', '0') == '1',
+                        help='Serve through torch.compile\'d fixed-shape graphs, compiled before accepting requests')
+    parser.add_argument('--compile-max-prompt-len', type=int, default=DEFAULT_MAX_PROMPT_LEN,
+                        help='Longest prompt the compiled graphs accept; also bounds the prefill buckets warmed up')
+    parser.add_argument('--compile-max-new-tokens', type=int, default=DEFAULT_MAX_NEW_TOKENS,
+                        help='Longest completion the compiled KV cache holds after the longest prompt')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    generator = TransformerGenerator(
+        args.model_path,
+        device=args.device,
+        load_in_8bit=args.load_in_8bit,
+        prefix_cache_max_bytes=args.prefix_cache_mb * 2**20,
+        compile_model=args.compile,
+        compile_batch_size=args.max_batch_size,
+        compile_max_prompt_len=args.compile_max_prompt_len,
+        compile_max_new_tokens=args.compile_max_new_tokens,
+    )
+    server = ModelServer(generator, address=args.socket, max_batch_size=args.max_batch_size)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Model server stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Prompt Prefix KV Cache
+Reuses the past_key_values of earlier prompts that share a token prefix with a new one
+"""
+
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+PastKeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+@dataclass
+class _PrefixEntry:
+    token_ids: List[int]
+    past_key_values: PastKeyValues
+    nbytes: int
+    block_hashes: List[bytes]
+
+
+class PrefixCache:
+    """
+    LRU cache of per-layer K/V for recently seen prompts, bounded by a byte budget.
+
+    Prompts are hashed block by block. Block k's digest chains the digest of blocks 0..k-1 with
+    the tokens of block k, so each digest identifies a whole token prefix. Every stored prompt is
+    indexed under all of its block digests. A lookup walks the new prompt's digests from the
+    longest down, and the first hit is extended token by token to the exact common prefix. The
+    matched K/V are returned as views sliced to that length, and only the remaining suffix has
+    to be prefilled.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        if block_size < 1:
+            raise ValueError(f"block_size must be positive, got {block_size}")
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+
+        self._entries: "OrderedDict[bytes, _PrefixEntry]" = OrderedDict()
+        self._index: Dict[bytes, bytes] = {}  # block digest -> key of the entry holding that prefix
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def _block_hashes(self, token_ids: List[int]) -> List[bytes]:
+        """Chained digests of token_ids[:block_size], token_ids[:2 * block_size], ..."""
+        hashes = []
+        digest = b""
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block = array("I", token_ids[start:start + self.block_size]).tobytes()
+            digest = hashlib.blake2b(digest + block, digest_size=16).digest()
+            hashes.append(digest)
+        return hashes
+
+    def lookup(self, token_ids: List[int]) -> Tuple[int, Optional[PastKeyValues]]:
+        """
+        Longest cached prefix of `token_ids`, as (length, past_key_values). At least the last
+        token is always left out so the caller still gets logits for it.
+        """
+        max_length = len(token_ids) - 1
+        block_hashes = self._block_hashes(token_ids[:max_length])
+        with self._lock:
+            for num_blocks in range(len(block_hashes), 0, -1):
+                key = self._index.get(block_hashes[num_blocks - 1])
+                if key is None:
+                    continue
+
+                entry = self._entries[key]
+                self._entries.move_to_end(key)
+
+                # The block digest guarantees a match up to here; extend to the exact common prefix
+                length = num_blocks * self.block_size
+                limit = min(len(entry.token_ids), max_length)
+                while length < limit and entry.token_ids[length] == token_ids[length]:
+                    length += 1
+
+                self.hits += 1
+                self.reused_tokens += length
+                past_key_values = tuple(
+                    (key_states[:, :, :length], value_states[:, :, :length])
+                    for key_states, value_states in entry.past_key_values
+                )
+                return length, past_key_values
+
+            self.misses += 1
+            return 0, None
+
+    def insert(self, token_ids: List[int], past_key_values: PastKeyValues):
+        """Store the K/V of a prefilled prompt (batch size 1, covering exactly `token_ids`)"""
+        block_hashes = self._block_hashes(token_ids)
+        if not block_hashes:
+            return
+
+        nbytes = sum(
+            key_states.numel() * key_states.element_size() + value_states.numel() * value_states.element_size()
+            for key_states, value_states in past_key_values
+        )
+        if nbytes > self.max_bytes:
+            return
+
+        key = hashlib.blake2b(array("I", token_ids).tobytes(), digest_size=16).digest()
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+
+            self._entries[key] = _PrefixEntry(list(token_ids), past_key_values, nbytes, block_hashes)
+            for block_hash in block_hashes:
+                self._index[block_hash] = key
+            self.nbytes += nbytes
+
+            while self.nbytes > self.max_bytes:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        key, entry = self._entries.popitem(last=False)
+        self.nbytes -= entry.nbytes
+        for block_hash in entry.block_hashes:
+            if self._index.get(block_hash) == key:
+                # Another cached prompt may share this prefix; let it serve future lookups
+                replacement = next(
+                    (other_key for other_key, other in reversed(self._entries.items())
+                     if block_hash in other.block_hashes),
+                    None,
+                )
+                if replacement is None:
+                    del self._index[block_hash]
+                else:
+                    self._index[block_hash] = replacement
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._index.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "reused_tokens": self.reused_tokens,
+        }
@@ -0,0 +1,92 @@
+"""
+Checkpoint I/O: safetensors weights bound straight from a memory-mapped file
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+from typing import Dict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+WEIGHTS_NAME = "pytorch_model.bin"
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def save_safetensors(state_dict: Dict[str, torch.Tensor], path: str):
+    """Write a state dict in the safetensors format"""
+    from safetensors.torch import save_file
+
+    # safetensors refuses shared or strided storage, so write contiguous CPU copies
+    tensors = {name: tensor.detach().contiguous().cpu() for name, tensor in state_dict.items()}
+
+    # Write then rename, so a file that is currently mmap'd (e.g. by a running worker) is never truncated
+    tmp_path = f"{path}.tmp"
+    save_file(tensors, tmp_path, metadata={"format": "pt"})
+    os.replace(tmp_path, path)
+
+
+def load_safetensors_mmap(path: str) -> Dict[str, torch.Tensor]:
+    """
+    Map a safetensors file and return tensors that view the mapping without copying.
+
+    The file is mapped copy-on-write, so every process loading the same checkpoint shares its
+    page-cache pages until a tensor is written to. Pages are only read in when first touched.
+    """
+    with open(path, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    data_start = 8 + header_size
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        if info["dtype"] not in _SAFETENSORS_DTYPES:
+            raise ValueError(f"Unsupported safetensors dtype {info['dtype']} for tensor {name}")
+
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        shape = info["shape"]
+        numel = (end - begin) // torch.empty((), dtype=dtype).element_size()
+
+        if numel == 0:
+            state_dict[name] = torch.empty(shape, dtype=dtype)
+            continue
+        # frombuffer keeps a reference to the mapping, so it stays open while any tensor is alive
+        tensor = torch.frombuffer(buffer, dtype=dtype, count=numel, offset=data_start + begin)
+        state_dict[name] = tensor.view(shape)
+
+    return state_dict
+
+
+def load_checkpoint_state_dict(model_path: str) -> Dict[str, torch.Tensor]:
+    """Load weights from `model_path`, preferring the mmap'd safetensors file over pytorch_model.bin"""
+    safe_path = os.path.join(model_path, SAFE_WEIGHTS_NAME)
+    if os.path.exists(safe_path):
+        return load_safetensors_mmap(safe_path)
+
+    weights_path = os.path.join(model_path, WEIGHTS_NAME)
+    if os.path.exists(weights_path):
+        logger.info(f"No {SAFE_WEIGHTS_NAME} in {model_path}, falling back to {WEIGHTS_NAME}")
+        return torch.load(weights_path, map_location="cpu")
+
+    raise FileNotFoundError(f"No {SAFE_WEIGHTS_NAME} or {WEIGHTS_NAME} found in {model_path}")
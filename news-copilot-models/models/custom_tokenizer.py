@@ -2,12 +2,20 @@
 Custom Tokenizer Implementation
 """
 
+import io
+import glob
+import gzip
 import json
 import os
 import re
-from typing import List, Dict, Optional, Union, Tuple
+import tempfile
+from typing import List, Dict, Iterable, Iterator, Optional, Union, Tuple
+import numpy as np
 import sentencepiece as spm
 
+TOKENIZER_MODEL_NAME = "tokenizer.model"
+TOKENIZER_VOCAB_NAME = "vocab.json"
+
 
 class CustomTokenizer:
     """Custom tokenizer using SentencePiece"""
@@ -33,10 +41,36 @@ class CustomTokenizer:
         self.unk_token_id = 0
         self.pad_token_id = None  # Transformer doesn't use padding by default
         
+        # Special token -> id for the tokens present in the loaded model
+        self.special_token_ids: Dict[str, int] = {}
+        # Full piece -> id table, built (or read from vocab.json) on first use
+        self._vocab: Optional[Dict[str, int]] = None
+        self._vocab_file: Optional[str] = None
+        
         self.sp_model = None
         if model_path and os.path.exists(model_path):
             self.load_model(model_path)
     
+    def _trainer_options(self, vocab_size: int, character_coverage: float, model_type: str) -> Dict[str, object]:
+        """SentencePieceTrainer arguments shared by every way of training"""
+        return dict(
+            vocab_size=vocab_size,
+            character_coverage=character_coverage,
+            model_type=model_type,
+            bos_id=self.bos_token_id,
+            eos_id=self.eos_token_id,
+            unk_id=self.unk_token_id,
+            bos_piece=self.bos_token,
+            eos_piece=self.eos_token,
+            unk_piece=self.unk_token,
+            user_defined_symbols=self.pad_token,
+            byte_fallback=True,
+            split_digits=True,
+            allow_whitespace_only_pieces=True,
+            remove_extra_whitespaces=False,
+            normalization_rule_name="identity",
+        )
+    
     def train(
         self, 
         input_files: List[str], 
@@ -46,42 +80,76 @@ class CustomTokenizer:
         model_type: str = 'bpe'
     ):
         """Train SentencePiece model"""
-        input_argument = ','.join(input_files)
-        
-        cmd = f"""
-        --input={input_argument}
-        --model_prefix={model_prefix}
-        --vocab_size={vocab_size}
-        --character_coverage={character_coverage}
-        --model_type={model_type}
-        --bos_id={self.bos_token_id}
-        --eos_id={self.eos_token_id}
-        --unk_id={self.unk_token_id}
-        --bos_piece={self.bos_token}
-        --eos_piece={self.eos_token}
-        --unk_piece={self.unk_token}
-        --user_defined_symbols={self.pad_token}
-        --byte_fallback=true
-        --split_digits=true
-        --allow_whitespace_only_pieces=true
-        --remove_extra_whitespaces=false
-        --normalization_rule_name=identity
-        """.replace('\n', ' ').strip()
-        
-        spm.SentencePieceTrainer.train(cmd)
+        spm.SentencePieceTrainer.train(
+            input=','.join(input_files),
+            model_prefix=model_prefix,
+            **self._trainer_options(vocab_size, character_coverage, model_type)
+        )
         self.load_model(f"{model_prefix}.model")
     
-    def load_model(self, model_path: str):
-        """Load trained SentencePiece model"""
+    def train_from_iterator(
+        self,
+        sentences: Iterable[str],
+        vocab_size: int = 32000,
+        character_coverage: float = 0.9995,
+        model_type: str = 'bpe',
+        input_sentence_size: int = 10_000_000,
+        shuffle_input_sentence: bool = True,
+        num_threads: Optional[int] = None
+    ):
+        """
+        Train SentencePiece model from a stream of sentences without writing them to disk.
+        
+        SentencePiece keeps a uniform sample of `input_sentence_size` sentences (reservoir sampling
+        when `shuffle_input_sentence`, otherwise the first ones), so memory is bounded by the
+        sample, not the corpus. The model proto is written to memory and loaded directly.
+        """
+        model_writer = io.BytesIO()
+        spm.SentencePieceTrainer.train(
+            sentence_iterator=iter(sentences),
+            model_writer=model_writer,
+            input_sentence_size=input_sentence_size,
+            shuffle_input_sentence=shuffle_input_sentence,
+            num_threads=num_threads or os.cpu_count() or 1,
+            **self._trainer_options(vocab_size, character_coverage, model_type)
+        )
+        self.load_model_proto(model_writer.getvalue())
+    
+    def load_model(self, model_path: str, special_token_ids: Optional[Dict[str, int]] = None):
+        """Load trained SentencePiece model (`special_token_ids` as saved by `save_pretrained`)"""
         self.sp_model = spm.SentencePieceProcessor()
         self.sp_model.load(model_path)
-        
+        self._init_vocab(special_token_ids)
+    
+    def load_model_proto(self, model_proto: bytes, special_token_ids: Optional[Dict[str, int]] = None):
+        """Load a serialized SentencePiece model (the contents of a .model file)"""
+        self.sp_model = spm.SentencePieceProcessor()
+        self.sp_model.load_from_serialized_proto(model_proto)
+        self._init_vocab(special_token_ids)
+    
+    def _init_vocab(self, special_token_ids: Optional[Dict[str, int]] = None):
         # Update vocab size with actual model size
         self.vocab_size = self.sp_model.get_piece_size()
+        self._vocab = None
+        self._vocab_file = None
         
-        # Find pad token ID if it exists
-        if self.pad_token in [self.sp_model.id_to_piece(i) for i in range(self.vocab_size)]:
-            self.pad_token_id = self.sp_model.piece_to_id(self.pad_token)
+        if special_token_ids is None:
+            special_token_ids = self._lookup_special_token_ids()
+        self.special_token_ids = dict(special_token_ids)
+        
+        # Use the pad token only if the model has it
+        self.pad_token_id = self.special_token_ids.get(self.pad_token)
+    
+    def _lookup_special_token_ids(self) -> Dict[str, int]:
+        """Ids of the special tokens in the model, one piece_to_id call each"""
+        unk_id = self.sp_model.unk_id()
+        special_token_ids = {}
+        for token in (self.bos_token, self.eos_token, self.unk_token, self.pad_token):
+            token_id = self.sp_model.piece_to_id(token)
+            # piece_to_id maps pieces missing from the vocab to unk_id
+            if token_id != unk_id or token == self.sp_model.id_to_piece(unk_id):
+                special_token_ids[token] = token_id
+        return special_token_ids
     
     def encode(
         self, 
@@ -97,7 +165,22 @@ class CustomTokenizer:
         
         # Encode text
         tokens = self.sp_model.encode(text, out_type=int)
+        tokens = self._add_special_tokens_and_truncate(tokens, add_special_tokens, max_length, truncation)
+        
+        # Padding
+        if padding and max_length and self.pad_token_id is not None:
+            if len(tokens) < max_length:
+                tokens = tokens + [self.pad_token_id] * (max_length - len(tokens))
         
+        return tokens
+    
+    def _add_special_tokens_and_truncate(
+        self,
+        tokens: List[int],
+        add_special_tokens: bool,
+        max_length: Optional[int],
+        truncation: bool
+    ) -> List[int]:
         # Add special tokens
         if add_special_tokens:
             tokens = [self.bos_token_id] + tokens + [self.eos_token_id]
@@ -111,11 +194,6 @@ class CustomTokenizer:
                 else:
                     tokens = tokens[:max_length]
         
-        # Padding
-        if padding and max_length and self.pad_token_id is not None:
-            if len(tokens) < max_length:
-                tokens = tokens + [self.pad_token_id] * (max_length - len(tokens))
-        
         return tokens
     
     def decode(self, token_ids: List[int], skip_special_tokens: bool = True) -> str:
@@ -132,6 +210,12 @@ class CustomTokenizer:
         
         return self.sp_model.decode(token_ids)
     
+    def decode_stream(self, skip_special_tokens: bool = True) -> "IncrementalDecoder":
+        """Create a decoder that turns token IDs pushed one at a time into text deltas"""
+        if self.sp_model is None:
+            raise ValueError("Model not loaded. Call load_model() or train() first.")
+        return IncrementalDecoder(self, skip_special_tokens=skip_special_tokens)
+    
     def batch_encode(
         self,
         texts: List[str],
@@ -139,47 +223,69 @@ class CustomTokenizer:
         max_length: Optional[int] = None,
         padding: bool = True,
         truncation: bool = True,
-        return_attention_mask: bool = True
-    ) -> Dict[str, List[List[int]]]:
-        """Batch encode multiple texts"""
-        all_input_ids = []
-        all_attention_masks = []
+        return_attention_mask: bool = True,
+        padding_side: str = "right",
+        return_tensors: Optional[str] = None,
+        num_threads: int = -1
+    ) -> Dict[str, Union[List[List[int]], np.ndarray, "torch.Tensor"]]:
+        """
+        Batch encode multiple texts (`padding_side="left"` for batched generation).
         
-        for text in texts:
-            input_ids = self.encode(
-                text, 
-                add_special_tokens=add_special_tokens,
-                max_length=max_length,
-                padding=False,  # We'll handle padding after
-                truncation=truncation
-            )
-            all_input_ids.append(input_ids)
+        All texts are tokenized in one native SentencePiece call on `num_threads` threads (-1 uses
+        every core). Padded rows and attention masks are filled in as int64 arrays, and
+        `return_tensors="np"` or `"pt"` returns those arrays (a tensor shares the array's memory)
+        instead of nested lists.
+        """
+        if padding_side not in ("right", "left"):
+            raise ValueError(f"padding_side must be 'right' or 'left', got {padding_side!r}")
+        if return_tensors not in (None, "np", "pt"):
+            raise ValueError(f"Unknown return_tensors: {return_tensors}. Available: [None, 'np', 'pt']")
+        if self.sp_model is None:
+            raise ValueError("Model not loaded. Call load_model() or train() first.")
         
-        # Determine max length for padding
-        if padding and max_length is None:
-            max_length = max(len(ids) for ids in all_input_ids)
+        all_input_ids = self.sp_model.encode(list(texts), out_type=int, num_threads=num_threads)
+        all_input_ids = [
+            self._add_special_tokens_and_truncate(tokens, add_special_tokens, max_length, truncation)
+            for tokens in all_input_ids
+        ]
+        lengths = np.fromiter((len(ids) for ids in all_input_ids), dtype=np.int64, count=len(all_input_ids))
         
-        # Apply padding and create attention masks
-        for i, input_ids in enumerate(all_input_ids):
-            attention_mask = [1] * len(input_ids)
-            
-            if padding and max_length and len(input_ids) < max_length:
-                if self.pad_token_id is not None:
-                    pad_length = max_length - len(input_ids)
-                    input_ids.extend([self.pad_token_id] * pad_length)
-                    attention_mask.extend([0] * pad_length)
-                else:
-                    # If no pad token, use unk token for padding
-                    pad_length = max_length - len(input_ids)
-                    input_ids.extend([self.unk_token_id] * pad_length)
-                    attention_mask.extend([0] * pad_length)
-            
-            all_input_ids[i] = input_ids
-            all_attention_masks.append(attention_mask)
+        if not padding and (return_tensors is None or len(set(lengths.tolist())) > 1):
+            if return_tensors is not None:
+                raise ValueError("return_tensors needs padding=True when the texts have different lengths")
+            result = {"input_ids": all_input_ids}
+            if return_attention_mask:
+                result["attention_mask"] = [[1] * len(ids) for ids in all_input_ids]
+            return result
+        
+        # Rows longer than max_length (truncation=False) widen the whole batch
+        width = int(lengths.max(initial=0))
+        if padding and max_length is not None:
+            width = max(width, max_length)
+        
+        positions = np.arange(width)
+        if padding_side == "left":
+            attention_mask = positions[None, :] >= (width - lengths)[:, None]
+        else:
+            attention_mask = positions[None, :] < lengths[:, None]
         
-        result = {"input_ids": all_input_ids}
+        # If no pad token, use unk token for padding
+        pad_id = self.pad_token_id if self.pad_token_id is not None else self.unk_token_id
+        input_ids = np.full((len(all_input_ids), width), pad_id, dtype=np.int64)
+        # Boolean assignment fills the masked slots in row-major order, i.e. each row's tokens in turn
+        input_ids[attention_mask] = np.fromiter(
+            (token for ids in all_input_ids for token in ids), dtype=np.int64, count=int(lengths.sum())
+        )
+        
+        result = {"input_ids": input_ids}
         if return_attention_mask:
-            result["attention_mask"] = all_attention_masks
+            result["attention_mask"] = attention_mask.astype(np.int64)
+        
+        if return_tensors == "pt":
+            import torch
+            result = {key: torch.from_numpy(value) for key, value in result.items()}
+        elif return_tensors is None:
+            result = {key: value.tolist() for key, value in result.items()}
         
         return result
     
@@ -188,15 +294,17 @@ class CustomTokenizer:
         return self.vocab_size
     
     def get_vocab(self) -> Dict[str, int]:
-        """Get vocabulary as token -> id mapping"""
+        """Get vocabulary as token -> id mapping (cached; do not modify the returned dict)"""
         if self.sp_model is None:
             return {}
         
-        vocab = {}
-        for i in range(self.vocab_size):
-            piece = self.sp_model.id_to_piece(i)
-            vocab[piece] = i
-        return vocab
+        if self._vocab is None:
+            if self._vocab_file is not None:
+                with open(self._vocab_file, "r", encoding="utf-8") as f:
+                    self._vocab = json.load(f)
+            else:
+                self._vocab = {self.sp_model.id_to_piece(i): i for i in range(self.vocab_size)}
+        return self._vocab
     
     def save_pretrained(self, save_directory: str):
         """Save tokenizer to directory"""
@@ -213,17 +321,19 @@ class CustomTokenizer:
             "eos_token_id": self.eos_token_id,
             "unk_token_id": self.unk_token_id,
             "pad_token_id": self.pad_token_id,
+            "special_token_ids": self.special_token_ids,
         }
         
         with open(os.path.join(save_directory, "tokenizer_config.json"), "w") as f:
             json.dump(config, f, indent=2)
         
-        # Copy model file if it exists
         if self.sp_model is not None:
-            import shutil
-            model_path = os.path.join(save_directory, "tokenizer.model")
-            # Note: This assumes the model file is accessible
-            # In practice, you'd need to save the actual model file
+            # The serialized proto is the .model file itself, wherever the model was loaded from
+            with open(os.path.join(save_directory, TOKENIZER_MODEL_NAME), "wb") as f:
+                f.write(self.sp_model.serialized_model_proto())
+            
+            with open(os.path.join(save_directory, TOKENIZER_VOCAB_NAME), "w", encoding="utf-8") as f:
+                json.dump(self.get_vocab(), f, ensure_ascii=False)
     
     @classmethod
     def from_pretrained(cls, model_path: str) -> "CustomTokenizer":
@@ -233,20 +343,149 @@ class CustomTokenizer:
             with open(config_path, "r") as f:
                 config = json.load(f)
             
-            tokenizer = cls(**config)
+            # The *_token_id entries are derived from the model, not constructor arguments
+            init_keys = ("vocab_size", "bos_token", "eos_token", "unk_token", "pad_token")
+            tokenizer = cls(**{key: config[key] for key in init_keys if key in config})
             
             # Load model file
-            model_file = os.path.join(model_path, "tokenizer.model")
+            model_file = os.path.join(model_path, TOKENIZER_MODEL_NAME)
             if os.path.exists(model_file):
-                tokenizer.load_model(model_file)
+                with open(model_file, "rb") as f:
+                    tokenizer.load_model_proto(f.read(), special_token_ids=config.get("special_token_ids"))
+                
+                vocab_file = os.path.join(model_path, TOKENIZER_VOCAB_NAME)
+                if os.path.exists(vocab_file):
+                    tokenizer._vocab_file = vocab_file
             
             return tokenizer
         else:
             # Try to load just the model file
-            model_file = os.path.join(model_path, "tokenizer.model")
+            model_file = os.path.join(model_path, TOKENIZER_MODEL_NAME)
             return cls(model_path=model_file)
 
 
+class IncrementalDecoder:
+    """
+    Incremental detokenizer for streaming generation.
+
+    A SentencePiece piece does not decode the same way on its own as it does in context. The
+    leading "▁" is dropped at the start of a decode, and byte-fallback pieces (<0xE2><0x80>...) only
+    form a character once all of its UTF-8 bytes have arrived. Each delta is therefore the
+    difference between decoding a short window that ends at the newest token and the same window
+    without the unread tokens. Text that ends in an incomplete byte sequence (U+FFFD) is held back
+    until the character is complete. The concatenated deltas equal `decode` of the whole sequence.
+    """
+    
+    def __init__(self, tokenizer: CustomTokenizer, skip_special_tokens: bool = True):
+        self.tokenizer = tokenizer
+        self.special_ids = set()
+        if skip_special_tokens:
+            self.special_ids = {tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.unk_token_id}
+            if tokenizer.pad_token_id is not None:
+                self.special_ids.add(tokenizer.pad_token_id)
+        
+        self.token_ids: List[int] = []
+        self.prefix_offset = 0  # start of the context window
+        self.read_offset = 0  # tokens before this have been emitted
+    
+    def push(self, token_id: int) -> str:
+        """Add one token and return the newly completed text (possibly empty)"""
+        if token_id in self.special_ids:
+            return ""
+        self.token_ids.append(token_id)
+        
+        sp_model = self.tokenizer.sp_model
+        prefix_text = sp_model.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = sp_model.decode(self.token_ids[self.prefix_offset:])
+        
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            delta = new_text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return delta
+        return ""
+    
+    def flush(self) -> str:
+        """Return any held-back text, even if it ends in an incomplete character"""
+        sp_model = self.tokenizer.sp_model
+        prefix_text = sp_model.decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = sp_model.decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+def _expand_corpus_paths(paths: Iterable[str]) -> List[str]:
+    """Files behind a list of files, directories and glob patterns, in a stable order"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.endswith(('.txt', '.jsonl', '.txt.gz', '.jsonl.gz'))
+            ))
+        elif glob.has_magic(path):
+            files.extend(sorted(glob.glob(path)))
+        else:
+            files.append(path)
+    return files
+
+
+def iter_corpus_texts(paths: Iterable[str], split_lines: bool = True) -> Iterator[str]:
+    """
+    Stream non-empty lines from text and JSONL corpus shards (optionally gzipped), one file at a
+    time. JSONL records use the same text/content fields as `load_training_data`. With
+    `split_lines` they are split into lines so that long articles stay under SentencePiece's
+    max_sentence_length; otherwise each record is yielded as one document.
+    """
+    for path in _expand_corpus_paths(paths):
+        opener = gzip.open if path.endswith('.gz') else open
+        is_jsonl = path.endswith(('.jsonl', '.jsonl.gz'))
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                if not is_jsonl:
+                    yield line
+                    continue
+                
+                data = json.loads(line)
+                text = data.get('text', data.get('content', str(data))) if isinstance(data, dict) else str(data)
+                if not split_lines:
+                    yield text
+                    continue
+                for text_line in text.splitlines():
+                    text_line = text_line.strip()
+                    if text_line:
+                        yield text_line
+
+
+def train_tokenizer_from_corpus(
+    corpus_paths: Iterable[str],
+    save_dir: str = "./tokenizer",
+    vocab_size: int = 32000,
+    input_sentence_size: int = 10_000_000,
+    shuffle_input_sentence: bool = True,
+    num_threads: Optional[int] = None,
+    model_type: str = 'bpe'
+) -> CustomTokenizer:
+    """Train a tokenizer over sharded .txt/.jsonl files (or directories/globs of them) in bounded memory"""
+    tokenizer = CustomTokenizer(vocab_size=vocab_size)
+    tokenizer.train_from_iterator(
+        iter_corpus_texts(corpus_paths),
+        vocab_size=vocab_size,
+        model_type=model_type,
+        input_sentence_size=input_sentence_size,
+        shuffle_input_sentence=shuffle_input_sentence,
+        num_threads=num_threads
+    )
+    
+    os.makedirs(save_dir, exist_ok=True)
+    tokenizer.save_pretrained(save_dir)
+    
+    return tokenizer
+
+
 def prepare_training_data(texts: List[str], output_file: str):
     """Prepare text data for SentencePiece training"""
     with open(output_file, 'w', encoding='utf-8') as f:
@@ -265,20 +504,19 @@ def create_custom_tokenizer_from_texts(
 ) -> CustomTokenizer:
     """Create and train a tokenizer from scratch"""
     
-    # Prepare training data
-    training_file = f"{model_name}_training.txt"
-    prepare_training_data(texts, training_file)
-    
-    # Create and train tokenizer
-    tokenizer = CustomTokenizer(vocab_size=vocab_size)
-    tokenizer.train([training_file], model_name, vocab_size=vocab_size)
+    # The training text and SentencePiece's {model_name}.model/.vocab outputs stay in a scratch
+    # directory; save_pretrained writes the model proto into save_dir
+    with tempfile.TemporaryDirectory() as work_dir:
+        # Prepare training data
+        training_file = os.path.join(work_dir, f"{model_name}_training.txt")
+        prepare_training_data(texts, training_file)
+        
+        # Create and train tokenizer
+        tokenizer = CustomTokenizer(vocab_size=vocab_size)
+        tokenizer.train([training_file], os.path.join(work_dir, model_name), vocab_size=vocab_size)
     
     # Save tokenizer
     os.makedirs(save_dir, exist_ok=True)
     tokenizer.save_pretrained(save_dir)
     
-    # Clean up training file
-    if os.path.exists(training_file):
-        os.remove(training_file)
-    
     return tokenizer
@@ -0,0 +1,175 @@
+"""
+Post-training int8 dynamic quantization for CPU inference
+"""
+
+import os
+import json
+import math
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+
+import torch
+import torch.nn as nn
+
+from models.transformer_model import TransformerConfig, TransformerForCausalLM, TransformerAttention, TransformerMLP
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_WEIGHTS_NAME = "pytorch_model_int8.bin"
+QUANTIZATION_CONFIG_NAME = "quantization_config.json"
+
+# Bumped when the quantized module layout changes; older artifacts cannot be loaded into it
+QUANTIZATION_FORMAT_VERSION = 2  # 2: fused gate_up_proj
+
+
+def _quantizable_module_names(model: nn.Module) -> List[str]:
+    """Names of the attention and MLP blocks whose nn.Linear projections get quantized"""
+    return [
+        name for name, module in model.named_modules()
+        if isinstance(module, (TransformerAttention, TransformerMLP))
+    ]
+
+
+def quantize_dynamic_int8(model: TransformerForCausalLM, inplace: bool = False) -> TransformerForCausalLM:
+    """
+    Quantize the q/k/v/o, fused gate_up and down projections to int8 with dynamic activation scales.
+
+    Embeddings, norms and lm_head stay in fp32. Dynamic quantization only runs on CPU and
+    expects an fp32 model.
+    """
+    if any(p.device.type != "cpu" for p in model.parameters()):
+        raise ValueError("int8 dynamic quantization is only supported on CPU")
+
+    model = model.float().eval()
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        qconfig_spec=set(_quantizable_module_names(model)),
+        dtype=torch.qint8,
+        inplace=inplace,
+    )
+
+
+def save_quantized_model(model: TransformerForCausalLM, save_directory: str):
+    """Save a quantized model next to its config as a separate int8 artifact"""
+    os.makedirs(save_directory, exist_ok=True)
+
+    torch.save(model.state_dict(), os.path.join(save_directory, QUANTIZED_WEIGHTS_NAME))
+
+    with open(os.path.join(save_directory, "config.json"), "w") as f:
+        json.dump(model.config.__dict__, f, indent=2)
+
+    quantization_config = {
+        "method": "dynamic",
+        "dtype": "qint8",
+        "format_version": QUANTIZATION_FORMAT_VERSION,
+        "modules": _quantizable_module_names(model),
+    }
+    with open(os.path.join(save_directory, QUANTIZATION_CONFIG_NAME), "w") as f:
+        json.dump(quantization_config, f, indent=2)
+
+    logger.info(f"Quantized model saved to {save_directory}")
+
+
+def load_quantized_model(model_path: str, config: Optional[TransformerConfig] = None) -> TransformerForCausalLM:
+    """Rebuild the quantized module structure and load a saved int8 artifact into it"""
+    if config is None:
+        with open(os.path.join(model_path, "config.json"), "r") as f:
+            config = TransformerConfig(**json.load(f))
+
+    # Skip random init; zero-filled weights give the observers finite ranges and are overwritten below
+    model = TransformerForCausalLM.from_config_empty(config, device="cpu")
+    with torch.no_grad():
+        for param in model.parameters():
+            param.zero_()
+    model = quantize_dynamic_int8(model, inplace=True)
+    state_dict = torch.load(os.path.join(model_path, QUANTIZED_WEIGHTS_NAME), map_location="cpu")
+    model.load_state_dict(state_dict)
+    model.eval()
+
+    return model
+
+
+def is_quantized_checkpoint(model_path: str) -> bool:
+    """Whether `model_path` contains a saved int8 artifact in the current module layout"""
+    if not os.path.exists(os.path.join(model_path, QUANTIZED_WEIGHTS_NAME)):
+        return False
+
+    config_path = os.path.join(model_path, QUANTIZATION_CONFIG_NAME)
+    format_version = 1
+    if os.path.exists(config_path):
+        with open(config_path, "r") as f:
+            format_version = json.load(f).get("format_version", 1)
+    if format_version != QUANTIZATION_FORMAT_VERSION:
+        # Packed int8 weights of separate gate/up projections cannot be concatenated like fp weights
+        logger.warning(
+            f"Ignoring {QUANTIZED_WEIGHTS_NAME} in {model_path}: saved with format version {format_version}, "
+            f"expected {QUANTIZATION_FORMAT_VERSION}. Re-run `model_utils.py quantize` to refresh it."
+        )
+        return False
+    return True
+
+
+def model_size_bytes(model: nn.Module) -> int:
+    """Bytes held by parameters, buffers and packed quantized weights"""
+    state_dict = model.state_dict()
+    total = 0
+    for value in state_dict.values():
+        if isinstance(value, torch.Tensor):
+            total += value.numel() * value.element_size()
+        elif isinstance(value, tuple):
+            # Packed params of quantized Linear layers: (int8 weight, bias)
+            total += sum(t.numel() * t.element_size() for t in value if isinstance(t, torch.Tensor))
+    return total
+
+
+@torch.no_grad()
+def evaluate_loss(model: TransformerForCausalLM, batches: Iterable[Dict[str, torch.Tensor]]) -> float:
+    """Mean causal-LM loss over batches of input_ids/labels (and optional attention_mask)"""
+    model.eval()
+    total_loss = 0.0
+    total_steps = 0
+
+    for batch in batches:
+        batch = {k: v.to("cpu") for k, v in batch.items()}
+        if batch["input_ids"].dim() == 1:
+            batch = {k: v.unsqueeze(0) for k, v in batch.items()}
+        outputs = model(**batch, use_cache=False)
+        total_loss += outputs["loss"].item()
+        total_steps += 1
+
+    if total_steps == 0:
+        raise ValueError("evaluate_loss needs at least one batch")
+    return total_loss / total_steps
+
+
+def quantization_accuracy_check(
+    fp32_model: TransformerForCausalLM,
+    quantized_model: TransformerForCausalLM,
+    batches: Iterable[Dict[str, torch.Tensor]],
+) -> Dict[str, Any]:
+    """Report eval-loss and perplexity drift of the int8 model against its fp32 source"""
+    batches = list(batches)
+    fp32_loss = evaluate_loss(fp32_model.float(), batches)
+    int8_loss = evaluate_loss(quantized_model, batches)
+
+    fp32_size = model_size_bytes(fp32_model)
+    int8_size = model_size_bytes(quantized_model)
+
+    results = {
+        "fp32_loss": fp32_loss,
+        "int8_loss": int8_loss,
+        "loss_drift": int8_loss - fp32_loss,
+        "relative_loss_drift": (int8_loss - fp32_loss) / fp32_loss if fp32_loss else float("nan"),
+        "fp32_perplexity": math.exp(fp32_loss),
+        "int8_perplexity": math.exp(int8_loss),
+        "fp32_size_mb": fp32_size / 2**20,
+        "int8_size_mb": int8_size / 2**20,
+        "compression_ratio": fp32_size / int8_size if int8_size else float("nan"),
+    }
+
+    logger.info(
+        f"int8 eval loss {int8_loss:.4f} vs fp32 {fp32_loss:.4f} "
+        f"(drift {results['loss_drift']:+.4f}), size {results['int8_size_mb']:.1f}MB "
+        f"vs {results['fp32_size_mb']:.1f}MB"
+    )
+    return results
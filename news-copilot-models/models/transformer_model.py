@@ -3,13 +3,49 @@ Advanced Transformer Model Implementation from Scratch
 A complete implementation of state-of-the-art transformer architecture for training purposes.
 """
 
+import os
+import json
 import math
+import logging
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from typing import Optional, Tuple, List, Union
+from contextlib import contextmanager
 from dataclasses import dataclass
 
+from models.checkpoint_io import SAFE_WEIGHTS_NAME, WEIGHTS_NAME, save_safetensors, load_checkpoint_state_dict
+
+logger = logging.getLogger(__name__)
+
+_TORCH_VERSION = tuple(int(v) for v in torch.__version__.split("+")[0].split(".")[:2])
+
+# `enable_gqa` lets SDPA broadcast key/value heads over query groups without copying them
+_SDPA_SUPPORTS_GQA = _TORCH_VERSION >= (2, 5)
+
+# Cleared by `no_init_weights()` while building a model whose weights are about to be loaded
+_INIT_WEIGHTS = True
+
+# `load_state_dict(assign=True)` binds checkpoint tensors to meta-initialized modules without a copy
+_LOAD_STATE_DICT_SUPPORTS_ASSIGN = _TORCH_VERSION >= (2, 1)
+
+# F.rms_norm computes the normalization as one native op instead of a pow/mean/rsqrt/mul chain
+_HAS_FUSED_RMS_NORM = hasattr(F, "rms_norm")
+
+
+@contextmanager
+def no_init_weights():
+    """Skip `post_init` weight initialization for models constructed inside this context"""
+    global _INIT_WEIGHTS
+    previous = _INIT_WEIGHTS
+    _INIT_WEIGHTS = False
+    try:
+        yield
+    finally:
+        _INIT_WEIGHTS = previous
+
 
 @dataclass
 class TransformerConfig:
@@ -33,52 +69,114 @@ class TransformerConfig:
     rope_theta: float = 10000.0
     sliding_window: Optional[int] = 4096
     attention_dropout: float = 0.0
+    output_attentions: bool = False
+    output_hidden_states: bool = False
+    use_return_dict: bool = True
+    attn_implementation: str = "eager"  # "eager", "sdpa"
     
     def __post_init__(self):
         if self.head_dim is None:
             self.head_dim = self.hidden_size // self.num_attention_heads
+        if self.attn_implementation not in ("eager", "sdpa"):
+            raise ValueError(
+                f"Unknown attn_implementation: {self.attn_implementation}. Available: ['eager', 'sdpa']"
+            )
 
 
 class TransformerRMSNorm(nn.Module):
-    """RMS Normalization layer"""
+    """
+    RMS Normalization layer.
+
+    With `residual`, the residual add is folded into the norm: returns (norm(hidden_states +
+    residual), hidden_states + residual), so the sum is materialized once and reused as the next
+    residual. Uses the single native F.rms_norm op where available (it upcasts half-precision
+    inputs internally); under torch.compile the add and the norm fuse into one kernel.
+    """
     
     def __init__(self, hidden_size: int, eps: float = 1e-6):
         super().__init__()
         self.weight = nn.Parameter(torch.ones(hidden_size))
         self.variance_epsilon = eps
 
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, residual=None):
+        """
+        Normalize `hidden_states`, or with `residual` normalize `hidden_states + residual` and also
+        return that sum as the new residual stream. Taking the add here is what lets torch.compile
+        (CompiledDecoder) fuse add + norm into one kernel; in eager mode they stay separate
+        kernels. As before, the add runs in the activation dtype and the normalization in float32.
+        """
+        if residual is not None:
+            hidden_states = hidden_states + residual
+            residual = hidden_states
+
         input_dtype = hidden_states.dtype
-        hidden_states = hidden_states.to(torch.float32)
-        variance = hidden_states.pow(2).mean(-1, keepdim=True)
-        hidden_states = hidden_states * torch.rsqrt(variance + self.variance_epsilon)
-        return self.weight * hidden_states.to(input_dtype)
+        normed = hidden_states.to(torch.float32)
+        if _HAS_FUSED_RMS_NORM:
+            normed = F.rms_norm(normed, (normed.shape[-1],), eps=self.variance_epsilon)
+        else:
+            variance = normed.pow(2).mean(-1, keepdim=True)
+            normed = normed * torch.rsqrt(variance + self.variance_epsilon)
+        normed = self.weight * normed.to(input_dtype)
+
+        return normed if residual is None else (normed, residual)
 
 
 class TransformerRotaryEmbedding(nn.Module):
-    """Rotary Position Embedding (RoPE)"""
+    """
+    Rotary Position Embedding (RoPE).
+
+    One instance is owned by TransformerModel and shared by every layer. The cos/sin tables are
+    computed once in the model's compute dtype, grown lazily in `chunk_size` steps up to the
+    longest sequence seen, and indexed by position_ids once per forward pass.
+    """
     
-    def __init__(self, dim: int, max_position_embeddings: int = 2048, base: float = 10000):
+    def __init__(self, dim: int, max_position_embeddings: int = 2048, base: float = 10000, chunk_size: int = 2048):
         super().__init__()
         self.dim = dim
         self.max_position_embeddings = max_position_embeddings
         self.base = base
-        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2).float() / self.dim))
+        self.chunk_size = chunk_size
+        self._init_buffers(dtype=torch.get_default_dtype())
+
+    def _init_buffers(self, device=None, dtype=None):
+        """(Re)build inv_freq and the first chunk of the cos/sin tables, e.g. after meta-device construction"""
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, device=device).float() / self.dim))
         self.register_buffer("inv_freq", inv_freq, persistent=False)
+        self._set_cos_sin_cache(
+            min(self.chunk_size, self.max_position_embeddings), device=inv_freq.device, dtype=dtype
+        )
 
     @torch.no_grad()
-    def forward(self, x, seq_len=None):
-        # x: [bs, num_attention_heads, seq_len, head_size]
-        if seq_len is None:
-            seq_len = x.shape[-2]
-        
-        t = torch.arange(seq_len, device=x.device).type_as(self.inv_freq)
-        freqs = torch.einsum("i,j->ij", t, self.inv_freq)
+    def _set_cos_sin_cache(self, seq_len: int, device, dtype):
+        self.max_seq_len_cached = seq_len
+        # Always build the table in fp32 (inv_freq may have been cast with the model) and downcast once
+        inv_freq = 1.0 / (self.base ** (torch.arange(0, self.dim, 2, device=device, dtype=torch.float32) / self.dim))
+        t = torch.arange(seq_len, device=device, dtype=torch.float32)
+        freqs = torch.outer(t, inv_freq)
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        cos = emb.cos()
-        sin = emb.sin()
-        return cos.to(dtype=x.dtype), sin.to(dtype=x.dtype)
+        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
+        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+
+    @torch.no_grad()
+    def forward(self, x, position_ids, seq_len=None):
+        """
+        x: [bs, seq_len, hidden] (only its dtype and device are used); position_ids: [bs, seq_len].
+        Returns cos, sin of shape [bs, seq_len, dim]. `seq_len` bounds the largest position id.
+        """
+        if seq_len is None:
+            seq_len = int(position_ids.max()) + 1
+        
+        if (
+            seq_len > self.max_seq_len_cached
+            or self.cos_cached.dtype != x.dtype
+            or self.cos_cached.device != x.device
+        ):
+            new_len = max(seq_len, self.max_seq_len_cached)
+            new_len = math.ceil(new_len / self.chunk_size) * self.chunk_size
+            self._set_cos_sin_cache(new_len, device=x.device, dtype=x.dtype)
+        
+        return self.cos_cached[position_ids], self.sin_cached[position_ids]
 
 
 def rotate_half(x):
@@ -88,10 +186,16 @@ def rotate_half(x):
     return torch.cat((-x2, x1), dim=-1)
 
 
-def apply_rotary_pos_emb(q, k, cos, sin, position_ids):
-    """Apply rotary position embedding to query and key tensors."""
-    cos = cos[position_ids].unsqueeze(1)  # [seq_len, dim] -> [batch_size, 1, seq_len, dim]
-    sin = sin[position_ids].unsqueeze(1)
+def apply_rotary_pos_emb(q, k, cos, sin, position_ids=None):
+    """
+    Apply rotary position embedding to query and key tensors. `cos`/`sin` are either full
+    [seq_len, dim] tables indexed with `position_ids`, or already gathered [batch_size, seq_len, dim].
+    """
+    if position_ids is not None:
+        cos = cos[position_ids]
+        sin = sin[position_ids]
+    cos = cos.unsqueeze(1)  # [batch_size, seq_len, dim] -> [batch_size, 1, seq_len, dim]
+    sin = sin.unsqueeze(1)
     q_embed = (q * cos) + (rotate_half(q) * sin)
     k_embed = (k * cos) + (rotate_half(k) * sin)
     return q_embed, k_embed
@@ -109,6 +213,153 @@ def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     return hidden_states.reshape(batch, num_key_value_heads * n_rep, slen, head_dim)
 
 
+class KVCache:
+    """
+    Base class for cache objects shared by all decoder layers and indexed by `layer_idx`.
+
+    `get_seq_length` is the number of positions processed so far (the position offset of the next
+    token); `get_cached_length` is the number of key/value entries actually retained, which is
+    smaller when old entries have been evicted.
+    """
+    
+    def __bool__(self):
+        # An empty cache behaves like "no past" for prepare_inputs_for_generation
+        return self.get_seq_length() > 0
+    
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        raise NotImplementedError
+    
+    def get_cached_length(self, layer_idx: int = 0) -> int:
+        return self.get_seq_length(layer_idx)
+    
+    def update(
+        self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Store new states and return the keys/values the current step attends to"""
+        raise NotImplementedError
+    
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        raise NotImplementedError
+
+
+class StaticKVCache(KVCache):
+    """
+    Preallocated key/value cache for decoding.
+
+    Holds one [batch_size, num_key_value_heads, max_cache_len, head_dim] buffer per layer for keys
+    and values. New states are written in place at a per-layer cursor and attention receives a view
+    of the filled prefix, so no history is copied while decoding and memory use is fixed up front.
+    """
+    
+    def __init__(
+        self,
+        config: TransformerConfig,
+        batch_size: int,
+        max_cache_len: int,
+        device: Optional[torch.device] = None,
+        dtype: torch.dtype = torch.float32,
+    ):
+        self.batch_size = batch_size
+        self.max_cache_len = max_cache_len
+        cache_shape = (batch_size, config.num_key_value_heads, max_cache_len, config.head_dim)
+        self.key_cache = [torch.zeros(cache_shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        self.value_cache = [torch.zeros(cache_shape, dtype=dtype, device=device) for _ in range(config.num_hidden_layers)]
+        self._seen_tokens = [0] * config.num_hidden_layers
+    
+    def __len__(self):
+        return len(self.key_cache)
+    
+    @property
+    def nbytes(self) -> int:
+        """Total bytes reserved by the key and value buffers"""
+        return sum(t.numel() * t.element_size() for t in self.key_cache + self.value_cache)
+    
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        """Number of positions already written for a layer"""
+        return self._seen_tokens[layer_idx]
+    
+    def update(
+        self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Write new states at the layer cursor and return views of the filled prefix"""
+        start = self._seen_tokens[layer_idx]
+        end = start + key_states.shape[-2]
+        if end > self.max_cache_len:
+            raise ValueError(
+                f"StaticKVCache overflow: layer {layer_idx} needs {end} positions but max_cache_len is"
+                f" {self.max_cache_len}"
+            )
+        
+        self.key_cache[layer_idx][:, :, start:end].copy_(key_states)
+        self.value_cache[layer_idx][:, :, start:end].copy_(value_states)
+        self._seen_tokens[layer_idx] = end
+        
+        return self.key_cache[layer_idx][:, :, :end], self.value_cache[layer_idx][:, :, :end]
+    
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """Reorder the batch dimension in place (beam search)"""
+        for layer_idx in range(len(self.key_cache)):
+            device = self.key_cache[layer_idx].device
+            self.key_cache[layer_idx].copy_(self.key_cache[layer_idx].index_select(0, beam_idx.to(device)))
+            self.value_cache[layer_idx].copy_(self.value_cache[layer_idx].index_select(0, beam_idx.to(device)))
+    
+    def reset(self):
+        """Rewind every layer cursor so the buffers can be reused for a new request"""
+        self._seen_tokens = [0] * len(self._seen_tokens)
+
+
+class SlidingWindowKVCache(KVCache):
+    """
+    Rolling key/value cache for sliding-window attention.
+
+    After each update only the last `sliding_window - 1` entries per layer are kept: the next query
+    cannot see anything older, so KV memory stays bounded no matter how long the article gets.
+    """
+    
+    def __init__(self, config: TransformerConfig):
+        if config.sliding_window is None:
+            raise ValueError("SlidingWindowKVCache requires config.sliding_window to be set")
+        self.sliding_window = config.sliding_window
+        self.key_cache: List[Optional[torch.Tensor]] = [None] * config.num_hidden_layers
+        self.value_cache: List[Optional[torch.Tensor]] = [None] * config.num_hidden_layers
+        self._seen_tokens = [0] * config.num_hidden_layers
+    
+    def __len__(self):
+        return len(self.key_cache)
+    
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        return self._seen_tokens[layer_idx]
+    
+    def get_cached_length(self, layer_idx: int = 0) -> int:
+        if self.key_cache[layer_idx] is None:
+            return 0
+        return self.key_cache[layer_idx].shape[-2]
+    
+    def update(
+        self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return retained + new states for this step, then evict everything outside the window"""
+        if self.key_cache[layer_idx] is not None:
+            key_states = torch.cat([self.key_cache[layer_idx], key_states], dim=2)
+            value_states = torch.cat([self.value_cache[layer_idx], value_states], dim=2)
+        
+        self._seen_tokens[layer_idx] += key_states.shape[-2] - self.get_cached_length(layer_idx)
+        start = max(0, key_states.shape[-2] - (self.sliding_window - 1))
+        self.key_cache[layer_idx] = key_states[:, :, start:]
+        self.value_cache[layer_idx] = value_states[:, :, start:]
+        
+        return key_states, value_states
+    
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        """Reorder the batch dimension (beam search)"""
+        for layer_idx in range(len(self.key_cache)):
+            if self.key_cache[layer_idx] is None:
+                continue
+            device = self.key_cache[layer_idx].device
+            self.key_cache[layer_idx] = self.key_cache[layer_idx].index_select(0, beam_idx.to(device))
+            self.value_cache[layer_idx] = self.value_cache[layer_idx].index_select(0, beam_idx.to(device))
+
+
 class TransformerAttention(nn.Module):
     """Multi-head attention with Grouped Query Attention (GQA) and sliding window attention"""
     
@@ -137,12 +388,6 @@ class TransformerAttention(nn.Module):
         self.v_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=False)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
 
-        self.rotary_emb = TransformerRotaryEmbedding(
-            self.head_dim,
-            max_position_embeddings=self.max_position_embeddings,
-            base=self.rope_theta,
-        )
-
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -151,9 +396,12 @@ class TransformerAttention(nn.Module):
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
         output_attentions: bool = False,
         use_cache: bool = False,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
+        if position_embeddings is None:
+            raise ValueError("position_embeddings (cos, sin) must be computed by TransformerModel.rotary_emb")
 
         query_states = self.q_proj(hidden_states)
         key_states = self.k_proj(hidden_states)
@@ -163,19 +411,50 @@ class TransformerAttention(nn.Module):
         key_states = key_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
         value_states = value_states.view(bsz, q_len, self.num_key_value_heads, self.head_dim).transpose(1, 2)
 
+        # cos/sin were gathered for position_ids once per forward pass and are shared by all layers
+        cos, sin = position_embeddings
+        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
+
+        if isinstance(past_key_value, KVCache):
+            # the cache object stores the new states and returns what this step attends to
+            key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx)
+            past_key_value = past_key_value if use_cache else None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
+
+            past_key_value = (key_states, value_states) if use_cache else None
+
         kv_seq_len = key_states.shape[-2]
-        if past_key_value is not None:
-            kv_seq_len += past_key_value[0].shape[-2]
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
-        query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if self.config.attn_implementation == "sdpa" and not output_attentions:
+            attn_output = self._sdpa_attention(query_states, key_states, value_states, attention_mask)
+            attn_weights = None
+        else:
+            attn_output, attn_weights = self._eager_attention(
+                query_states, key_states, value_states, attention_mask, bsz, q_len, kv_seq_len
+            )
+
+        if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
+            raise ValueError(
+                f"`attn_output` should be of size {(bsz, self.num_heads, q_len, self.head_dim)}, but is"
+                f" {attn_output.size()}"
+            )
+
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+
+        attn_output = self.o_proj(attn_output)
+
+        if not output_attentions:
+            attn_weights = None
 
-        past_key_value = (key_states, value_states) if use_cache else None
+        return attn_output, attn_weights, past_key_value
 
+    def _eager_attention(self, query_states, key_states, value_states, attention_mask, bsz, q_len, kv_seq_len):
+        """Reference attention: explicit score matrix and fp32 softmax"""
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -201,42 +480,79 @@ class TransformerAttention(nn.Module):
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
         attn_output = torch.matmul(attn_weights, value_states)
 
-        if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
-            raise ValueError(
-                f"`attn_output` should be of size {(bsz, self.num_heads, q_len, self.head_dim)}, but is"
-                f" {attn_output.size()}"
-            )
-
-        attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
-
-        attn_output = self.o_proj(attn_output)
-
-        if not output_attentions:
-            attn_weights = None
-
-        return attn_output, attn_weights, past_key_value
+        return attn_output, attn_weights
+
+    def _sdpa_attention(self, query_states, key_states, value_states, attention_mask):
+        """
+        Attention through torch's scaled_dot_product_attention, which picks fused, memory-efficient
+        kernels and never materializes the full score matrix. Without a mask, a multi-token query
+        uses the kernel's built-in causal masking.
+        """
+        q_len = query_states.shape[-2]
+        kwargs = {}
+        if _SDPA_SUPPORTS_GQA:
+            kwargs["enable_gqa"] = self.num_key_value_groups > 1
+        else:
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
+
+        return F.scaled_dot_product_attention(
+            query_states,
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.attention_dropout if self.training else 0.0,
+            is_causal=attention_mask is None and q_len > 1,
+            **kwargs,
+        )
 
 
 class TransformerMLP(nn.Module):
-    """MLP with SwiGLU activation"""
+    """
+    MLP with SwiGLU activation.
+
+    The gate and up projections are stored as one [2 * intermediate_size, hidden_size] weight, so
+    both come out of a single GEMM that reads the input once, then get split.
+    """
     
     def __init__(self, config: TransformerConfig):
         super().__init__()
         self.config = config
         self.hidden_size = config.hidden_size
         self.intermediate_size = config.intermediate_size
-        self.gate_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
-        self.up_proj = nn.Linear(self.hidden_size, self.intermediate_size, bias=False)
+        self.gate_up_proj = nn.Linear(self.hidden_size, 2 * self.intermediate_size, bias=False)
         self.down_proj = nn.Linear(self.intermediate_size, self.hidden_size, bias=False)
         self.act_fn = nn.SiLU()
 
     def forward(self, x):
-        return self.down_proj(self.act_fn(self.gate_proj(x)) * self.up_proj(x))
+        gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.down_proj(self.act_fn(gate) * up)
+
+
+def fuse_gate_up_weights(state_dict: dict) -> dict:
+    """
+    Checkpoints saved before the gate/up fusion have separate mlp.gate_proj/mlp.up_proj weights;
+    concatenate each pair into mlp.gate_up_proj in place (done once by `from_pretrained`)
+    """
+    for gate_key in [key for key in state_dict if key.endswith("mlp.gate_proj.weight")]:
+        prefix = gate_key[:-len("gate_proj.weight")]
+        up_key = f"{prefix}up_proj.weight"
+        if up_key in state_dict:
+            state_dict[f"{prefix}gate_up_proj.weight"] = torch.cat(
+                [state_dict.pop(gate_key), state_dict.pop(up_key)], dim=0
+            )
+    return state_dict
 
 
 class TransformerDecoderLayer(nn.Module):
-    """Transformer decoder layer"""
+    """
+    Transformer decoder layer.
+
+    The residual stream is carried between layers un-added: a layer returns its MLP output and
+    the residual separately, and the next layer's input_layernorm (or the final norm) adds them.
+    Both residual adds therefore go through a norm's `residual` argument. `residual=None` (the
+    first layer) means `hidden_states` is already the full stream.
+    """
     
     def __init__(self, config: TransformerConfig, layer_idx: int):
         super().__init__()
@@ -254,11 +570,15 @@ class TransformerDecoderLayer(nn.Module):
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = False,
+        position_embeddings: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        residual: Optional[torch.Tensor] = None,
         **kwargs,
-    ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
-        residual = hidden_states
-
-        hidden_states = self.input_layernorm(hidden_states)
+    ) -> Tuple[torch.FloatTensor, ...]:
+        if residual is None:
+            residual = hidden_states
+            hidden_states = self.input_layernorm(hidden_states)
+        else:
+            hidden_states, residual = self.input_layernorm(hidden_states, residual)
 
         # Self Attention
         hidden_states, self_attn_weights, present_key_value = self.self_attn(
@@ -268,17 +588,15 @@ class TransformerDecoderLayer(nn.Module):
             past_key_value=past_key_value,
             output_attentions=output_attentions,
             use_cache=use_cache,
+            position_embeddings=position_embeddings,
             **kwargs,
         )
-        hidden_states = residual + hidden_states
 
-        # Fully Connected
-        residual = hidden_states
-        hidden_states = self.post_attention_layernorm(hidden_states)
+        # Fully Connected (both residual adds happen inside the following norm)
+        hidden_states, residual = self.post_attention_layernorm(hidden_states, residual)
         hidden_states = self.mlp(hidden_states)
-        hidden_states = residual + hidden_states
 
-        outputs = (hidden_states,)
+        outputs = (hidden_states, residual)
 
         if output_attentions:
             outputs += (self_attn_weights,)
@@ -297,6 +615,11 @@ class TransformerPreTrainedModel(nn.Module):
     _no_split_modules = ["TransformerDecoderLayer"]
     _skip_keys_device_placement = "past_key_values"
 
+    def post_init(self):
+        """Apply weight initialization, unless the model is being built to receive checkpoint weights"""
+        if _INIT_WEIGHTS:
+            self.apply(self._init_weights)
+
     def _init_weights(self, module):
         std = self.config.initializer_range
         if isinstance(module, nn.Linear):
@@ -308,6 +631,117 @@ class TransformerPreTrainedModel(nn.Module):
             if module.padding_idx is not None:
                 module.weight.data[module.padding_idx].zero_()
 
+    def gradient_checkpointing_enable(self, every_n_layers: int = 1, use_reentrant: bool = False):
+        """
+        Recompute decoder layer activations during backward instead of keeping them. Layers
+        0, N, 2N, ... are checkpointed for `every_n_layers=N`, trading less memory saved for
+        activations against one extra forward of those layers per step.
+        """
+        if not self.supports_gradient_checkpointing:
+            raise ValueError(f"{type(self).__name__} does not support gradient checkpointing")
+        if every_n_layers < 1:
+            raise ValueError(f"every_n_layers must be positive, got {every_n_layers}")
+
+        checkpoint_func = functools.partial(torch.utils.checkpoint.checkpoint, use_reentrant=use_reentrant)
+        for module in self.modules():
+            if isinstance(module, TransformerModel):
+                module.gradient_checkpointing = True
+                module.gradient_checkpointing_every_n_layers = every_n_layers
+                module._gradient_checkpointing_func = checkpoint_func
+
+    def gradient_checkpointing_disable(self):
+        for module in self.modules():
+            if isinstance(module, TransformerModel):
+                module.gradient_checkpointing = False
+
+    @property
+    def is_gradient_checkpointing(self) -> bool:
+        return any(getattr(module, "gradient_checkpointing", False) for module in self.modules())
+
+    def _init_non_persistent_buffers(self, device=None, dtype=None):
+        """Recompute buffers that are not stored in checkpoints"""
+        for module in self.modules():
+            if isinstance(module, TransformerRotaryEmbedding):
+                module._init_buffers(device=device, dtype=dtype or torch.get_default_dtype())
+
+    def save_pretrained(self, save_directory: str, safe_serialization: bool = True):
+        """Save the weights (model.safetensors, or pytorch_model.bin) and config.json"""
+        os.makedirs(save_directory, exist_ok=True)
+
+        if safe_serialization:
+            save_safetensors(self.state_dict(), os.path.join(save_directory, SAFE_WEIGHTS_NAME))
+        else:
+            torch.save(self.state_dict(), os.path.join(save_directory, WEIGHTS_NAME))
+
+        with open(os.path.join(save_directory, "config.json"), "w") as f:
+            json.dump(self.config.__dict__, f, indent=2)
+
+    @classmethod
+    def from_config_empty(cls, config: TransformerConfig, device: Optional[Union[str, torch.device]] = None):
+        """
+        Construct without running any weight initialization.
+
+        The model is built on the meta device, so neither nn.Linear/nn.Embedding's own reset nor
+        `_init_weights` touches memory. With `device`, uninitialized storage is allocated there and
+        must be filled by `load_state_dict` before use.
+        """
+        with torch.device("meta"), no_init_weights():
+            model = cls(config)
+
+        if device is not None:
+            model = model.to_empty(device=device)
+            model._init_non_persistent_buffers(device=device)
+        return model
+
+    @classmethod
+    def from_pretrained(
+        cls,
+        model_path: str,
+        config: Optional[TransformerConfig] = None,
+        device: Union[str, torch.device] = "cpu",
+        torch_dtype: Optional[torch.dtype] = None,
+    ):
+        """
+        Build the model on the meta device and bind checkpoint weights to it.
+
+        Safetensors weights are assigned as views of the mmap'd file, so nothing is copied when the
+        stored dtype and device already match and worker processes share one page-cached copy.
+        `torch_dtype=None` keeps the stored dtype; any other dtype copies the weights it casts.
+        """
+        if config is None:
+            with open(os.path.join(model_path, "config.json"), "r") as f:
+                config = cls.config_class(**json.load(f))
+
+        model = cls.from_config_empty(config)
+
+        state_dict = fuse_gate_up_weights(load_checkpoint_state_dict(model_path))
+        stored_dtype = next((t.dtype for t in state_dict.values() if t.is_floating_point()), None)
+        cast_bytes = sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in state_dict.values()
+            if torch_dtype is not None and tensor.is_floating_point() and tensor.dtype != torch_dtype
+        )
+        if cast_bytes:
+            logger.warning(
+                f"Casting {cast_bytes / 2**20:.0f} MiB of {stored_dtype} weights to {torch_dtype} copies them "
+                f"out of the mmap'd checkpoint, so processes no longer share them. Save the checkpoint in the "
+                f"serving dtype (model_utils.py convert --dtype) to load it without a copy."
+            )
+        state_dict = {
+            name: tensor.to(device=device, dtype=torch_dtype)
+            if torch_dtype is not None and tensor.is_floating_point() else tensor.to(device=device)
+            for name, tensor in state_dict.items()
+        }
+
+        if _LOAD_STATE_DICT_SUPPORTS_ASSIGN:
+            model.load_state_dict(state_dict, assign=True)
+        else:
+            model = model.to_empty(device=device)
+            model.load_state_dict(state_dict)
+
+        model._init_non_persistent_buffers(device=device, dtype=torch_dtype or stored_dtype)
+        return model
+
 
 class TransformerModel(TransformerPreTrainedModel):
     """
@@ -323,15 +757,19 @@ class TransformerModel(TransformerPreTrainedModel):
         self.embed_tokens = nn.Embedding(config.vocab_size, config.hidden_size, self.padding_idx)
         self.layers = nn.ModuleList([TransformerDecoderLayer(config, layer_idx) for layer_idx in range(config.num_hidden_layers)])
         self.norm = TransformerRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
+        self.rotary_emb = TransformerRotaryEmbedding(
+            config.head_dim,
+            max_position_embeddings=config.max_position_embeddings,
+            base=config.rope_theta,
+        )
 
         self.gradient_checkpointing = False
+        self.gradient_checkpointing_every_n_layers = 1
+        self._causal_mask_cache = {}
+        self._causal_mask_cache_size = 64
         # Initialize weights and apply final processing
         self.post_init()
 
-    def post_init(self):
-        """Apply weight initialization"""
-        self.apply(self._init_weights)
-
     def get_input_embeddings(self):
         return self.embed_tokens
 
@@ -371,8 +809,15 @@ class TransformerModel(TransformerPreTrainedModel):
         seq_length_with_past = seq_length
         past_key_values_length = 0
 
-        if past_key_values is not None:
+        cached_length = 0
+
+        if isinstance(past_key_values, KVCache):
+            past_key_values_length = past_key_values.get_seq_length()
+            cached_length = past_key_values.get_cached_length()
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+        elif past_key_values is not None:
             past_key_values_length = past_key_values[0][0].shape[2]
+            cached_length = past_key_values_length
             seq_length_with_past = seq_length_with_past + past_key_values_length
 
         if position_ids is None:
@@ -387,12 +832,16 @@ class TransformerModel(TransformerPreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        if attention_mask is not None and hasattr(self.config, "sliding_window") and self.config.sliding_window is not None:
-            # sliding window attention mask
-            attention_mask = self._update_causal_mask(attention_mask, inputs_embeds, seq_length_with_past)
+        # causal attention mask, offset by the cached prefix and merged with any padding mask
+        attention_mask = self._update_causal_mask(
+            attention_mask, inputs_embeds, past_key_values_length, output_attentions, cached_length
+        )
 
         hidden_states = inputs_embeds
 
+        # rotary cos/sin for these positions, computed once and shared by every layer
+        position_embeddings = self.rotary_emb(hidden_states, position_ids, seq_len=seq_length_with_past)
+
         if self.gradient_checkpointing and self.training:
             if use_cache:
                 use_cache = False
@@ -401,14 +850,24 @@ class TransformerModel(TransformerPreTrainedModel):
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         next_decoder_cache = () if use_cache else None
+        # layers return their MLP output and the residual stream separately (see TransformerDecoderLayer)
+        residual = None
 
         for idx, decoder_layer in enumerate(self.layers):
             if output_hidden_states:
-                all_hidden_states += (hidden_states,)
+                all_hidden_states += (hidden_states if residual is None else hidden_states + residual,)
 
-            past_key_value = past_key_values[idx] if past_key_values is not None else None
+            if isinstance(past_key_values, KVCache):
+                # cache objects are shared by all layers and indexed by layer_idx
+                past_key_value = past_key_values
+            else:
+                past_key_value = past_key_values[idx] if past_key_values is not None else None
 
-            if self.gradient_checkpointing and self.training:
+            if (
+                self.gradient_checkpointing
+                and self.training
+                and idx % self.gradient_checkpointing_every_n_layers == 0
+            ):
                 layer_outputs = self._gradient_checkpointing_func(
                     decoder_layer.__call__,
                     hidden_states,
@@ -417,6 +876,8 @@ class TransformerModel(TransformerPreTrainedModel):
                     past_key_value,
                     output_attentions,
                     use_cache,
+                    position_embeddings,
+                    residual,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -426,23 +887,30 @@ class TransformerModel(TransformerPreTrainedModel):
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    position_embeddings=position_embeddings,
+                    residual=residual,
                 )
 
-            hidden_states = layer_outputs[0]
+            hidden_states, residual = layer_outputs[0], layer_outputs[1]
 
             if use_cache:
-                next_decoder_cache += (layer_outputs[2 if output_attentions else 1],)
+                next_decoder_cache += (layer_outputs[3 if output_attentions else 2],)
 
             if output_attentions:
-                all_self_attns += (layer_outputs[1],)
+                all_self_attns += (layer_outputs[2],)
 
-        hidden_states = self.norm(hidden_states)
+        if residual is None:
+            hidden_states = self.norm(hidden_states)
+        else:
+            hidden_states, _ = self.norm(hidden_states, residual)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
             all_hidden_states += (hidden_states,)
 
         next_cache = next_decoder_cache if use_cache else None
+        if use_cache and isinstance(past_key_values, KVCache):
+            next_cache = past_key_values
 
         return {
             "last_hidden_state": hidden_states,
@@ -451,15 +919,75 @@ class TransformerModel(TransformerPreTrainedModel):
             "attentions": all_self_attns
         }
 
-    def _update_causal_mask(self, attention_mask, input_tensor, seq_length_with_past):
-        # For sliding window attention
-        if self.config.sliding_window is not None:
-            # Create sliding window mask
-            sliding_window = self.config.sliding_window
-            # Implementation would go here
-            pass
-        
-        return attention_mask
+    def _update_causal_mask(
+        self, attention_mask, input_tensor, past_key_values_length, output_attentions=False, cached_length=None
+    ):
+        """
+        Build the additive [batch_size, 1, q_len, kv_len] causal mask. Queries sit at the last
+        q_len of the kv_len key positions, so a cached decode step sees the same mask row as the
+        matching row of a full forward pass. With `config.sliding_window` the mask is banded:
+        a query only sees the previous `sliding_window` positions. A 2D padding mask
+        (1 = keep, 0 = pad) covering all positions seen so far is folded in.
+        """
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # Already expanded by the caller
+            return attention_mask
+
+        batch_size, seq_length = input_tensor.shape[:2]
+        if cached_length is None:
+            cached_length = past_key_values_length
+        kv_length = cached_length + seq_length
+        sliding_window = self.config.sliding_window
+        unpadded = attention_mask is None or bool(attention_mask.all())
+        within_window = sliding_window is None or kv_length <= sliding_window
+
+        # A single query may attend to every retained position, so unpadded decode steps need no mask
+        if seq_length == 1 and unpadded and within_window:
+            return None
+
+        # SDPA applies plain causal masking itself when there is no cached prefix or padding
+        # (output_attentions falls back to eager attention, which needs the explicit mask)
+        sdpa = self.config.attn_implementation == "sdpa" and not output_attentions
+        if sdpa and past_key_values_length == 0 and unpadded and within_window:
+            return None
+
+        causal_mask = self._get_causal_mask(
+            seq_length, kv_length, sliding_window, input_tensor.dtype, input_tensor.device
+        )
+        causal_mask = causal_mask[None, None, :, :].expand(batch_size, 1, -1, -1)
+
+        if attention_mask is not None:
+            padding_mask = attention_mask[:, None, None, -kv_length:] == 0
+            causal_mask = causal_mask.masked_fill(padding_mask, torch.finfo(input_tensor.dtype).min)
+
+        return causal_mask
+
+    def _get_causal_mask(self, q_len, kv_len, sliding_window, dtype, device):
+        """
+        Additive [q_len, kv_len] (banded) causal mask, cached per shape. Query i and key j are
+        `i + kv_len - q_len - j` positions apart whatever the absolute offset, so the mask only
+        depends on the two lengths.
+        """
+        cache_key = (q_len, kv_len, sliding_window, dtype, device)
+        causal_mask = self._causal_mask_cache.get(cache_key)
+        if causal_mask is not None:
+            return causal_mask
+
+        query_positions = torch.arange(kv_len - q_len, kv_len, device=device)
+        key_positions = torch.arange(kv_len, device=device)
+        distance = query_positions[:, None] - key_positions[None, :]
+        masked = distance < 0
+        if sliding_window is not None:
+            masked = masked | (distance >= sliding_window)
+
+        # Use the dtype minimum rather than -inf so fully padded rows do not produce NaNs
+        causal_mask = torch.zeros(q_len, kv_len, dtype=dtype, device=device).masked_fill(masked, torch.finfo(dtype).min)
+
+        # Decode steps produce a new kv_len every token; keep the cache small
+        if len(self._causal_mask_cache) >= self._causal_mask_cache_size:
+            self._causal_mask_cache.clear()
+        self._causal_mask_cache[cache_key] = causal_mask
+        return causal_mask
 
 
 class TransformerForCausalLM(TransformerPreTrainedModel):
@@ -468,6 +996,7 @@ class TransformerForCausalLM(TransformerPreTrainedModel):
 
     def __init__(self, config):
         super().__init__()
+        self.config = config
         self.model = TransformerModel(config)
         self.vocab_size = config.vocab_size
         self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
@@ -475,10 +1004,6 @@ class TransformerForCausalLM(TransformerPreTrainedModel):
         # Initialize weights and apply final processing
         self.post_init()
 
-    def post_init(self):
-        """Apply weight initialization"""
-        self.apply(self._init_weights)
-
     def get_input_embeddings(self):
         return self.model.embed_tokens
 
@@ -586,6 +1111,9 @@ class TransformerForCausalLM(TransformerPreTrainedModel):
 
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
+        if isinstance(past_key_values, KVCache):
+            past_key_values.reorder_cache(beam_idx)
+            return past_key_values
         reordered_past = ()
         for layer_past in past_key_values:
             reordered_past += (
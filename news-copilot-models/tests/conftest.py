@@ -0,0 +1,81 @@
+"""
+Shared fixtures for the CPU parity tests.
+
+The package uses absolute imports (`from models.x import ...`) relative to news-copilot-models,
+so that directory is put on sys.path the same way running a script from it would.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def tiny_config():
+    """A two-layer GQA model small enough to run every test on CPU in milliseconds"""
+    from models.transformer_model import TransformerConfig
+
+    return TransformerConfig(
+        vocab_size=64,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=128,
+        sliding_window=None,
+        pad_token_id=0,
+    )
+
+
+@pytest.fixture
+def tiny_model(tiny_config):
+    from models.transformer_model import TransformerForCausalLM
+
+    torch = pytest.importorskip("torch")
+    torch.manual_seed(0)
+    return TransformerForCausalLM(tiny_config).eval()
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    """A saved tiny model with a SentencePiece tokenizer next to it, as TransformerGenerator loads them"""
+    pytest.importorskip("sentencepiece")
+    torch = pytest.importorskip("torch")
+    from models.custom_tokenizer import create_custom_tokenizer_from_texts
+    from models.transformer_model import TransformerConfig, TransformerForCausalLM
+
+    model_dir = tmp_path_factory.mktemp("tiny_model")
+    texts = [
+        f"Story {i}: the mayor said the new bridge will open in {2020 + i} after the council vote."
+        for i in range(50)
+    ]
+    tokenizer = create_custom_tokenizer_from_texts(texts, vocab_size=80, save_dir=str(model_dir))
+
+    torch.manual_seed(0)
+    config = TransformerConfig(
+        vocab_size=tokenizer.get_vocab_size(),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        sliding_window=None,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    TransformerForCausalLM(config).save_pretrained(str(model_dir))
+    return str(model_dir)
+
+
+@pytest.fixture
+def make_generator(tiny_model_dir):
+    """Build a CPU TransformerGenerator over `tiny_model_dir` with extra constructor options"""
+    from inference.model_inference import TransformerGenerator
+
+    def make(**kwargs):
+        return TransformerGenerator(tiny_model_dir, device="cpu", **kwargs)
+    return make
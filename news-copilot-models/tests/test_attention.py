@@ -0,0 +1,67 @@
+"""SDPA attention against the eager reference: GQA, padding masks, cached decoding and sliding windows"""
+
+import dataclasses
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.transformer_model import TransformerForCausalLM
+
+
+def _eager_and_sdpa(config):
+    torch.manual_seed(0)
+    eager = TransformerForCausalLM(dataclasses.replace(config, attn_implementation="eager")).eval()
+    sdpa = TransformerForCausalLM(dataclasses.replace(config, attn_implementation="sdpa")).eval()
+    sdpa.load_state_dict(eager.state_dict())
+    return eager, sdpa
+
+
+def _left_padded_batch(vocab_size):
+    input_ids = torch.randint(1, vocab_size, (2, 10))
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[1, :4] = 0
+    input_ids[1, :4] = 0
+    return input_ids, attention_mask
+
+
+@pytest.mark.parametrize("sliding_window", [None, 4])
+def test_sdpa_matches_eager(tiny_config, sliding_window):
+    eager, sdpa = _eager_and_sdpa(dataclasses.replace(tiny_config, sliding_window=sliding_window))
+    assert eager.config.num_key_value_heads < eager.config.num_attention_heads
+    input_ids = torch.randint(1, tiny_config.vocab_size, (2, 12))
+
+    with torch.no_grad():
+        expected = eager(input_ids, use_cache=False)["logits"]
+        logits = sdpa(input_ids, use_cache=False)["logits"]
+
+    torch.testing.assert_close(logits, expected, atol=1e-5, rtol=1e-5)
+
+
+def test_sdpa_matches_eager_with_padding(tiny_config):
+    eager, sdpa = _eager_and_sdpa(tiny_config)
+    input_ids, attention_mask = _left_padded_batch(tiny_config.vocab_size)
+
+    with torch.no_grad():
+        expected = eager(input_ids, attention_mask=attention_mask, use_cache=False)["logits"]
+        logits = sdpa(input_ids, attention_mask=attention_mask, use_cache=False)["logits"]
+
+    # Padded query rows attend to nothing; only the real tokens have defined outputs
+    keep = attention_mask.bool()
+    torch.testing.assert_close(logits[keep], expected[keep], atol=1e-5, rtol=1e-5)
+
+
+def test_sdpa_matches_eager_when_decoding_from_cache(tiny_config):
+    eager, sdpa = _eager_and_sdpa(tiny_config)
+    input_ids, attention_mask = _left_padded_batch(tiny_config.vocab_size)
+    next_tokens = torch.randint(1, tiny_config.vocab_size, (2, 1))
+    step_mask = torch.cat([attention_mask, torch.ones_like(next_tokens)], dim=1)
+
+    step_logits = []
+    with torch.no_grad():
+        for model in (eager, sdpa):
+            past_key_values = model(input_ids, attention_mask=attention_mask, use_cache=True)["past_key_values"]
+            outputs = model(next_tokens, attention_mask=step_mask, past_key_values=past_key_values, use_cache=True)
+            step_logits.append(outputs["logits"])
+
+    torch.testing.assert_close(step_logits[1], step_logits[0], atol=1e-5, rtol=1e-5)
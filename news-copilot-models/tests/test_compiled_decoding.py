@@ -0,0 +1,49 @@
+"""CompiledDecoder's fixed-shape prefill/decode against the eager model"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from inference.compiled_decoding import CompiledDecoder
+
+
+def test_compiled_logits_match_eager(tiny_model):
+    decoder = CompiledDecoder(tiny_model, batch_size=2, max_prompt_len=16, max_new_tokens=8, prefill_buckets=(8, 16))
+    assert decoder.max_cache_len == 16 + 8
+    prompts = [torch.randint(1, tiny_model.config.vocab_size, (length,)).tolist() for length in (5, 11)]
+    continuations = torch.randint(1, tiny_model.config.vocab_size, (2, 4))
+
+    with torch.no_grad():
+        for slot, prompt in enumerate(prompts):
+            logits = decoder.prefill(slot, prompt)
+            expected = tiny_model(torch.tensor([prompt]), use_cache=False)["logits"][:, -1]
+            torch.testing.assert_close(logits, expected, atol=1e-4, rtol=1e-4)
+
+        # Both slots step together from different positions
+        sequences = [list(prompt) for prompt in prompts]
+        for step in range(continuations.shape[1]):
+            logits = decoder.decode(
+                [0, 1], continuations[:, step:step + 1], [len(sequence) for sequence in sequences]
+            )
+            for slot, sequence in enumerate(sequences):
+                sequence.append(int(continuations[slot, step]))
+                expected = tiny_model(torch.tensor([sequence]), use_cache=False)["logits"][:, -1]
+                torch.testing.assert_close(logits[slot:slot + 1], expected, atol=1e-4, rtol=1e-4)
+
+
+def test_cache_is_bounded_by_prompt_bucket_and_new_tokens(tiny_model):
+    decoder = CompiledDecoder(tiny_model, max_prompt_len=10, max_new_tokens=6, prefill_buckets=(8, 16, 32))
+
+    assert decoder.prefill_buckets == [8, 16]
+    assert decoder.max_cache_len == 16 + 6
+    assert decoder.fits(16, 6) and not decoder.fits(17, 1) and not decoder.fits(10, 13)
+
+
+def test_compiled_generation_matches_eager(make_generator):
+    prompt = "Story 9: the mayor said"
+    greedy = dict(max_new_tokens=8, do_sample=False, repetition_penalty=1.0, no_repeat_ngram_size=0)
+
+    eager = make_generator()
+    compiled = make_generator(compile_model=True, compile_max_prompt_len=32, compile_max_new_tokens=8)
+
+    assert compiled.generate(prompt, **greedy) == eager.generate(prompt, **greedy)
@@ -0,0 +1,99 @@
+"""Fused MLP / residual-carrying norms against the unfused baseline block, and legacy checkpoint loading"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+import torch.nn.functional as F
+
+from models.transformer_model import TransformerForCausalLM
+
+
+def _baseline_rms_norm(norm, hidden_states):
+    input_dtype = hidden_states.dtype
+    hidden_states = hidden_states.to(torch.float32)
+    variance = hidden_states.pow(2).mean(-1, keepdim=True)
+    hidden_states = hidden_states * torch.rsqrt(variance + norm.variance_epsilon)
+    return norm.weight * hidden_states.to(input_dtype)
+
+
+def _baseline_mlp(mlp, hidden_states):
+    gate_weight, up_weight = mlp.gate_up_proj.weight.chunk(2, dim=0)
+    gate = F.linear(hidden_states, gate_weight)
+    up = F.linear(hidden_states, up_weight)
+    return mlp.down_proj(F.silu(gate) * up)
+
+
+def _baseline_logits(model, input_ids):
+    """The pre-fusion decoder: separate residual adds, separate gate/up GEMMs, fp32 RMSNorm"""
+    decoder = model.model
+    hidden_states = decoder.embed_tokens(input_ids)
+    position_ids = torch.arange(input_ids.shape[1]).unsqueeze(0)
+    attention_mask = decoder._update_causal_mask(None, hidden_states, 0)
+    position_embeddings = decoder.rotary_emb(hidden_states, position_ids)
+
+    for layer in decoder.layers:
+        residual = hidden_states
+        hidden_states = _baseline_rms_norm(layer.input_layernorm, hidden_states)
+        hidden_states = layer.self_attn(
+            hidden_states,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            position_embeddings=position_embeddings,
+        )[0]
+        hidden_states = residual + hidden_states
+
+        residual = hidden_states
+        hidden_states = _baseline_mlp(layer.mlp, _baseline_rms_norm(layer.post_attention_layernorm, hidden_states))
+        hidden_states = residual + hidden_states
+
+    hidden_states = _baseline_rms_norm(decoder.norm, hidden_states)
+    return model.lm_head(hidden_states).float()
+
+
+@pytest.mark.parametrize("dtype,atol", [(torch.float32, 1e-5), (torch.bfloat16, 5e-2)])
+def test_decoder_matches_baseline_block(tiny_model, dtype, atol):
+    model = tiny_model.to(dtype)
+    input_ids = torch.randint(1, model.config.vocab_size, (2, 12))
+
+    with torch.no_grad():
+        logits = model(input_ids, use_cache=False)["logits"]
+        expected = _baseline_logits(model, input_ids)
+
+    torch.testing.assert_close(logits, expected, atol=atol, rtol=0)
+
+
+def test_hidden_states_include_the_carried_residual(tiny_model):
+    input_ids = torch.randint(1, tiny_model.config.vocab_size, (1, 8))
+
+    with torch.no_grad():
+        outputs = tiny_model.model(input_ids, use_cache=False, output_hidden_states=True, output_attentions=True)
+
+    assert len(outputs["hidden_states"]) == tiny_model.config.num_hidden_layers + 1
+    assert len(outputs["attentions"]) == tiny_model.config.num_hidden_layers
+    torch.testing.assert_close(
+        outputs["hidden_states"][0], tiny_model.model.embed_tokens(input_ids)
+    )
+
+
+def test_legacy_gate_up_checkpoint_loads(tiny_model, tmp_path):
+    state_dict = tiny_model.state_dict()
+    legacy = {}
+    for name, tensor in state_dict.items():
+        if name.endswith("mlp.gate_up_proj.weight"):
+            prefix = name[:-len("gate_up_proj.weight")]
+            gate, up = tensor.chunk(2, dim=0)
+            legacy[f"{prefix}gate_proj.weight"] = gate.clone()
+            legacy[f"{prefix}up_proj.weight"] = up.clone()
+        else:
+            legacy[name] = tensor.clone()
+
+    tiny_model.save_pretrained(str(tmp_path), safe_serialization=False)
+    torch.save(legacy, tmp_path / "pytorch_model.bin")
+    loaded = TransformerForCausalLM.from_pretrained(str(tmp_path)).eval()
+
+    assert loaded.state_dict().keys() == state_dict.keys()
+    input_ids = torch.randint(1, tiny_model.config.vocab_size, (1, 10))
+    with torch.no_grad():
+        torch.testing.assert_close(
+            loaded(input_ids, use_cache=False)["logits"], tiny_model(input_ids, use_cache=False)["logits"]
+        )
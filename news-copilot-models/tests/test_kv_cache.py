@@ -0,0 +1,68 @@
+"""Cached decoding (dynamic and static KV caches) against re-encoding the whole sequence"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.transformer_model import StaticKVCache
+
+
+def _decode_step_by_step(model, input_ids, prompt_length, past_key_values=None):
+    """Prefill `prompt_length` tokens, then feed the rest one at a time; returns logits for every position"""
+    outputs = model(input_ids[:, :prompt_length], past_key_values=past_key_values, use_cache=True)
+    logits = [outputs["logits"]]
+    past_key_values = outputs["past_key_values"]
+    for position in range(prompt_length, input_ids.shape[1]):
+        outputs = model(input_ids[:, position:position + 1], past_key_values=past_key_values, use_cache=True)
+        logits.append(outputs["logits"])
+        past_key_values = outputs["past_key_values"]
+    return torch.cat(logits, dim=1), past_key_values
+
+
+@pytest.mark.parametrize("cache_implementation", ["dynamic", "static"])
+def test_cached_logits_match_full_forward(tiny_model, cache_implementation):
+    input_ids = torch.randint(1, tiny_model.config.vocab_size, (2, 12))
+    past_key_values = None
+    if cache_implementation == "static":
+        past_key_values = StaticKVCache(tiny_model.config, batch_size=2, max_cache_len=16)
+
+    with torch.no_grad():
+        expected = tiny_model(input_ids, use_cache=False)["logits"]
+        logits, cache = _decode_step_by_step(tiny_model, input_ids, 5, past_key_values)
+
+    torch.testing.assert_close(logits, expected, atol=1e-5, rtol=1e-5)
+    if cache_implementation == "static":
+        assert cache is past_key_values
+        assert cache.get_seq_length() == input_ids.shape[1]
+
+
+def test_static_cache_rejects_overflow(tiny_model):
+    cache = StaticKVCache(tiny_model.config, batch_size=1, max_cache_len=4)
+    with torch.no_grad(), pytest.raises(ValueError, match="StaticKVCache overflow"):
+        tiny_model(torch.randint(1, tiny_model.config.vocab_size, (1, 5)), past_key_values=cache, use_cache=True)
+
+
+@pytest.mark.parametrize("cache_implementation", ["dynamic", "static"])
+def test_greedy_generation_matches_uncached(make_generator, cache_implementation):
+    generator = make_generator()
+    input_ids = torch.tensor([generator._encode_prompt("Story 3: the mayor said")])
+    greedy = dict(
+        max_new_tokens=12,
+        temperature=1.0,
+        top_k=0,
+        top_p=1.0,
+        do_sample=False,
+        repetition_penalty=1.0,
+        no_repeat_ngram_size=0,
+        pad_token_id=generator.tokenizer.eos_token_id,
+        # Never stop early, so every step is compared
+        eos_token_id=-1,
+    )
+
+    expected = generator._generate_tokens(input_ids=input_ids, use_cache=False, **greedy)
+    generated = generator._generate_tokens(
+        input_ids=input_ids, use_cache=True, cache_implementation=cache_implementation, **greedy
+    )
+
+    assert generated.shape[1] == input_ids.shape[1] + 12
+    assert torch.equal(generated, expected)
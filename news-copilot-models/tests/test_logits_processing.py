@@ -0,0 +1,99 @@
+"""Vectorized repetition penalty and incremental n-gram blocking against straightforward loops"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from inference.model_inference import NoRepeatNGramIndex
+
+
+def _reference_repetition_penalty(logits, input_ids, penalty):
+    logits = logits.clone()
+    for row in range(input_ids.shape[0]):
+        for token in set(input_ids[row].tolist()):
+            score = logits[row, token]
+            logits[row, token] = score * penalty if score < 0 else score / penalty
+    return logits
+
+
+def _reference_banned_tokens(input_ids, ngram_size):
+    banned = []
+    for tokens in input_ids.tolist():
+        prefix = tuple(tokens[len(tokens) - ngram_size + 1:])
+        banned.append({
+            tokens[i + ngram_size - 1]
+            for i in range(len(tokens) - ngram_size + 1)
+            if tuple(tokens[i:i + ngram_size - 1]) == prefix
+        })
+    return banned
+
+
+def test_repetition_penalty_matches_reference(make_generator):
+    generator = make_generator()
+    vocab_size = generator.model.config.vocab_size
+    torch.manual_seed(0)
+    logits = torch.randn(3, vocab_size)
+    # Repeated tokens must be penalized once, not once per occurrence
+    input_ids = torch.randint(0, 8, (3, 20))
+
+    penalized = generator._apply_repetition_penalty(logits.clone(), input_ids, 1.3)
+
+    torch.testing.assert_close(penalized, _reference_repetition_penalty(logits, input_ids, 1.3))
+
+
+@pytest.mark.parametrize("ngram_size", [2, 3])
+def test_ngram_index_matches_full_scan(ngram_size):
+    torch.manual_seed(0)
+    # A small alphabet so n-grams repeat often
+    input_ids = torch.randint(0, 4, (2, 40))
+    index = NoRepeatNGramIndex(ngram_size, batch_size=2)
+
+    # Grow the sequence one token at a time, as decoding does
+    for length in range(1, input_ids.shape[1] + 1):
+        prefix = input_ids[:, :length]
+        index.update(prefix)
+        banned = [set(tokens) for tokens in index.banned_tokens(prefix)]
+        assert banned == _reference_banned_tokens(prefix, ngram_size)
+
+
+def test_ngram_index_truncate_forgets_rejected_tokens():
+    torch.manual_seed(0)
+    input_ids = torch.randint(0, 4, (1, 30))
+    index = NoRepeatNGramIndex(3, batch_size=1)
+    index.update(input_ids)
+
+    # Roll back to 18 tokens, as speculative decoding does after rejected proposals
+    index.truncate(18)
+    index.update(input_ids[:, :18])
+    fresh = NoRepeatNGramIndex(3, batch_size=1)
+    fresh.update(input_ids[:, :18])
+
+    def non_empty(ngram_index):
+        return [{prefix: tokens for prefix, tokens in row.items() if tokens} for row in ngram_index.index]
+
+    assert index.banned_tokens(input_ids[:, :18]) == fresh.banned_tokens(input_ids[:, :18])
+    assert non_empty(index) == non_empty(fresh)
+
+
+def test_generation_bans_repeated_ngrams(make_generator):
+    generator = make_generator()
+    input_ids = torch.tensor([generator._encode_prompt("Story 7: the mayor said")])
+
+    generated = generator._generate_tokens(
+        input_ids=input_ids,
+        max_new_tokens=30,
+        temperature=1.0,
+        top_k=0,
+        top_p=1.0,
+        do_sample=False,
+        repetition_penalty=1.0,
+        no_repeat_ngram_size=2,
+        pad_token_id=generator.tokenizer.eos_token_id,
+        eos_token_id=-1,
+    )
+
+    tokens = generated[0].tolist()
+    # Every generated token completes a bigram that did not occur earlier in the sequence
+    for position in range(input_ids.shape[1], len(tokens)):
+        earlier = set(zip(tokens[:position - 1], tokens[1:position]))
+        assert (tokens[position - 1], tokens[position]) not in earlier
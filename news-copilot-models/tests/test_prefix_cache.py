@@ -0,0 +1,60 @@
+"""Prefilling from a prefix-cache hit against prefilling the whole prompt"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from inference.prefix_cache import PrefixCache
+
+
+def _prefill(model, token_ids, prefix_cache):
+    """What TransformerGenerator._prefill does: reuse the longest cached prefix, run the rest"""
+    cached_length, past_key_values = prefix_cache.lookup(token_ids)
+    input_ids = torch.tensor([token_ids])
+    outputs = model(input_ids[:, cached_length:], past_key_values=past_key_values, use_cache=True)
+    prefix_cache.insert(token_ids, outputs["past_key_values"])
+    return cached_length, outputs["logits"][:, -1], outputs["past_key_values"]
+
+
+def test_hit_matches_miss(tiny_model):
+    torch.manual_seed(0)
+    vocab_size = tiny_model.config.vocab_size
+    document = torch.randint(1, vocab_size, (20,)).tolist()
+    # Shares the first 18 tokens (one full block plus two) with the document, then diverges
+    edited = document[:18] + [document[18] % (vocab_size - 1) + 1] + torch.randint(1, vocab_size, (5,)).tolist()
+    prefix_cache = PrefixCache(max_bytes=2**20, block_size=16)
+
+    with torch.no_grad():
+        miss_length, _, _ = _prefill(tiny_model, document, prefix_cache)
+        hit_length, hit_logits, hit_past = _prefill(tiny_model, edited, prefix_cache)
+        expected = tiny_model(torch.tensor([edited]), use_cache=True)
+
+    assert miss_length == 0
+    assert hit_length == 18
+    assert prefix_cache.stats()["hits"] == 1 and prefix_cache.stats()["misses"] == 1
+    torch.testing.assert_close(hit_logits, expected["logits"][:, -1], atol=1e-5, rtol=1e-5)
+    for (key, value), (expected_key, expected_value) in zip(hit_past, expected["past_key_values"]):
+        torch.testing.assert_close(key, expected_key, atol=1e-5, rtol=1e-5)
+        torch.testing.assert_close(value, expected_value, atol=1e-5, rtol=1e-5)
+
+
+def test_lookup_leaves_the_last_token_to_run(tiny_model):
+    token_ids = torch.randint(1, tiny_model.config.vocab_size, (32,)).tolist()
+    prefix_cache = PrefixCache(max_bytes=2**20, block_size=16)
+
+    with torch.no_grad():
+        _prefill(tiny_model, token_ids, prefix_cache)
+        cached_length, _ = prefix_cache.lookup(token_ids)
+
+    assert cached_length == len(token_ids) - 1
+
+
+def test_generation_with_prefix_cache_matches_without(make_generator):
+    prompts = ["Story 4: the mayor said the new bridge", "Story 4: the mayor said the new bridge will open"]
+    greedy = dict(max_new_tokens=10, do_sample=False, repetition_penalty=1.0, no_repeat_ngram_size=0)
+
+    plain = make_generator()
+    cached = make_generator(prefix_cache_max_bytes=2**20)
+    for prompt in prompts:
+        assert cached.generate(prompt, **greedy) == plain.generate(prompt, **greedy)
+    assert cached.prefix_cache.stats()["hits"] >= 1
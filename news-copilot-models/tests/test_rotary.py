@@ -0,0 +1,53 @@
+"""Shared, lazily grown RoPE cos/sin tables against computing them directly"""
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.transformer_model import TransformerRotaryEmbedding
+
+
+def _direct_cos_sin(dim, base, positions):
+    inv_freq = 1.0 / (base ** (torch.arange(0, dim, 2, dtype=torch.float64) / dim))
+    freqs = torch.outer(positions.to(torch.float64), inv_freq)
+    emb = torch.cat((freqs, freqs), dim=-1)
+    return emb.cos(), emb.sin()
+
+
+def test_tables_grow_in_chunks_and_match_direct_computation():
+    rotary = TransformerRotaryEmbedding(8, max_position_embeddings=64, base=10000, chunk_size=4)
+    x = torch.zeros(1, 1, 8)
+    assert rotary.max_seq_len_cached == 4
+
+    position_ids = torch.arange(10)[None]
+    cos, sin = rotary(x, position_ids)
+    assert rotary.max_seq_len_cached == 12
+
+    expected_cos, expected_sin = _direct_cos_sin(8, 10000, torch.arange(10))
+    torch.testing.assert_close(cos[0].double(), expected_cos, atol=1e-6, rtol=0)
+    torch.testing.assert_close(sin[0].double(), expected_sin, atol=1e-6, rtol=0)
+
+
+def test_tables_follow_the_compute_dtype():
+    rotary = TransformerRotaryEmbedding(8, max_position_embeddings=64, chunk_size=16)
+    position_ids = torch.tensor([[3, 7, 11]])
+
+    cos, sin = rotary(torch.zeros(1, 1, 8, dtype=torch.bfloat16), position_ids)
+
+    expected_cos, expected_sin = _direct_cos_sin(8, 10000, position_ids[0])
+    assert cos.dtype == sin.dtype == torch.bfloat16
+    torch.testing.assert_close(cos[0], expected_cos.to(torch.bfloat16))
+    torch.testing.assert_close(sin[0], expected_sin.to(torch.bfloat16))
+
+
+def test_decode_positions_index_the_same_table(tiny_model):
+    rotary = tiny_model.model.rotary_emb
+    x = torch.zeros(1, 1, tiny_model.config.hidden_size)
+
+    full_cos, full_sin = rotary(x, torch.arange(12)[None])
+    step_cos, step_sin = rotary(x, torch.tensor([[11]]))
+
+    assert torch.equal(step_cos[0, 0], full_cos[0, 11])
+    assert torch.equal(step_sin[0, 0], full_sin[0, 11])
+    # One table is owned by the model and shared by every layer
+    assert not any(hasattr(layer.self_attn, "rotary_emb") for layer in tiny_model.model.layers)
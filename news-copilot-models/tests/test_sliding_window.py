@@ -0,0 +1,52 @@
+"""Sliding-window causal mask and the rolling SlidingWindowKVCache"""
+
+import dataclasses
+
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from models.transformer_model import SlidingWindowKVCache, TransformerForCausalLM
+
+WINDOW = 4
+
+
+@pytest.fixture
+def window_model(tiny_config):
+    torch.manual_seed(0)
+    return TransformerForCausalLM(dataclasses.replace(tiny_config, sliding_window=WINDOW)).eval()
+
+
+def test_causal_mask_is_banded(window_model):
+    mask = window_model.model._get_causal_mask(6, 6, WINDOW, torch.float32, torch.device("cpu"))
+    visible = mask == 0
+
+    for query in range(6):
+        for key in range(6):
+            assert visible[query, key] == (0 <= query - key < WINDOW)
+
+
+def test_decode_step_mask_matches_full_mask_row(window_model):
+    full = window_model.model._get_causal_mask(9, 9, WINDOW, torch.float32, torch.device("cpu"))
+    # A decode step at position 8 with every earlier key still cached
+    step = window_model.model._get_causal_mask(1, 9, WINDOW, torch.float32, torch.device("cpu"))
+
+    torch.testing.assert_close(step[0], full[-1])
+
+
+def test_rolling_cache_matches_full_forward_and_evicts(window_model):
+    input_ids = torch.randint(1, window_model.config.vocab_size, (2, 14))
+    cache = SlidingWindowKVCache(window_model.config)
+
+    with torch.no_grad():
+        expected = window_model(input_ids, use_cache=False)["logits"]
+        outputs = window_model(input_ids[:, :6], past_key_values=cache, use_cache=True)
+        logits = [outputs["logits"]]
+        for position in range(6, input_ids.shape[1]):
+            outputs = window_model(input_ids[:, position:position + 1], past_key_values=cache, use_cache=True)
+            logits.append(outputs["logits"])
+            # Only the entries the next query can still see are kept
+            assert cache.get_seq_length() == position + 1
+            assert cache.get_cached_length() == WINDOW - 1
+
+    torch.testing.assert_close(torch.cat(logits, dim=1), expected, atol=1e-5, rtol=1e-5)
@@ -0,0 +1,64 @@
+"""MemmapTokenDataset blocks against the token ids TextDataset produces for the same corpus"""
+
+import json
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("sentencepiece")
+
+from models.custom_tokenizer import train_tokenizer_from_corpus
+from training.token_dataset import MemmapTokenDataset, collate_token_blocks, pretokenize_corpus
+from training.train_model import TextDataset
+
+# Each document is long enough (over 64 tokens) that TextDataset keeps it
+DOCUMENTS = [
+    f"Article {i}: the council approved the budget for {i} new schools and {2 * i} clinics this week. " * 4
+    for i in range(40)
+]
+
+
+@pytest.fixture(scope="module")
+def corpus(tmp_path_factory):
+    root = tmp_path_factory.mktemp("corpus")
+    corpus_path = root / "news.jsonl"
+    with open(corpus_path, "w") as f:
+        for document in DOCUMENTS:
+            f.write(json.dumps({"text": document}) + "\n")
+
+    tokenizer = train_tokenizer_from_corpus([str(corpus_path)], save_dir=str(root / "tokenizer"), vocab_size=80)
+    pretokenize_corpus([str(corpus_path)], str(root / "tokenizer"), str(root / "news.bin"), num_workers=1)
+    return tokenizer, str(root / "news.bin")
+
+
+def test_memmap_tokens_match_text_dataset(corpus):
+    tokenizer, data_path = corpus
+    # A stride longer than any document keeps one (padded) example per document
+    text_dataset = TextDataset(DOCUMENTS, tokenizer, max_length=4096, stride=4096)
+    assert len(text_dataset) == len(DOCUMENTS)
+    expected = []
+    for example in text_dataset.examples:
+        # Drop TextDataset's trailing padding; every document ends with EOS
+        expected.extend(example[:len(example) - example[::-1].index(tokenizer.eos_token_id)])
+
+    dataset = MemmapTokenDataset(data_path, block_size=16)
+    assert dataset.num_tokens == len(expected)
+    assert dataset.tokens.tolist() == expected
+
+    for idx in range(len(dataset)):
+        assert dataset[idx]["input_ids"].tolist() == expected[idx * 16:(idx + 1) * 16]
+
+
+def test_blocks_are_views_widened_by_collate(corpus):
+    _, data_path = corpus
+    dataset = MemmapTokenDataset(data_path, block_size=16, stride=8)
+
+    blocks = [dataset[0], dataset[1]]
+    assert all(np.shares_memory(block["input_ids"], dataset.tokens) for block in blocks)
+
+    batch = collate_token_blocks(blocks)
+    assert batch["input_ids"].dtype == torch.int64
+    assert batch["input_ids"].shape == (2, 16)
+    torch.testing.assert_close(batch["input_ids"][1, :8], batch["input_ids"][0, 8:])
+    assert torch.equal(batch["labels"], batch["input_ids"])
@@ -0,0 +1,200 @@
+"""
+Pre-tokenized Token Dataset
+Tokenize a corpus once into a flat token file, then serve fixed-length blocks from a memory map
+"""
+
+import os
+import json
+import logging
+import multiprocessing
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from models.custom_tokenizer import CustomTokenizer, iter_corpus_texts
+
+logger = logging.getLogger(__name__)
+
+TOKENS_SUFFIX = ".bin"
+METADATA_SUFFIX = ".json"
+
+_worker_tokenizer: Optional[CustomTokenizer] = None
+
+
+def _token_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.uint16) if vocab_size <= 2**16 else np.dtype(np.uint32)
+
+
+def _output_prefix(path: str) -> str:
+    """`data/news` for any of `data/news`, `data/news.bin` or `data/news.json`"""
+    for suffix in (TOKENS_SUFFIX, METADATA_SUFFIX):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def _init_worker(tokenizer_path: str):
+    global _worker_tokenizer
+    _worker_tokenizer = CustomTokenizer.from_pretrained(tokenizer_path)
+
+
+def _tokenize_batch(texts: List[str], num_threads: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """BOS + tokens + EOS of each text, as one flat token array and the per-text lengths"""
+    tokenizer = _worker_tokenizer
+    all_tokens = tokenizer.batch_encode(
+        texts,
+        add_special_tokens=True,
+        padding=False,
+        truncation=False,
+        return_attention_mask=False,
+        num_threads=num_threads,
+    )["input_ids"]
+    lengths = np.fromiter((len(tokens) for tokens in all_tokens), dtype=np.int64, count=len(all_tokens))
+    flat = np.fromiter(
+        (token for tokens in all_tokens for token in tokens),
+        dtype=_token_dtype(tokenizer.get_vocab_size()),
+        count=int(lengths.sum()),
+    )
+    return flat, lengths
+
+
+def _batched(iterable: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def collate_token_blocks(blocks: List[Dict[str, np.ndarray]]) -> Dict[str, torch.Tensor]:
+    """Stack a batch of `MemmapTokenDataset` blocks, widening the token ids to int64 in one copy"""
+    input_ids = np.empty((len(blocks), len(blocks[0]["input_ids"])), dtype=np.int64)
+    for row, block in zip(input_ids, blocks):
+        row[:] = block["input_ids"]
+    input_ids = torch.from_numpy(input_ids)
+    # For causal LM, input and labels are the same (shifted internally in model)
+    return {
+        "input_ids": input_ids,
+        "labels": input_ids
+    }
+
+
+def pretokenize_corpus(
+    corpus_paths: Iterable[str],
+    tokenizer_path: str,
+    output_path: str,
+    num_workers: Optional[int] = None,
+    batch_size: int = 1024,
+) -> Dict[str, object]:
+    """
+    Tokenize .txt/.jsonl corpus shards into `{output}.bin`, a flat array of uint16 token ids
+    (uint32 for vocabularies over 65536), with BOS/EOS around every document.
+
+    Documents are streamed in batches to `num_workers` processes (all cores by default) and
+    written back in corpus order, so the output is deterministic and memory stays bounded.
+    `{output}.json` holds the metadata `MemmapTokenDataset` needs.
+    """
+    prefix = _output_prefix(output_path)
+    output_dir = os.path.dirname(prefix)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    num_workers = num_workers or os.cpu_count() or 1
+
+    documents = iter_corpus_texts(corpus_paths, split_lines=False)
+    batches = _batched(documents, batch_size)
+    num_documents = 0
+    num_tokens = 0
+
+    with open(prefix + TOKENS_SUFFIX, "wb") as f:
+        def write(flat, lengths):
+            nonlocal num_documents, num_tokens
+            f.write(flat.tobytes())
+            num_documents += len(lengths)
+            num_tokens += len(flat)
+
+        if num_workers > 1:
+            with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(tokenizer_path,)) as pool:
+                # Pool.imap would read the whole corpus into its task queue; keep a few batches in flight
+                pending = deque()
+                for batch in batches:
+                    pending.append(pool.apply_async(_tokenize_batch, (batch,)))
+                    if len(pending) >= 2 * num_workers:
+                        write(*pending.popleft().get())
+                while pending:
+                    write(*pending.popleft().get())
+        else:
+            _init_worker(tokenizer_path)
+            for batch in batches:
+                write(*_tokenize_batch(batch, num_threads=-1))
+
+    tokenizer = CustomTokenizer.from_pretrained(tokenizer_path)
+    metadata = {
+        "dtype": _token_dtype(tokenizer.get_vocab_size()).name,
+        "num_tokens": num_tokens,
+        "num_documents": num_documents,
+        "vocab_size": tokenizer.get_vocab_size(),
+        "tokenizer_path": os.path.abspath(tokenizer_path),
+    }
+    with open(prefix + METADATA_SUFFIX, "w") as f:
+        json.dump(metadata, f, indent=2)
+
+    logger.info(f"Wrote {num_tokens} tokens from {num_documents} documents to {prefix + TOKENS_SUFFIX}")
+    return metadata
+
+
+class MemmapTokenDataset(Dataset):
+    """
+    Fixed-length blocks over a `pretokenize_corpus` output.
+
+    Block i is tokens[i * stride : i * stride + block_size] of the flat token file (documents
+    are packed back to back, so no block is padded). The file is memory-mapped lazily in each
+    process, so DataLoader workers share the page cache instead of copying token lists.
+
+    Items are zero-copy uint16/uint32 views into the map. Pass `collate_fn` to the DataLoader:
+    it widens a whole batch to int64 in a single copy (the trainer does this automatically).
+    """
+    collate_fn = staticmethod(collate_token_blocks)
+
+    def __init__(self, path: str, block_size: int = 4096, stride: Optional[int] = None):
+        self.prefix = _output_prefix(path)
+        with open(self.prefix + METADATA_SUFFIX, "r") as f:
+            self.metadata = json.load(f)
+
+        self.block_size = block_size
+        self.stride = stride or block_size
+        if self.stride < 1 or block_size < 1:
+            raise ValueError(f"block_size and stride must be positive, got {block_size} and {self.stride}")
+
+        self.dtype = np.dtype(self.metadata["dtype"])
+        self.num_tokens = self.metadata["num_tokens"]
+        self.num_blocks = max(0, (self.num_tokens - block_size) // self.stride + 1)
+        self._tokens: Optional[np.memmap] = None
+
+    @property
+    def tokens(self) -> np.ndarray:
+        if self._tokens is None:
+            self._tokens = np.memmap(self.prefix + TOKENS_SUFFIX, dtype=self.dtype, mode="r")
+        return self._tokens
+
+    def __getstate__(self):
+        # Each worker maps the file itself rather than receiving a pickled copy of it
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        return state
+
+    def __len__(self):
+        return self.num_blocks
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += self.num_blocks
+        if not 0 <= idx < self.num_blocks:
+            raise IndexError(f"Block {idx} out of range for {self.num_blocks} blocks")
+
+        start = idx * self.stride
+        return {"input_ids": self.tokens[start:start + self.block_size]}
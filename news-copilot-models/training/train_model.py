@@ -26,8 +26,10 @@ try:
 except ImportError:
     WANDB_AVAILABLE = False
 
+from config.training_config import TrainingConfig
 from models.transformer_model import TransformerConfig, TransformerForCausalLM
-from models.custom_tokenizer import CustomTokenizer, create_custom_tokenizer_from_texts
+from models.custom_tokenizer import CustomTokenizer, TOKENIZER_MODEL_NAME, train_tokenizer_from_corpus
+from training.token_dataset import MemmapTokenDataset
 
 
 # Configure logging
@@ -83,6 +85,11 @@ class TrainingArguments:
     fp16: bool = False
     bf16: bool = True
     
+    # Gradient checkpointing (defaults follow TrainingConfig)
+    gradient_checkpointing: bool = TrainingConfig.use_gradient_checkpointing
+    gradient_checkpointing_every_n_layers: int = TrainingConfig.gradient_checkpointing_every_n_layers
+    report_gradient_checkpointing: bool = False
+    
     # Distributed training
     local_rank: int = -1
     ddp_find_unused_parameters: bool = False
@@ -116,10 +123,12 @@ class TextDataset(Dataset):
         logger.info("Tokenizing texts...")
         self.examples = []
         
-        for text in texts:
-            # Tokenize text
-            tokens = tokenizer.encode(text, add_special_tokens=True, max_length=None)
-            
+        # One native call tokenizes every text on all cores
+        all_tokens = tokenizer.batch_encode(
+            texts, add_special_tokens=True, padding=False, truncation=False, return_attention_mask=False
+        )["input_ids"]
+        
+        for tokens in all_tokens:
             # Split into chunks with stride
             for i in range(0, len(tokens), stride):
                 chunk = tokens[i:i + max_length]
@@ -164,6 +173,9 @@ class TransformerTrainer:
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.model.to(self.device)
         
+        if self.args.gradient_checkpointing:
+            self.model.gradient_checkpointing_enable(every_n_layers=self.args.gradient_checkpointing_every_n_layers)
+        
         # Setup distributed training if needed
         self.is_distributed = self.args.local_rank != -1
         if self.is_distributed:
@@ -203,7 +215,8 @@ class TransformerTrainer:
             shuffle=True,
             num_workers=4,
             pin_memory=True,
-            drop_last=True
+            drop_last=True,
+            collate_fn=getattr(self.train_dataset, "collate_fn", None)
         )
     
     def _get_eval_dataloader(self):
@@ -217,7 +230,8 @@ class TransformerTrainer:
             shuffle=False,
             num_workers=4,
             pin_memory=True,
-            drop_last=False
+            drop_last=False,
+            collate_fn=getattr(self.eval_dataset, "collate_fn", None)
         )
     
     def _calculate_total_steps(self):
@@ -294,6 +308,15 @@ class TransformerTrainer:
         logger.info(f"  Batch size per device = {self.args.per_device_train_batch_size}")
         logger.info(f"  Gradient accumulation steps = {self.args.gradient_accumulation_steps}")
         logger.info(f"  Total optimization steps = {self.total_steps}")
+        if self.args.gradient_checkpointing:
+            logger.info(
+                f"  Gradient checkpointing = every {self.args.gradient_checkpointing_every_n_layers} layer(s)"
+            )
+        else:
+            logger.info("  Gradient checkpointing = disabled")
+        
+        if self.args.report_gradient_checkpointing:
+            self.report_gradient_checkpointing()
         
         self.model.train()
         total_loss = 0.0
@@ -347,18 +370,24 @@ class TransformerTrainer:
                         avg_loss = total_loss / self.args.logging_steps
                         current_lr = self.optimizer.param_groups[0]['lr']
                         elapsed_time = time.time() - start_time
+                        step_time = elapsed_time / self.args.logging_steps
+                        peak_memory_mb = self._peak_memory_mb()
                         
                         logger.info(
                             f"Step {self.global_step} | "
                             f"Loss: {avg_loss:.4f} | "
                             f"LR: {current_lr:.2e} | "
-                            f"Time: {elapsed_time:.2f}s"
+                            f"Time: {elapsed_time:.2f}s | "
+                            f"Step time: {step_time:.2f}s | "
+                            f"Peak memory: {peak_memory_mb:.0f}MB"
                         )
                         
                         if WANDB_AVAILABLE and self.args.report_to == "wandb":
                             wandb.log({
                                 "train_loss": avg_loss,
                                 "learning_rate": current_lr,
+                                "step_time": step_time,
+                                "peak_memory_mb": peak_memory_mb,
                                 "epoch": epoch,
                                 "global_step": self.global_step
                             })
@@ -396,6 +425,36 @@ class TransformerTrainer:
         self.save_model(os.path.join(self.args.output_dir, "final_model"))
         logger.info("Training completed!")
     
+    def _peak_memory_mb(self) -> float:
+        """Peak allocated CUDA memory, or the peak RSS of the process on CPU"""
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device) / 2**20
+        try:
+            import resource
+        except ImportError:
+            # No resource module on Windows
+            return 0.0
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    
+    def report_gradient_checkpointing(self, every_n_layers_options=(0, 1, 2, 4)) -> List[Dict[str, float]]:
+        """Log the activation memory vs step time trade-off of each checkpointing granularity on one batch"""
+        model = self.model.module if isinstance(self.model, DDP) else self.model
+        batch = next(iter(self.train_dataloader))
+        batch = {k: v.to(self.device) for k, v in batch.items()}
+        results = measure_gradient_checkpointing(model, batch, every_n_layers_options)
+        
+        logger.info("Gradient checkpointing trade-off (one forward/backward pass):")
+        for result in results:
+            setting = f"every {result['every_n_layers']}" if result["every_n_layers"] else "disabled"
+            logger.info(
+                f"  {setting:>10} | "
+                f"checkpointed layers: {result['checkpointed_layers']} | "
+                f"saved activations: {result['saved_activation_mb']:.0f}MB | "
+                f"step time: {result['step_time']:.2f}s"
+            )
+        return results
+    
     def evaluate(self):
         """Evaluate the model"""
         if self.eval_dataloader is None:
@@ -424,14 +483,9 @@ class TransformerTrainer:
         """Save model and tokenizer"""
         os.makedirs(output_dir, exist_ok=True)
         
-        # Save model state dict
+        # Save weights as model.safetensors (mmap-loadable) plus config.json
         model_to_save = self.model.module if hasattr(self.model, 'module') else self.model
-        torch.save(model_to_save.state_dict(), os.path.join(output_dir, "pytorch_model.bin"))
-        
-        # Save config
-        config_dict = model_to_save.config.__dict__
-        with open(os.path.join(output_dir, "config.json"), "w") as f:
-            json.dump(config_dict, f, indent=2)
+        model_to_save.save_pretrained(output_dir)
         
         # Save tokenizer if available
         if self.tokenizer:
@@ -444,6 +498,75 @@ class TransformerTrainer:
         logger.info(f"Model saved to {output_dir}")
 
 
+def measure_gradient_checkpointing(
+    model: TransformerForCausalLM,
+    batch: Dict[str, torch.Tensor],
+    every_n_layers_options=(0, 1, 2, 4),
+    num_steps: int = 2,
+) -> List[Dict[str, float]]:
+    """
+    Time a forward/backward pass and measure the activations kept for backward under each
+    checkpointing granularity (0 = disabled). The model's checkpointing setting and train/eval
+    mode are restored afterwards.
+
+    `saved_activation_mb` is the size of the distinct non-parameter tensors autograd saved during
+    the forward pass, counted through saved_tensors_hooks so it also works on CPU. That is what
+    stays alive between forward and backward. It does not include the activations a checkpointed
+    layer recomputes during backward, which are alive only briefly, one layer at a time. Peak
+    memory is therefore somewhat higher than this number.
+    """
+    decoder = model.model
+    previous_every_n = decoder.gradient_checkpointing_every_n_layers if decoder.gradient_checkpointing else 0
+    was_training = model.training
+    parameter_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+    num_layers = len(decoder.layers)
+    
+    model.train()
+    results = []
+    try:
+        for every_n in every_n_layers_options:
+            if every_n:
+                model.gradient_checkpointing_enable(every_n_layers=every_n)
+            else:
+                model.gradient_checkpointing_disable()
+            
+            step_times = []
+            # The first pass is a warm-up and is not timed
+            for step in range(num_steps + 1):
+                saved = {}
+                
+                def pack(tensor):
+                    storage = tensor.untyped_storage()
+                    if storage.data_ptr() not in parameter_storages:
+                        saved[storage.data_ptr()] = storage.nbytes()
+                    return tensor
+                
+                start_time = time.perf_counter()
+                with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                    loss = model(**batch)["loss"]
+                loss.backward()
+                if loss.device.type == "cuda":
+                    torch.cuda.synchronize(loss.device)
+                if step > 0:
+                    step_times.append(time.perf_counter() - start_time)
+                model.zero_grad(set_to_none=True)
+            
+            results.append({
+                "every_n_layers": every_n,
+                "checkpointed_layers": len(range(0, num_layers, every_n)) if every_n else 0,
+                "saved_activation_mb": sum(saved.values()) / 2**20,
+                "step_time": sum(step_times) / len(step_times),
+            })
+    finally:
+        if previous_every_n:
+            model.gradient_checkpointing_enable(every_n_layers=previous_every_n)
+        else:
+            model.gradient_checkpointing_disable()
+        model.train(was_training)
+    
+    return results
+
+
 def load_training_data(data_path: str) -> List[str]:
     """Load training data from various formats"""
     texts = []
@@ -483,20 +606,26 @@ def main():
     # Setup output directory
     os.makedirs(args.output_dir, exist_ok=args.overwrite_output_dir)
     
+    data_path = "./training_data.txt"  # Adjust path (or a .bin written by model_utils.py pretokenize)
+    pretokenized = data_path.endswith(".bin")
+    
     # Load or create tokenizer
     logger.info("Setting up tokenizer...")
     tokenizer_path = "./tokenizer"
-    if os.path.exists(tokenizer_path):
+    if pretokenized:
+        # The token ids only make sense with the tokenizer that produced them
+        train_dataset = MemmapTokenDataset(data_path, block_size=args.block_size)
+        eval_dataset = None
+        tokenizer = CustomTokenizer.from_pretrained(train_dataset.metadata["tokenizer_path"])
+    elif os.path.exists(os.path.join(tokenizer_path, TOKENIZER_MODEL_NAME)):
         tokenizer = CustomTokenizer.from_pretrained(tokenizer_path)
     else:
-        # Create tokenizer from training data
+        # Stream the corpus into SentencePiece, which samples what it trains on
         logger.info("Creating tokenizer from training data...")
-        training_texts = load_training_data("./training_data.txt")  # Adjust path
-        tokenizer = create_custom_tokenizer_from_texts(
-            training_texts[:10000],  # Use subset for tokenizer training
-            model_name="custom_tokenizer",
-            vocab_size=args.vocab_size,
-            save_dir=tokenizer_path
+        tokenizer = train_tokenizer_from_corpus(
+            [data_path],
+            save_dir=tokenizer_path,
+            vocab_size=args.vocab_size
         )
     
     # Create model config
@@ -514,22 +643,23 @@ def main():
     logger.info("Creating model...")
     model = TransformerForCausalLM(config)
     
-    # Load training data
-    logger.info("Loading training data...")
-    training_texts = load_training_data("./training_data.txt")  # Adjust path
-    
-    # Create datasets
-    train_dataset = TextDataset(
-        training_texts[:-1000],  # All but last 1000 for training
-        tokenizer,
-        max_length=args.max_seq_length
-    )
-    
-    eval_dataset = TextDataset(
-        training_texts[-1000:],  # Last 1000 for evaluation
-        tokenizer,
-        max_length=args.max_seq_length
-    ) if len(training_texts) > 1000 else None
+    if not pretokenized:
+        # Load training data
+        logger.info("Loading training data...")
+        training_texts = load_training_data(data_path)
+        
+        # Create datasets
+        train_dataset = TextDataset(
+            training_texts[:-1000],  # All but last 1000 for training
+            tokenizer,
+            max_length=args.max_seq_length
+        )
+        
+        eval_dataset = TextDataset(
+            training_texts[-1000:],  # Last 1000 for evaluation
+            tokenizer,
+            max_length=args.max_seq_length
+        ) if len(training_texts) > 1000 else None
     
     # Create trainer
     trainer = TransformerTrainer(
@@ -6,28 +6,37 @@ import os
 import sys
 import argparse
 import logging
+import torch
 from typing import List, Dict, Any, Optional
 
 # Add the project root to Python path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 from models.transformer_model import TransformerConfig, TransformerForCausalLM
-from models.custom_tokenizer import CustomTokenizer, create_custom_tokenizer_from_texts
+from models.custom_tokenizer import CustomTokenizer, TOKENIZER_MODEL_NAME, train_tokenizer_from_corpus
+from models.quantization import quantize_dynamic_int8, save_quantized_model, quantization_accuracy_check
 from config.training_config import get_config
 from training.train_model import TransformerTrainer, TrainingArguments, TextDataset, load_training_data
+from training.token_dataset import MemmapTokenDataset, pretokenize_corpus
 from inference.model_inference import TransformerGenerator, create_model_chatbot
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def create_model(config_name: str = "tiny", save_path: str = "./models/untrained") -> None:
-    """Create and save an untrained Transformer model"""
+def create_model(
+    config_name: str = "tiny",
+    save_path: str = "./models/untrained",
+    attn_implementation: Optional[str] = None
+) -> None:
+    """Create and save an untrained Transformer model (`attn_implementation` overrides the config)"""
     
     logger.info(f"Creating {config_name} Transformer model...")
     
     # Get configuration
     config = get_config(config_name)
+    attn_implementation = attn_implementation or config.attn_implementation
+    logger.info(f"Attention implementation: {attn_implementation}")
     
     # Create model config
     model_config = TransformerConfig(
@@ -38,22 +47,14 @@ def create_model(config_name: str = "tiny", save_path: str = "./models/untrained
         num_attention_heads=config.num_attention_heads,
         num_key_value_heads=config.num_key_value_heads,
         max_position_embeddings=config.max_position_embeddings,
+        attn_implementation=attn_implementation,
     )
     
     # Create model
     model = TransformerForCausalLM(model_config)
     
-    # Save model
-    os.makedirs(save_path, exist_ok=True)
-    
-    # Save model weights
-    import torch
-    torch.save(model.state_dict(), os.path.join(save_path, "pytorch_model.bin"))
-    
-    # Save config
-    import json
-    with open(os.path.join(save_path, "config.json"), "w") as f:
-        json.dump(model_config.__dict__, f, indent=2)
+    # Save model weights and config
+    model.save_pretrained(save_path)
     
     logger.info(f"Model saved to {save_path}")
     
@@ -124,27 +125,36 @@ def train_model(
     output_dir: str = "./checkpoints",
     num_epochs: int = 1,
     batch_size: int = 1,
-    learning_rate: float = 3e-4
+    learning_rate: float = 3e-4,
+    block_size: int = 512,
+    gradient_checkpointing: Optional[bool] = None,
+    gradient_checkpointing_every_n_layers: Optional[int] = None,
+    report_gradient_checkpointing: bool = False,
+    attn_implementation: Optional[str] = None
 ) -> None:
-    """Train a Transformer model"""
+    """Train a Transformer model (`data_path` may be a `pretokenize` output .bin)"""
     
     logger.info(f"Starting training with {config_name} configuration...")
     
+    pretokenized = data_path.endswith(".bin")
+    
     # Prepare sample data if it doesn't exist
-    if not os.path.exists(data_path):
+    if not pretokenized and not os.path.exists(data_path):
         logger.info("Creating sample data...")
         prepare_sample_data(data_path)
     
     # Create tokenizer
     tokenizer_path = os.path.join(output_dir, "tokenizer")
-    if not os.path.exists(tokenizer_path):
+    if pretokenized:
+        # The token ids only make sense with the tokenizer that produced them
+        train_dataset = MemmapTokenDataset(data_path, block_size=block_size)
+        tokenizer = CustomTokenizer.from_pretrained(train_dataset.metadata["tokenizer_path"])
+    elif not os.path.exists(os.path.join(tokenizer_path, TOKENIZER_MODEL_NAME)):
         logger.info("Creating tokenizer...")
-        training_texts = load_training_data(data_path)[:100]  # Use subset for tokenizer
-        tokenizer = create_custom_tokenizer_from_texts(
-            training_texts,
-            model_name="custom_tokenizer",
-            vocab_size=32000,
-            save_dir=tokenizer_path
+        tokenizer = train_tokenizer_from_corpus(
+            [data_path],
+            save_dir=tokenizer_path,
+            vocab_size=32000
         )
     else:
         logger.info("Loading existing tokenizer...")
@@ -152,6 +162,8 @@ def train_model(
     
     # Get training config
     config = get_config(config_name)
+    attn_implementation = attn_implementation or config.attn_implementation
+    logger.info(f"Attention implementation: {attn_implementation}")
     
     # Create model config
     model_config = TransformerConfig(
@@ -162,20 +174,22 @@ def train_model(
         num_attention_heads=config.num_attention_heads,
         num_key_value_heads=config.num_key_value_heads,
         max_position_embeddings=config.max_position_embeddings,
+        attn_implementation=attn_implementation,
     )
     
     # Create model
     model = TransformerForCausalLM(model_config)
     
-    # Load training data
-    training_texts = load_training_data(data_path)
-    
-    # Create dataset
-    train_dataset = TextDataset(
-        training_texts,
-        tokenizer,
-        max_length=512  # Smaller for demo
-    )
+    if not pretokenized:
+        # Load training data
+        training_texts = load_training_data(data_path)
+        
+        # Create dataset
+        train_dataset = TextDataset(
+            training_texts,
+            tokenizer,
+            max_length=block_size
+        )
     
     # Create training arguments
     args = TrainingArguments(
@@ -186,9 +200,17 @@ def train_model(
         learning_rate=learning_rate,
         logging_steps=10,
         save_steps=100,
-        max_seq_length=512,
+        max_seq_length=block_size,
+        block_size=block_size,
         bf16=False,  # Disable for CPU training
         fp16=False,
+        gradient_checkpointing=(
+            config.use_gradient_checkpointing if gradient_checkpointing is None else gradient_checkpointing
+        ),
+        gradient_checkpointing_every_n_layers=(
+            gradient_checkpointing_every_n_layers or config.gradient_checkpointing_every_n_layers
+        ),
+        report_gradient_checkpointing=report_gradient_checkpointing,
         run_name=f"transformer-{config_name}-demo"
     )
     
@@ -252,6 +274,53 @@ def test_inference(model_path: str, prompts: Optional[List[str]] = None) -> None
         logger.error(f"Failed to load model: {e}")
 
 
+def convert_checkpoint(model_path: str, output_dir: Optional[str] = None, dtype: Optional[str] = None) -> None:
+    """Rewrite a checkpoint as model.safetensors, optionally cast to the serving dtype"""
+    
+    if not os.path.exists(model_path):
+        logger.error(f"Model not found at {model_path}")
+        return
+    
+    torch_dtype = getattr(torch, dtype) if dtype else None
+    model = TransformerForCausalLM.from_pretrained(model_path, torch_dtype=torch_dtype)
+    model.save_pretrained(output_dir or model_path)
+    
+    logger.info(f"Safetensors checkpoint saved to {output_dir or model_path}")
+
+
+def quantize_model(
+    model_path: str,
+    output_dir: Optional[str] = None,
+    data_path: Optional[str] = None,
+    num_eval_examples: int = 32,
+    max_length: int = 512
+) -> None:
+    """Save an int8 dynamically quantized copy of a model and optionally check its eval-loss drift"""
+    
+    if not os.path.exists(model_path):
+        logger.error(f"Model not found at {model_path}")
+        return
+    
+    output_dir = output_dir or model_path
+    
+    generator = TransformerGenerator(model_path, device="cpu", torch_dtype=torch.float32)
+    fp32_model = generator.model
+    quantized_model = quantize_dynamic_int8(fp32_model, inplace=False)
+    
+    save_quantized_model(quantized_model, output_dir)
+    if output_dir != model_path:
+        generator.tokenizer.save_pretrained(output_dir)
+    
+    if data_path is not None:
+        texts = load_training_data(data_path)
+        eval_dataset = TextDataset(texts, generator.tokenizer, max_length=max_length, stride=max_length)
+        batches = [eval_dataset[i] for i in range(min(num_eval_examples, len(eval_dataset)))]
+        
+        results = quantization_accuracy_check(fp32_model, quantized_model, batches)
+        for key, value in results.items():
+            logger.info(f"{key}: {value:.4f}")
+
+
 def interactive_chat_cli(model_path: str) -> None:
     """Start interactive chat"""
     
@@ -301,25 +370,66 @@ def main():
     create_parser = subparsers.add_parser('create', help='Create untrained model')
     create_parser.add_argument('--config', default='tiny', choices=['tiny', 'small', 'medium', 'large'])
     create_parser.add_argument('--output', default='./models/untrained')
+    create_parser.add_argument('--attn-implementation', choices=['eager', 'sdpa'], default=None,
+                               help='Attention backend (defaults to the config, which uses eager)')
     
     # Prepare data command
     data_parser = subparsers.add_parser('data', help='Prepare sample training data')
     data_parser.add_argument('--output', default='./data/sample_news.txt')
     
+    # Tokenizer command
+    tokenizer_parser = subparsers.add_parser('tokenizer', help='Train a tokenizer on sharded corpus files')
+    tokenizer_parser.add_argument('corpus', nargs='+', help='.txt/.jsonl files (optionally .gz), directories or globs')
+    tokenizer_parser.add_argument('--output', default='./tokenizer')
+    tokenizer_parser.add_argument('--vocab-size', type=int, default=32000)
+    tokenizer_parser.add_argument('--input-sentence-size', type=int, default=10_000_000,
+                                  help='Sentences sampled from the corpus for training (0 uses all of them)')
+    tokenizer_parser.add_argument('--no-shuffle', action='store_true',
+                                  help='Take the first sentences instead of a uniform sample')
+    tokenizer_parser.add_argument('--num-threads', type=int, default=None, help='Defaults to all cores')
+    
+    # Pretokenize command
+    pretokenize_parser = subparsers.add_parser('pretokenize', help='Tokenize a corpus into a memory-mapped token file')
+    pretokenize_parser.add_argument('corpus', nargs='+', help='.txt/.jsonl files (optionally .gz), directories or globs')
+    pretokenize_parser.add_argument('--tokenizer', required=True, help='Tokenizer directory')
+    pretokenize_parser.add_argument('--output', default='./data/tokens.bin')
+    pretokenize_parser.add_argument('--num-workers', type=int, default=None, help='Defaults to all cores')
+    
     # Train command
     train_parser = subparsers.add_parser('train', help='Train model')
     train_parser.add_argument('--config', default='tiny', choices=['tiny', 'small', 'medium', 'large'])
-    train_parser.add_argument('--data', default='./data/sample_news.txt')
+    train_parser.add_argument('--data', default='./data/sample_news.txt',
+                              help='Text/JSON(L) data, or a .bin written by pretokenize')
     train_parser.add_argument('--output', default='./checkpoints')
     train_parser.add_argument('--epochs', type=int, default=1)
     train_parser.add_argument('--batch-size', type=int, default=1)
     train_parser.add_argument('--learning-rate', type=float, default=3e-4)
+    train_parser.add_argument('--block-size', type=int, default=512)
+    train_parser.add_argument('--checkpoint-every', type=int, default=None,
+                              help='Checkpoint every Nth decoder layer (0 disables; defaults to the config)')
+    train_parser.add_argument('--report-checkpointing', action='store_true',
+                              help='Log activation memory and step time per checkpointing granularity before training')
+    train_parser.add_argument('--attn-implementation', choices=['eager', 'sdpa'], default=None,
+                              help='Attention backend (defaults to the config, which uses eager)')
     
     # Test command
     test_parser = subparsers.add_parser('test', help='Test model inference')
     test_parser.add_argument('model_path', help='Path to trained model')
     test_parser.add_argument('--prompts', nargs='*', help='Test prompts')
     
+    # Convert command
+    convert_parser = subparsers.add_parser('convert', help='Convert a checkpoint to safetensors')
+    convert_parser.add_argument('model_path', help='Path to model with pytorch_model.bin')
+    convert_parser.add_argument('--output', default=None, help='Output directory (defaults to model_path)')
+    convert_parser.add_argument('--dtype', default=None, choices=['float32', 'bfloat16', 'float16'])
+    
+    # Quantize command
+    quantize_parser = subparsers.add_parser('quantize', help='Save an int8 quantized copy for CPU inference')
+    quantize_parser.add_argument('model_path', help='Path to trained model')
+    quantize_parser.add_argument('--output', default=None, help='Output directory (defaults to model_path)')
+    quantize_parser.add_argument('--data', default=None, help='Eval data for the eval-loss drift check')
+    quantize_parser.add_argument('--num-examples', type=int, default=32)
+    
     # Chat command
     chat_parser = subparsers.add_parser('chat', help='Interactive chat')
     chat_parser.add_argument('model_path', help='Path to trained model')
@@ -327,11 +437,24 @@ def main():
     args = parser.parse_args()
     
     if args.command == 'create':
-        create_model(args.config, args.output)
+        create_model(args.config, args.output, attn_implementation=args.attn_implementation)
     
     elif args.command == 'data':
         prepare_sample_data(args.output)
     
+    elif args.command == 'tokenizer':
+        train_tokenizer_from_corpus(
+            args.corpus,
+            save_dir=args.output,
+            vocab_size=args.vocab_size,
+            input_sentence_size=args.input_sentence_size,
+            shuffle_input_sentence=not args.no_shuffle,
+            num_threads=args.num_threads
+        )
+    
+    elif args.command == 'pretokenize':
+        pretokenize_corpus(args.corpus, args.tokenizer, args.output, num_workers=args.num_workers)
+    
     elif args.command == 'train':
         train_model(
             config_name=args.config,
@@ -339,12 +462,23 @@ def main():
             output_dir=args.output,
             num_epochs=args.epochs,
             batch_size=args.batch_size,
-            learning_rate=args.learning_rate
+            learning_rate=args.learning_rate,
+            block_size=args.block_size,
+            gradient_checkpointing=None if args.checkpoint_every is None else args.checkpoint_every > 0,
+            gradient_checkpointing_every_n_layers=args.checkpoint_every or None,
+            report_gradient_checkpointing=args.report_checkpointing,
+            attn_implementation=args.attn_implementation
         )
     
     elif args.command == 'test':
         test_inference(args.model_path, args.prompts)
     
+    elif args.command == 'convert':
+        convert_checkpoint(args.model_path, args.output, args.dtype)
+    
+    elif args.command == 'quantize':
+        quantize_model(args.model_path, args.output, args.data, args.num_examples)
+    
     elif args.command == 'chat':
         interactive_chat_cli(args.model_path)
     